@@ -0,0 +1,406 @@
+#
+#    Copyright 2009 Mathieu Leocmach
+#
+#    This file is part of Colloids.
+#
+#    Colloids is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Colloids is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Colloids.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Compiled kernels used by the tracking code.
+
+These functions replace the scipy.weave inline C++ blocks that are not available on Python 3. Loops over particles or bonds are parallelized with prange."""
+import numpy as np
+from numba import jit, prange
+from math import sqrt, exp, erf, pi
+
+
+@jit(nopython=True)
+def halfG(d, R, sigma):
+    return exp(-(R+d)**2/(2*sigma**2))*sqrt(2/pi)*sigma/d + erf((R+d)/sigma/sqrt(2.0))
+
+
+@jit(nopython=True)
+def G(d, R, sigma):
+    """Gaussian blurred sphere of radius R seen at distance d"""
+    return halfG(d, R, sigma) + halfG(-d, R, sigma)
+
+
+@jit(nopython=True)
+def G0(R, sigma):
+    """Gaussian blurred sphere of radius R seen from its center"""
+    x = R/sigma/sqrt(2.0)
+    return erf(x) - x*exp(-x**2)*2/sqrt(pi)
+
+
+@jit(nopython=True)
+def DoG(d, R, sigma, alpha):
+    return G(d, R, alpha*sigma) - G(d, R, sigma)
+
+
+@jit(nopython=True)
+def halfG_dsigma(d, R, s2):
+    return (R*R + d*R + s2)*exp(-(R+d)**2/(2*s2))/sqrt(2*pi)/d/s2
+
+
+@jit(nopython=True)
+def G_dsigma(d, R, s2):
+    """Derivative of G with respect to sigma. s2 is the square of sigma."""
+    return halfG_dsigma(d, R, s2) + halfG_dsigma(-d, R, s2)
+
+
+@jit(nopython=True)
+def DoG_dsigma(d, R, sigma, alpha):
+    return alpha*G_dsigma(d, R, (alpha*sigma)**2) - G_dsigma(d, R, sigma*sigma)
+
+
+@jit(nopython=True)
+def G0_dsigma(R, sigma):
+    return -R**3/sigma**4*sqrt(2/pi)*exp(-R**2/2/sigma**2)
+
+
+@jit(nopython=True)
+def halfG_dsigma_dR(d, R, s2):
+    return -R*((R+d)**2 - s2)*exp(-(R+d)**2/(2*s2))/sqrt(2*pi)/d/(s2*s2)
+
+
+@jit(nopython=True)
+def G_dsigma_dR(d, R, s2):
+    """Cross derivative of G with respect to sigma and R. s2 is the square of sigma."""
+    return halfG_dsigma_dR(d, R, s2) + halfG_dsigma_dR(-d, R, s2)
+
+
+@jit(nopython=True)
+def DoG_dsigma_dR(d, R, sigma, alpha):
+    return alpha*G_dsigma_dR(d, R, (alpha*sigma)**2) - G_dsigma_dR(d, R, sigma*sigma)
+
+
+@jit(nopython=True)
+def G0_dsigma_dR(R, sigma):
+    return R**2*(R**2 - 3*sigma**2)/sigma**6*sqrt(2/pi)*exp(-R**2/2/sigma**2)
+
+
+@jit(nopython=True, parallel=True)
+def rescale_terms(bonds, dists, sigma0, R0, intensities, alpha, clip, v0, tr, jacob):
+    """Fill the right hand side v0, the diagonal tr and the off-diagonal terms jacob of the Newton step of global_rescale_weave and global_rescale_intensity.
+
+    If clip is True, the distance between two particles is never smaller than the sum of their radii."""
+    for i in prange(v0.shape[0]):
+        v0[i] = intensities[i] * (alpha*G0_dsigma(R0[i], alpha*sigma0[i]) - G0_dsigma(R0[i], sigma0[i]))
+        tr[i] = intensities[i] * (alpha*G0_dsigma_dR(R0[i], alpha*sigma0[i]) - G0_dsigma_dR(R0[i], sigma0[i]))
+    #contribution of each bond to v0, summed afterwards to avoid race conditions
+    contrib = np.empty((bonds.shape[0], 2))
+    for b in prange(bonds.shape[0]):
+        i = bonds[b, 0]
+        j = bonds[b, 1]
+        d = dists[b]
+        if clip:
+            d = max(d, R0[i] + R0[j])
+        jacob[b, 0] = intensities[j] * DoG_dsigma_dR(d, R0[j], sigma0[i], alpha)
+        jacob[b, 1] = intensities[i] * DoG_dsigma_dR(d, R0[i], sigma0[j], alpha)
+        contrib[b, 0] = intensities[j] * DoG_dsigma(d, R0[j], sigma0[i], alpha)
+        contrib[b, 1] = intensities[i] * DoG_dsigma(d, R0[i], sigma0[j], alpha)
+    for b in range(bonds.shape[0]):
+        v0[bonds[b, 0]] += contrib[b, 0]
+        v0[bonds[b, 1]] += contrib[b, 1]
+
+
+@jit(nopython=True, parallel=True)
+def intensity_terms(bonds, dists, sigma0, R0, alpha, tr, ofd):
+    """Fill the diagonal tr and the off-diagonal terms ofd of the linear system of solve_intensities."""
+    for i in prange(tr.shape[0]):
+        tr[i] = G0(R0[i], alpha*sigma0[i]) - G0(R0[i], sigma0[i])
+    for b in prange(bonds.shape[0]):
+        i = bonds[b, 0]
+        j = bonds[b, 1]
+        ofd[b, 0] = DoG(dists[b], R0[j], sigma0[i], alpha)
+        ofd[b, 1] = DoG(dists[b], R0[i], sigma0[j], alpha)
+
+
+@jit(nopython=True, parallel=True)
+def subpix2D(im, c0, coefprime, coefsec, centers):
+    """Crocker & Grier subpixel refinement on a 2D image. centers[p] is filled with (mean intensity in the 5x5 neighbourhood, i, j)"""
+    for p in prange(c0.shape[0]):
+        i = c0[p, 0]
+        j = c0[p, 1]
+        s = 0.0
+        for u in range(i-2, i+3):
+            for v in range(j-2, j+3):
+                s += im[u, v]
+        centers[p, 0] = s / 25.
+        num = 0.0
+        den = 0.0
+        for u in range(5):
+            num += im[i-2+u, j] * coefprime[u]
+            den += im[i-2+u, j] * coefsec[u]
+        centers[p, 1] = i - num / den
+        num = 0.0
+        den = 0.0
+        for v in range(5):
+            num += im[i, j-2+v] * coefprime[v]
+            den += im[i, j-2+v] * coefsec[v]
+        centers[p, 2] = j - num / den
+
+
+@jit(nopython=True, parallel=True)
+def subpix3D(im, c0, coefprime, coefsec, centers):
+    """Crocker & Grier subpixel refinement on a 3D image. centers[p] is filled with (mean intensity in the 5x5x5 neighbourhood, i, j, k)"""
+    for p in prange(c0.shape[0]):
+        i = c0[p, 0]
+        j = c0[p, 1]
+        k = c0[p, 2]
+        s = 0.0
+        for u in range(i-2, i+3):
+            for v in range(j-2, j+3):
+                for w in range(k-2, k+3):
+                    s += im[u, v, w]
+        centers[p, 0] = s / 125.
+        num = 0.0
+        den = 0.0
+        for u in range(5):
+            num += im[i-2+u, j, k] * coefprime[u]
+            den += im[i-2+u, j, k] * coefsec[u]
+        centers[p, 1] = i - num / den
+        num = 0.0
+        den = 0.0
+        for v in range(5):
+            num += im[i, j-2+v, k] * coefprime[v]
+            den += im[i, j-2+v, k] * coefsec[v]
+        centers[p, 2] = j - num / den
+        num = 0.0
+        den = 0.0
+        for w in range(5):
+            num += im[i, j, k-2+w] * coefprime[w]
+            den += im[i, j, k-2+w] * coefsec[w]
+        centers[p, 3] = k - num / den
+
+
+@jit(nopython=True, parallel=True)
+def draw_rods(pos, radii, im):
+    """Draw in im a segment along the first axis for each (x, y, z) position"""
+    for p in prange(pos.shape[0]):
+        i = int(pos[p, 0])
+        j = int(pos[p, 1])
+        m = max(0, int(pos[p, 2] - radii[p]))
+        M = min(im.shape[0], int(pos[p, 2] + radii[p]) + 1)
+        for z in range(m, M):
+            im[z, j, i] = 1
+
+
+@jit(nopython=True, parallel=True)
+def draw_spheres(pos, radii, intensities, sigma, zlow, order, im):
+    """Draw in the 3D image im a sphere for each (x, y, z) position.
+
+    If sigma is positive, the spheres are blurred by a Gaussian of width sigma and added, with a peak value close to intensities[p], up to 4 sigma from their surface. Otherwise the pixels inside are set to intensities[p].
+    zlow is the lowest plane reached by each sphere and order sorts zlow. Each plane is drawn by a single thread, so that the result does not depend on the number of threads."""
+    extent = radii + 4 * sigma
+    reach = 2 * extent.max() + 1
+    sorted_low = zlow[order]
+    for z in prange(im.shape[0]):
+        #spheres that may reach the plane
+        first = np.searchsorted(sorted_low, z - reach)
+        last = np.searchsorted(sorted_low, z, side='right')
+        for o in range(first, last):
+            p = order[o]
+            dz = z - pos[p, 2]
+            rho2 = extent[p]**2 - dz**2
+            if rho2 < 0:
+                continue
+            rho = sqrt(rho2)
+            for y in range(max(0, int(np.ceil(pos[p, 1] - rho))), min(im.shape[1], int(pos[p, 1] + rho) + 1)):
+                dy = y - pos[p, 1]
+                w = sqrt(max(0.0, rho2 - dy**2))
+                for x in range(max(0, int(np.ceil(pos[p, 0] - w))), min(im.shape[2], int(pos[p, 0] + w) + 1)):
+                    d2 = dz**2 + dy**2 + (x - pos[p, 0])**2
+                    if sigma > 0:
+                        d = sqrt(d2)
+                        if d < 1e-4 * sigma:
+                            v = G0(radii[p], sigma)
+                        else:
+                            v = G(d, radii[p], sigma) / 2
+                        im[z, y, x] += intensities[p] * v
+                    elif d2 <= radii[p]**2:
+                        im[z, y, x] = intensities[p]
+
+
+@jit(nopython=True)
+def greedy_nonoverlap(order, indptr, indices, good):
+    """Visit the objects in the given order and discard the ones that overlap an object already kept.
+
+    Overlaps are given as a symmetric adjacency matrix in CSR format (indptr, indices). good is set to False for the discarded objects."""
+    rank = np.empty(order.shape[0], np.int64)
+    for r in range(order.shape[0]):
+        rank[order[r]] = r
+    for r in range(order.shape[0]):
+        i = order[r]
+        for k in range(indptr[i], indptr[i+1]):
+            j = indices[k]
+            if rank[j] < r and good[j]:
+                good[i] = False
+                break
+
+
+@jit(nopython=True)
+def greedy_links(pairs, from_used, to_used):
+    """Accept the candidate links (from, to) in the given order, as long as both ends are still free.
+
+    from_used and to_used flag the ends already linked, they are updated in place. Returns the mask of the accepted links."""
+    accepted = np.zeros(pairs.shape[0], np.bool_)
+    for i in range(pairs.shape[0]):
+        p = pairs[i, 0]
+        q = pairs[i, 1]
+        if from_used[p] or to_used[q]:
+            continue
+        from_used[p] = True
+        to_used[q] = True
+        accepted[i] = True
+    return accepted
+
+
+@jit(nopython=True)
+def greedy_matching(pairs, nfrom, nto):
+    """Accept the candidate links (from, to) in the given order, as long as both ends are still free.
+
+    Returns for each destination the index of the origin it is linked to, or -1."""
+    accepted = greedy_links(pairs, np.zeros(nfrom, np.bool_), np.zeros(nto, np.bool_))
+    matched = np.full(nto, -1, np.int64)
+    for i in range(pairs.shape[0]):
+        if accepted[i]:
+            matched[pairs[i, 1]] = pairs[i, 0]
+    return matched
+
+
+def deriche_coefficients(sigma):
+    """Coefficients of the fourth order recursive approximation of the Gaussian of R. Deriche, INRIA Research Report 1893 (1993).
+
+    Returns the numerator coefficients of the causal and anticausal filters, the common denominator coefficients and the normalization factor."""
+    a0, a1, b0, w0 = 1.680, 3.735, 1.783, 0.6318
+    c0, c1, b1, w1 = -0.6803, -0.2598, 1.723, 1.997
+    cw0, sw0, cw1, sw1 = np.cos(w0/sigma), np.sin(w0/sigma), np.cos(w1/sigma), np.sin(w1/sigma)
+    e0, e1 = np.exp(-b0/sigma), np.exp(-b1/sigma)
+    n = np.array([
+        a0 + c0,
+        e1*(c1*sw1 - (c0 + 2*a0)*cw1) + e0*(a1*sw0 - (2*c0 + a0)*cw0),
+        2*e0*e1*((a0 + c0)*cw1*cw0 - a1*cw1*sw0 - c1*cw0*sw1) + c0*e0**2 + a0*e1**2,
+        e1*e0**2*(c1*sw1 - c0*cw1) + e0*e1**2*(a1*sw0 - a0*cw0)
+        ])
+    d = np.array([
+        -2*e1*cw1 - 2*e0*cw0,
+        4*cw1*cw0*e0*e1 + e1**2 + e0**2,
+        -2*cw0*e0*e1**2 - 2*cw1*e1*e0**2,
+        (e0*e1)**2
+        ])
+    m = np.append(n[1:] - d[:-1]*n[0], -d[-1]*n[0])
+    #normalization to have a unit integral
+    norm = (n.sum() + m.sum()) / (1 + d.sum())
+    return n, m, d, norm
+
+
+@jit(nopython=True, parallel=True)
+def recursive_gaussian_lines(lines, n, m, d, norm, pad):
+    """In place recursive Gaussian filter of each line of a 2D array, given the coefficients output by deriche_coefficients.
+
+    The cost per pixel does not depend on sigma. The lines are extended by pad values on each side by symmetric reflection (as scipy.ndimage mode='reflect'), then by the edge value of the extended line."""
+    N = lines.shape[1]
+    M = N + 2*pad
+    for l in prange(lines.shape[0]):
+        x = np.empty(M + 8)
+        for i in range(M):
+            j = (i - pad) % (2*N)
+            if j >= N:
+                j = 2*N - 1 - j
+            x[i+4] = lines[l, j]
+        x[:4] = x[4]
+        x[M+4:] = x[M+3]
+        #causal pass, initialized at steady state
+        yp = np.empty(M + 4)
+        yp[:4] = x[4] * (n[0] + n[1] + n[2] + n[3]) / (1 + d[0] + d[1] + d[2] + d[3])
+        for i in range(4, M+4):
+            yp[i] = (n[0]*x[i] + n[1]*x[i-1] + n[2]*x[i-2] + n[3]*x[i-3]
+                     - d[0]*yp[i-1] - d[1]*yp[i-2] - d[2]*yp[i-3] - d[3]*yp[i-4])
+        #anticausal pass, initialized at steady state
+        ym = np.empty(M + 4)
+        ym[M:] = x[M+3] * (m[0] + m[1] + m[2] + m[3]) / (1 + d[0] + d[1] + d[2] + d[3])
+        for i in range(M-1, -1, -1):
+            ym[i] = (m[0]*x[i+5] + m[1]*x[i+6] + m[2]*x[i+7] + m[3]*x[i+8]
+                     - d[0]*ym[i+1] - d[1]*ym[i+2] - d[2]*ym[i+3] - d[3]*ym[i+4])
+        for i in range(N):
+            lines[l, i] = (yp[i+pad+4] + ym[i+pad]) / norm
+
+
+@jit(nopython=True)
+def is_scale_space_minimum(flat, idx, offsets, maxDoG):
+    """Tell if flat[idx] is negative enough and not larger than any of its neighbours flat[idx+offsets]"""
+    v = flat[idx]
+    if not (v < maxDoG and float(v)**2 + 1.0 > 1.0):
+        return False
+    for o in offsets:
+        if flat[idx + o] < v:
+            return False
+    return True
+
+
+@jit(nopython=True)
+def inside_margin(q, shape, margin):
+    """Tell if the flat index q of an array of a given shape is further than margin from the edges"""
+    for a in range(shape.shape[0]-1, -1, -1):
+        u = q % shape[a]
+        if u < margin or u >= shape[a] - margin:
+            return False
+        q //= shape[a]
+    return True
+
+
+@jit(nopython=True, parallel=True)
+def scale_space_minima(flat, shape, margins, offsets, maxDoG):
+    """Coordinates of the local minima of a stack of DoG layers, without building any intermediate array.
+
+    flat is the C-contiguous stack raveled, shape its shape (layers first), offsets the flat offsets of the 3**ndim-1 neighbours of a pixel. The first and last layers, as well as the pixels closer than margins[l] to the edges of layer l, are excluded. Coordinates are in C order."""
+    L = shape[0]
+    n0 = shape[1]
+    inner = 1
+    for s in shape[2:]:
+        inner *= s
+    ntasks = max(0, (L-2) * n0)
+    #first pass: count the minima in each row
+    counts = np.zeros(ntasks + 1, np.int64)
+    for t in prange(ntasks):
+        l = t // n0 + 1
+        i = t % n0
+        r = margins[l]
+        if r < 1 or i < r or i >= n0 - r:
+            continue
+        start = (l * n0 + i) * inner
+        for q in range(inner):
+            if is_scale_space_minimum(flat, start + q, offsets, maxDoG) and inside_margin(q, shape[2:], r):
+                counts[t+1] += 1
+    starts = np.cumsum(counts)
+    out = np.empty((starts[-1], shape.shape[0]), np.int64)
+    #second pass: fill the coordinates
+    for t in prange(ntasks):
+        if counts[t+1] == 0:
+            continue
+        l = t // n0 + 1
+        i = t % n0
+        r = margins[l]
+        start = (l * n0 + i) * inner
+        k = starts[t]
+        for q in range(inner):
+            if is_scale_space_minimum(flat, start + q, offsets, maxDoG) and inside_margin(q, shape[2:], r):
+                out[k, 0] = l
+                out[k, 1] = i
+                u = q
+                for a in range(shape.shape[0]-1, 1, -1):
+                    out[k, a] = u % shape[a]
+                    u //= shape[a]
+                k += 1
+    return out
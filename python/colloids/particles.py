@@ -21,11 +21,16 @@ import numpy as np
 import numexpr
 import subprocess, shlex, os, os.path
 from scipy.spatial import cKDTree as KDTree
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.optimize import linear_sum_assignment
 #from scipy import weave
 #from scipy.weave import converters
 import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import os.path
-from colloids import periodic
+from colloids import periodic, kernels
 
 class Particles:
     """Positions of the particles at a givent time"""
@@ -718,223 +723,436 @@ def spatial_correlation(pos, is_center, values, Nbins, maxdist):
         verbose=2, compiler='gcc')
     return h, g
 
-def get_links(pos0, radii0, pos1, radii1, maxdist=1.0):
-    """Get the pairs of particles closer than maxdist in two configurations and their distances"""
-    pairs = []
-    dists = []
-    maxdist_=maxdist
-    code = """
-    const double maxdist=maxdist_;
-    //spatial indexing
-    typedef RStarTree<int, %(dim)d, 4, 32, double> RTree;
-    RTree tree;
-    for(int p=0; p<Npos0[0]; ++p)
-    {
-        typename RTree::BoundingBox bb;
-        for(int d=0; d<Npos1[1]; ++d)
-        {
-            const double r = radii0(p);
-            bb.edges[d].first = pos0(p,d) - maxdist*r;
-            bb.edges[d].second = pos0(p,d) + maxdist*r;
-        }
-        tree.Insert(p, bb);
-    }
-    //look for nearby particles
-    #pragma omp parallel for
-    for(int p=0; p<Npos1[0]; ++p)
-    {
-        std::list<int> overlapping;
-        typename RTree::BoundingBox bb;
-        for(int d=0; d<Npos1[1]; ++d)
-        {
-            const double r = radii1(p);
-            bb.edges[d].first = pos1(p,d) - maxdist*r;
-            bb.edges[d].second = pos1(p,d) + maxdist*r;
-        }
-        tree.Query(typename RTree::AcceptOverlapping(bb), Gatherer<RTree::Leaf>(overlapping));
-        overlapping.sort();
-        overlapping.unique();
-        for(std::list<int>::const_iterator it=overlapping.begin(); it!=overlapping.end(); ++it)
-        {
-            const int q = *it;
-            double dsq = 0;
-            for(int d=0; d<Npos1[1]; ++d)
-                dsq += pow(pos1(p,d)-pos0(q,d), 2);
-            if(dsq < pow(maxdist*(radii1(p)+radii0(q)), 2))
-            #pragma omp critical
-            {
-                 pairs.append(q);
-                 pairs.append(p);
-                 dists.append(sqrt(dsq));
-            }
-        }
-    }
-    """%{'dim':pos1.shape[1]}
-    weave.inline(
-        code,['pos0', 'radii0', 'pos1', 'radii1', 'maxdist_', 'pairs', 'dists'],
-        type_converters =converters.blitz,
-        support_code = support_Rtree,
-        include_dirs = [rstartree_path],
-        headers = ['"RStarTree.h"','<deque>', '<list>'],
-        extra_compile_args =['-O3 -fopenmp -mtune=native'],
-        extra_link_args=['-lgomp'],
-        verbose=2)
-    return np.resize(pairs, [len(pairs)/2,2]), np.asarray(dists)
-    
-def get_links_size(pos0, radii0, pos1, radii1, maxdist=1.0):
-    pairs, distances = get_links(pos0, radii0, pos1, radii1, maxdist)
-    code = """
-    #pragma omp parallel for
-    for(int i=0; i<Npairs[0]; ++i)
-    {
-        const int p = pairs(i,0), q = pairs(i,1);
-        distances(i) += pow(radii0(p) - radii1(q), 2);
-    }
-    """
-    weave.inline(
-        code, ['pairs', 'radii0', 'radii1', 'distances'],
-        type_converters =converters.blitz,
-        extra_compile_args =['-O3 -fopenmp'],
-        extra_link_args=['-lgomp'],
-        verbose=2, compiler='gcc')
-    return pairs, distances  
+def get_links(pos0, radii0, pos1, radii1, maxdist=1.0, workers=-1, chunk=2**16):
+    """Get the pairs of particles closer than maxdist*(r0+r1) in two configurations and their distances.
+
+    The second configuration is cut into chunks of at most chunk particles. Each chunk is matched against a KD-tree of the first configuration, in parallel on workers threads (-1 for all cores).
+    Returns pairs (index in pos0, index in pos1) sorted by the first then the second index, and distances."""
+    pos0 = np.asarray(pos0, float)
+    pos1 = np.asarray(pos1, float)
+    radii0 = np.asarray(radii0, float)
+    radii1 = np.asarray(radii1, float)
+    if len(pos0) == 0 or len(pos1) == 0:
+        return np.zeros((0, 2), int), np.zeros(0)
+    tree = KDTree(pos0, balanced_tree=False)
+    #largest possible distance of a link
+    reach = maxdist * (radii0.max() + radii1.max())
+    #the leaf order of a KD-tree makes spatially compact chunks
+    compact = KDTree(pos1, balanced_tree=False).indices
+    def links_chunk(start):
+        m = tree.sparse_distance_matrix(
+            KDTree(pos1[compact[start:start+chunk]], balanced_tree=False), reach, output_type='ndarray'
+            )
+        q = m['i'].astype(int)
+        p = compact[start + m['j']]
+        #filter out the pairs that are too far for their radii
+        good = m['v'] < maxdist * (radii0[q] + radii1[p])
+        return np.column_stack((q[good], p[good])), m['v'][good]
+    if workers < 0:
+        workers = os.cpu_count()
+    with ThreadPoolExecutor(max(1, workers)) as executor:
+        links = list(executor.map(links_chunk, range(0, len(pos1), chunk)))
+    pairs = np.vstack([l[0] for l in links])
+    dists = np.concatenate([l[1] for l in links])
+    order = np.argsort(pairs[:, 0] * len(pos1) + pairs[:, 1])
+    return pairs[order], dists[order]
+
+def get_links_size(pos0, radii0, pos1, radii1, maxdist=1.0, workers=-1):
+    """Same as get_links, but the squared difference of radii is added to the distances"""
+    pairs, distances = get_links(pos0, radii0, pos1, radii1, maxdist, workers)
+    distances += (np.asarray(radii0)[pairs[:, 0]] - np.asarray(radii1)[pairs[:, 1]])**2
+    return pairs, distances
+
+def optimal_links(pairs, distances, from_used, to_used, maxsize=100, workers=-1, batchsize=64):
+    """Choose among the candidate links (from, to) by solving an assignment problem on each connected subnetwork of candidate links.
+
+    In each subnetwork, the number of links is maximized, then the sum of their squared distances is minimized, using scipy.optimize.linear_sum_assignment. Subnetworks with more than maxsize particles on either side are solved greedily, shortest links first. Subnetworks are dispatched to workers threads (-1 for all cores) by batches of batchsize.
+    from_used and to_used flag the ends already linked, they are updated in place. Returns the mask of the accepted links."""
+    pairs = np.asarray(pairs, np.int64).reshape(-1, 2)
+    distances = np.asarray(distances, float)
+    accepted = np.zeros(len(pairs), bool)
+    free = np.where(~from_used[pairs[:,0]] & ~to_used[pairs[:,1]])[0]
+    if len(free) == 0:
+        return accepted
+    #connected components of the bipartite graph of the candidate links
+    nfrom = len(from_used)
+    graph = sparse.coo_matrix(
+        (np.ones(len(free), bool), (pairs[free,0], nfrom + pairs[free,1])),
+        shape=(nfrom + len(to_used),)*2
+        )
+    labels = connected_components(graph, directed=False)[1][pairs[free,0]]
+    order = np.argsort(labels, kind='stable')
+    free = free[order]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(labels[order])) + 1))
+    sizes = np.diff(np.append(starts, len(free)))
+    #isolated links need no choice
+    accepted[free[starts[sizes == 1]]] = True
+    def solve(idx):
+        rows, ri = np.unique(pairs[idx,0], return_inverse=True)
+        cols, ci = np.unique(pairs[idx,1], return_inverse=True)
+        if max(len(rows), len(cols)) > maxsize:
+            o = np.argsort(distances[idx])
+            return idx[o][kernels.greedy_links(
+                np.column_stack((ri, ci))[o],
+                np.zeros(len(rows), bool), np.zeros(len(cols), bool)
+                )]
+        #each link is worth more than any decrease of the sum of squared distances
+        d2 = distances[idx]**2
+        cost = np.zeros((len(rows), len(cols)))
+        cost[ri, ci] = d2 / max(d2.max(), np.finfo(float).tiny) - min(len(rows), len(cols)) - 1
+        index = np.full(cost.shape, -1)
+        index[ri, ci] = np.arange(len(idx))
+        r, c = linear_sum_assignment(cost)
+        return idx[index[r, c][cost[r, c] < 0]]
+    def solve_batch(batch):
+        return np.concatenate([solve(idx) for idx in batch])
+    subnets = [free[a:a+n] for a, n in zip(starts, sizes) if n > 1]
+    #thread pools do not chunk their tasks, so subnetworks are dispatched by batches
+    batches = [subnets[i:i+batchsize] for i in range(0, len(subnets), batchsize)]
+    if workers < 0:
+        workers = os.cpu_count()
+    with ThreadPoolExecutor(max(1, min(workers, len(batches)))) as executor:
+        for links in executor.map(solve_batch, batches):
+            accepted[links] = True
+    from_used[pairs[accepted,0]] = True
+    to_used[pairs[accepted,1]] = True
+    return accepted
+
+class GrowingArray:
+    """One dimensional array preallocated by chunks, its capacity doubling when full"""
+    def __init__(self, dtype=np.int32, capacity=16):
+        self.data = np.empty(capacity, dtype)
+        self.size = 0
+
+    def extend(self, values):
+        values = np.asarray(values, self.data.dtype).ravel()
+        n = self.size + len(values)
+        if n > len(self.data):
+            data = np.empty(max(n, 2 * len(self.data)), self.data.dtype)
+            data[:self.size] = self.array
+            self.data = data
+        self.data[self.size:n] = values
+        self.size = n
+
+    def append(self, value):
+        self.extend([value])
+
+    def truncate(self, size):
+        """Forget the elements after size"""
+        self.size = min(size, self.size)
+
+    @property
+    def array(self):
+        """View on the elements, without copy"""
+        return self.data[:self.size]
+
+    def __len__(self):
+        return self.size
 
 class Linker:
-    def __init__(self, nb_initial_pos):
-        self.tr2pos = [[p] for p in range(nb_initial_pos)]
-        self.pos2tr = [np.arange(nb_initial_pos)]
-        self.trajstart = [0 for p in range(nb_initial_pos)]
-        self.nbtrajs = [nb_initial_pos]
-        
+    """Link the positions of successive frames into trajectories.
+
+    pos2tr[t] is the int32 array of the trajectory index of each position of frame t. Since a trajectory has exactly one position per frame from its start to its end, pos2tr is all that is needed to know the positions of each trajectory. It is exported in CSR layout by get_csr, at a cost of O(links) time and memory. The starting frame of each trajectory and the number of trajectories after each frame are stored in int32 arrays grown by chunks (starts, nbtrajs_array).
+    tr2pos, trajstart and nbtrajs are the same data as lists, built again at each access.
+
+    method chooses among the candidate links:
+        'greedy': shortest links first
+        'optimal': assignment on each connected subnetwork of candidate links, falling back to greedy above maxsize particles, see optimal_links."""
+    def __init__(self, nb_initial_pos, method='greedy', maxsize=100):
+        if method not in ('greedy', 'optimal'):
+            raise ValueError("Unknown linking method %s" % method)
+        self.method = method
+        self.maxsize = maxsize
+        self.pos2tr = [np.arange(nb_initial_pos, dtype=np.int32)]
+        self.starts = GrowingArray()
+        self.starts.extend(np.zeros(nb_initial_pos))
+        self.nbtrajs_array = GrowingArray()
+        self.nbtrajs_array.append(nb_initial_pos)
+        self._csr = None
+
+    @property
+    def trajstart(self):
+        """Starting frame of each trajectory, as a list"""
+        return self.starts.array.tolist()
+
+    @property
+    def nbtrajs(self):
+        """Number of trajectories after each frame, as a list"""
+        return self.nbtrajs_array.array.tolist()
+
+    @property
+    def tr2pos(self):
+        """Position indices of each trajectory, as a list of lists built from get_csr at each access"""
+        trajstart, indptr, positions = self.get_csr()
+        return [tr.tolist() for tr in np.split(positions, indptr[1:-1])]
+
+    def get_csr(self):
+        """Trajectories in CSR layout.
+
+        Returns trajstart, indptr and positions, such that positions[indptr[tr]:indptr[tr+1]] are the position indices of trajectory tr in the successive frames starting at trajstart[tr]. trajstart is a view on the internal storage, but indptr and positions are built by sorting all the positions by trajectory: the export costs O(links) memory on top of pos2tr. The result is cached until the next change of the trajectories."""
+        if self._csr is None:
+            nb = len(self.starts)
+            frames = np.concatenate(self.pos2tr)
+            #positions are sorted by trajectory, then by frame
+            order = np.argsort(frames, kind='stable')
+            positions = np.concatenate([np.arange(len(f), dtype=np.int32) for f in self.pos2tr])[order]
+            indptr = np.zeros(nb + 1, np.int64)
+            np.cumsum(np.bincount(frames, minlength=nb), out=indptr[1:])
+            self._csr = self.starts.array, indptr, positions
+        return self._csr
+
+    def select_links(self, pairs, distances, from_used, to_used):
+        """Links chosen among the candidate pairs according to self.method. from_used and to_used flag the ends already linked, they are updated in place."""
+        pairs = np.asarray(pairs, np.int64).reshape(-1, 2)
+        if self.method == 'optimal':
+            return pairs[optimal_links(pairs, distances, from_used, to_used, self.maxsize)]
+        #sort the possible links by increasing distances
+        pairs = pairs[np.argsort(distances)]
+        return pairs[kernels.greedy_links(pairs, from_used, to_used)]
+
+    def predict(self, pos_prev, pos, method='median', previous=None):
+        """Predicted positions in the next frame of the particles of the last frame.
+
+        pos_prev and pos are the positions of the last two frames. The displacements of the trajectories present in both frames give the prediction:
+            'median': all particles move by the median displacement (global drift)
+            'particle': each particle moves by its own last displacement, or by the median displacement if its trajectory just started
+        previous is the prediction returned by the previous call, for the particles of pos_prev.
+        Returns the predicted positions and the residuals of the predictor, from which a search radius can be deduced: the norms of the differences between the previous prediction and the actual positions of the particles of the last frame. If previous is None, the residuals are the norms of the deviations of the displacements from the median displacement."""
+        if method not in ('median', 'particle'):
+            raise ValueError("Unknown prediction method %s" % method)
+        pos_prev = np.asarray(pos_prev, float)
+        pos = np.asarray(pos, float)
+        assert len(self.pos2tr) > 1 and len(pos) == len(self.pos2tr[-1])
+        #position in the previous frame of each trajectory, intermediate positions excluded
+        prev = np.full(len(self.starts), -1)
+        real = np.arange(min(len(pos_prev), len(self.pos2tr[-2])))
+        prev[self.pos2tr[-2][real]] = real
+        prev = prev[self.pos2tr[-1]]
+        known = prev >= 0
+        if not known.any():
+            return pos, np.zeros(0)
+        displ = pos[known] - pos_prev[prev[known]]
+        drift = np.median(displ, axis=0)
+        predicted = pos + drift
+        if method == 'particle':
+            predicted[known] = pos[known] + displ
+        if previous is None:
+            residuals = displ - drift
+        else:
+            residuals = pos[known] - np.asarray(previous, float)[prev[known]]
+        return predicted, np.sqrt(np.sum(residuals**2, -1))
+
+    def _new_trajectories(self, frame, positions, t):
+        """Start a new trajectory at frame t for each of the positions"""
+        frame[positions] = np.arange(len(positions)) + len(self.starts)
+        self.starts.extend(np.full(len(positions), t))
+
     def loadFrame(self, frame):
         """Load a precalculated pos2tr frame."""
         t = len(self.pos2tr)
+        frame = np.asarray(frame, np.int32)
         self.pos2tr.append(frame)
-        for p,tr in enumerate(frame):
-            if tr<self.nbtrajs[-1]:
-                self.tr2pos[tr].append(p)
-            else:
-                self.trajstart.append(t)
-                self.tr2pos.append([p])
-        self.nbtrajs.append(len(self.trajstart))
-        
+        self.starts.extend(np.full(np.sum(frame >= self.nbtrajs_array.array[-1]), t))
+        self.nbtrajs_array.append(len(self.starts))
+        self._csr = None
+
     def addFrame(self, frame_size, pairs, distances):
         assert len(pairs) == len(distances)
+        self._csr = None
+        #create the new frame
+        newframe = np.zeros(frame_size, np.int32)
         if len(pairs)==0:
-            self.tr2pos += [[p] for p in range(frame_size)]
-            self.trajstart += [len(self.pos2tr) for p in range(frame_size)]
-            self.pos2tr.append(np.arange(frame_size)+self.nbtrajs[-1])
-            self.nbtrajs.append(len(self.trajstart))
+            self._new_trajectories(newframe, np.arange(frame_size), len(self.pos2tr))
+            self.pos2tr.append(newframe)
+            self.nbtrajs_array.append(len(self.starts))
             return
         assert pairs[:,1].max() < frame_size, "The largest particle index in the new frame is larger than the new frame size"
-        #sort the possible links by increasing distances
-        pairs = pairs[np.argsort(distances)]
         #any position can be linked only once. At init none are linked
         from_used = np.zeros(len(self.pos2tr[-1]), bool)
         to_used = np.zeros(frame_size, bool)
-        #create the new frame
-        newframe = np.zeros(frame_size, int)
-        code = """
-        for(int i=0; i<Npairs[0]; ++i)
-        {
-            const int p = pairs(i,0), q = pairs(i,1);
-            if(from_used(p) | to_used(q)) continue;
-            from_used(p) = true;
-            to_used(q) = true;
-            const int tr = pos2tr(p);
-            newframe(q) = tr;
-            py::object o(tr2pos[tr]);
-            ((py::list *)&o)->append(q);
-        }
-        """
-        pos2tr = self.pos2tr[-1]
-        tr2pos = self.tr2pos
-        weave.inline(
-            code, ['pairs', 'from_used', 'to_used', 'pos2tr', 'tr2pos', 'newframe'],
-            type_converters =converters.blitz,
-            extra_compile_args =['-O3 -fopenmp -mtune=native'],
-            extra_link_args=['-lgomp'],
-            verbose=2)
         #link the bounded positions into trajectories
-        #for p,q in pairs:
-         #   if(from_used[p] or to_used[q]):continue
-          #  from_used[p] = True
-           # to_used[q] = True
-            #tr = self.pos2tr[-1][p]
-            #newframe[q] = tr
-            #self.tr2pos[tr].append(q);
+        links = self.select_links(pairs, distances, from_used, to_used)
+        newframe[links[:,1]] = self.pos2tr[-1][links[:,0]]
         #the trajectories of the previous frame that are not linked in the new frame are terminated by construction
         #but the trajectories starting in the new frame have to be created
-        notused = np.where(np.bitwise_not(to_used))[0]
-        newframe[notused] = np.arange(len(notused)) + len(self.tr2pos)
-        self.tr2pos += [[p] for p in notused]
-        self.trajstart += [len(self.pos2tr) for p in notused]
-        self.nbtrajs.append(len(self.trajstart))
+        self._new_trajectories(newframe, np.where(np.bitwise_not(to_used))[0], len(self.pos2tr))
+        self.nbtrajs_array.append(len(self.starts))
         #add the new frame
         self.pos2tr.append(newframe)
         
-    def update(self, pairs, distances):
-        """Continue trajectories terminated two steps ago (not existing one step ago). The first column of pairs contains trajectory indices, the second column contains present (last frame) positions indices."""
+    def update(self, pairs, distances, maxgap=1):
+        """Continue trajectories terminated up to maxgap+1 steps ago (not existing one step ago). The first column of pairs contains trajectory indices, the second column contains present (last frame) positions indices.
+
+        Trajectories that ended earlier are not continued. Only the last maxgap+1 frames are looked at. In each missing frame, an intermediate position is added at the end of the frame for each continued trajectory."""
         assert len(self.pos2tr)>2
         assert len(pairs) == len(distances)
-        #sort the possible links by increasing distances
-        pairs = pairs[np.argsort(distances)]
-        #any position can be linked only once. Initialize the ones allready linked.
-        from_used = np.zeros(self.nbtrajs[-2], bool)
-        from_used[self.pos2tr[-2]] = True
-        to_used = self.pos2tr[-1] < self.nbtrajs[-2]
+        self._csr = None
+        nbtrajs = self.nbtrajs_array.array
+        pairs = np.asarray(pairs, np.int64).reshape(-1, 2)
+        #last frame of the candidate trajectories within the window
+        trs, local = np.unique(pairs[:,0], return_inverse=True)
+        last = np.full(len(trs), -1)
+        for f in range(max(0, len(self.pos2tr)-2-maxgap), len(self.pos2tr)-2):
+            last[np.isin(trs, self.pos2tr[f])] = f
+        #any position can be linked only once. Initialize the ones allready linked or out of reach.
+        from_used = (last < 0) | np.isin(trs, self.pos2tr[-2])
+        to_used = self.pos2tr[-1] < nbtrajs[-2]
         #filter the links
-        links = []
-        for tr, p in pairs:
-            if from_used[tr] or to_used[p]: continue
-            from_used[tr] = True
-            to_used[p] = True
-            links.append((tr, p))
-        links = np.array(links, dtype=int)
-        links = links[np.argsort(links[:,0])]
-        #create intermediate position indices
-        self.pos2tr[-2] = np.concatenate((self.pos2tr[-2], links[:,0]))
+        links = self.select_links(np.column_stack((local, pairs[:,1])), distances, from_used, to_used)
+        ends = last[links[:,0]]
+        links[:,0] = trs[links[:,0]]
+        order = np.argsort(links[:,0])
+        links = links[order]
+        ends = ends[order]
+        #create intermediate position indices, the grown trajectories go through them
+        for f in range(ends.min() + 1 if len(ends) else len(self.pos2tr)-2, len(self.pos2tr)-1):
+            self.pos2tr[f] = np.concatenate((self.pos2tr[f], links[ends < f, 0])).astype(np.int32)
         #set grown trajectories in the present frame
         self.pos2tr[-1][links[:,1]] = links[:,0]
         #remove the trajectories previously starting in the present frame
-        del self.trajstart[self.nbtrajs[-2]:]
-        del self.tr2pos[self.nbtrajs[-2]:]
-        #grow trajectories
-        for (tr, p), inter in zip(links, range(len(self.pos2tr[-2]) - len(links), len(self.pos2tr[-2]))):
-            self.tr2pos[tr] += [inter, p]
+        self.starts.truncate(nbtrajs[-2])
         #recreate the trajectories now starting in the present frame
-        notused = np.where(np.bitwise_not(to_used))[0]
-        self.pos2tr[-1][notused] = np.arange(len(notused)) + self.nbtrajs[-2]
-        self.tr2pos += [[p] for p in notused]
-        self.trajstart += [len(self.pos2tr)-1 for p in notused]
-        self.nbtrajs[-1] = len(self.trajstart)
+        self._new_trajectories(self.pos2tr[-1], np.where(np.bitwise_not(to_used))[0], len(self.pos2tr)-1)
+        nbtrajs[-1] = len(self.starts)
         #note the trajectories that have grown in the process
-        has_grown = np.zeros(len(self.trajstart), bool)
+        has_grown = np.zeros(len(self.starts), bool)
         has_grown[links[:,0]] = True
         return has_grown
         
     def save(self, f):
         """write the trajectory data to an opend file"""
-        for start, tr in zip(self.trajstart, self.tr2pos):
+        trajstart, indptr, positions = self.get_csr()
+        #the CSR copy is not kept after the export
+        self._csr = None
+        for start, tr in zip(trajstart, np.split(positions, indptr[1:-1])):
             f.write('%d\n'%start)
             f.write('\t'.join(['%d'%p for p in tr])+'\n')
             
-def link_save(path, dt, size, radius=4.32692):
-    """Link and save the trajectories"""
+class GapCloser:
+    """Reconnect the trajectories of a Linker across up to maxgap missing frames.
+
+    The ends of the trajectories terminated in the last maxgap+1 frames are kept in a sliding window, each frame with its own spatial index. Memory is thus bounded by maxgap frames whatever the length of the experiment.
+    An end can be reconnected to a trajectory starting in the present frame if their distance is smaller than maxdist*sqrt(elapsed), with elapsed the number of time steps between them. Links are chosen by the linking method of the Linker, on distances divided by sqrt(elapsed)."""
+    def __init__(self, linker, maxgap=2, maxdist=1.0):
+        self.linker = linker
+        self.maxgap = maxgap
+        self.maxdist = maxdist
+        #frame, trajectory indices, positions, KD-tree and still free mask of the ends
+        self.ends = deque()
+
+    def __call__(self, pos_prev, pos, drift=None, maxdist=None):
+        """Reconnect the trajectories starting in the last frame. To be called after each Linker.addFrame.
+
+        pos_prev and pos are the positions of the last two frames. If drift is given, the displacement per frame of the sample, ends are moved by the drift before looking for their continuation. If maxdist is given, it replaces self.maxdist for this frame, e.g. to follow the search distance of the linking.
+        Returns the mask of the trajectories that have grown, see Linker.update."""
+        if maxdist is None:
+            maxdist = self.maxdist
+        linker = self.linker
+        t = len(linker.pos2tr) - 1
+        nbtrajs = linker.nbtrajs_array.array
+        #trajectories terminated in the previous frame, intermediate positions excluded
+        real = linker.pos2tr[-2][:len(pos_prev)]
+        terminated = ~np.isin(real, linker.pos2tr[-1])
+        if terminated.any():
+            ends = np.asarray(pos_prev, float)[:len(real)][terminated]
+            self.ends.append((t-1, real[terminated], ends, KDTree(ends), np.ones(len(ends), bool)))
+        while len(self.ends) > 0 and self.ends[0][0] < t - 1 - self.maxgap:
+            self.ends.popleft()
+        #positions of the trajectories starting in the present frame
+        new = np.where(linker.pos2tr[-1] >= nbtrajs[-2])[0]
+        pairs = []
+        distances = []
+        if len(new) > 0:
+            pos = np.asarray(pos, float)
+            for frame, trs, ends, tree, free in self.ends:
+                elapsed = t - frame
+                if elapsed < 2:
+                    continue
+                shift = 0 if drift is None else elapsed * np.asarray(drift)
+                m = tree.sparse_distance_matrix(
+                    KDTree(pos[new] - shift), maxdist * np.sqrt(elapsed),
+                    output_type='ndarray'
+                    )
+                m = m[free[m['i']]]
+                pairs.append(np.column_stack((trs[m['i']], new[m['j']])))
+                distances.append(m['v'] / np.sqrt(elapsed))
+        if len(pairs) == 0 or sum(map(len, pairs)) == 0:
+            return np.zeros(len(linker.starts), bool)
+        has_grown = linker.update(np.vstack(pairs), np.concatenate(distances), self.maxgap)
+        #reconnected ends are not free anymore
+        for frame, trs, ends, tree, free in self.ends:
+            free &= ~has_grown[trs]
+        return has_grown
+
+def save_intermediate_positions(pattern, linker, window):
+    """Save the intermediate positions that the last Linker.update added to the frames before the present one.
+
+    Each intermediate position is interpolated linearly between the position of its trajectory in the previous frame and in the present frame. It is appended to the .dat file of its frame, whose particle count in the header is updated, and the .p2tr file of the frame is saved again.
+    pattern is the format string of the .dat files. window holds the positions of the last frames, the present frame last. Its arrays are replaced by arrays that include the intermediate positions."""
+    t = len(linker.pos2tr) - 1
+    present = np.atleast_2d(window[-1])
+    for i in range(1, len(window) - 1):
+        f = t - len(window) + 1 + i
+        before = np.atleast_2d(window[i])
+        extra = linker.pos2tr[f][len(before):]
+        if len(extra) == 0:
+            continue
+        previous = np.atleast_2d(window[i-1])
+        #positions of the reconnected trajectories in the previous and in the present frames
+        p0 = np.argsort(linker.pos2tr[f-1])
+        p0 = p0[np.searchsorted(linker.pos2tr[f-1], extra, sorter=p0)]
+        p1 = np.argsort(linker.pos2tr[-1])
+        p1 = p1[np.searchsorted(linker.pos2tr[-1], extra, sorter=p1)]
+        intermediate = previous[p0] + (present[p1] - previous[p0]) / (t - f + 1)
+        with open(pattern%f) as dat:
+            lines = dat.readlines()
+        if not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        header = lines[0].split()
+        if len(header) > 1 and header[1] == '%d'%len(before):
+            header[1] = '%d'%(len(before) + len(extra))
+            lines[0] = ' '.join(header) + '\n'
+        with open(pattern%f, 'w') as dat:
+            dat.writelines(lines)
+            np.savetxt(dat, intermediate, fmt='%g')
+        np.savetxt((pattern[:-3]+'p2tr')%f, linker.pos2tr[f], fmt='%d')
+        window[i] = np.vstack((before, intermediate))
+
+def link_save(path, dt, size, radius=4.32692, method='greedy', maxdist=5, predict=None, margin=3.0, maxgap=0, minsearch=None):
+    """Link and save the trajectories. method is the linking method of the Linker.
+
+    Positions are linked within 2*maxdist. If predict is 'median' or 'particle' (see Linker.predict), the new positions are looked for around the predicted positions. The search distance is then margin times the median residual of the predictor in the previous frame, which is robust to wrong links, bounded by 2*minsearch and 2*maxdist. minsearch defaults to maxdist/5.
+    If maxgap is positive, trajectories are reconnected across up to maxgap missing frames within 2*search*sqrt(elapsed time steps), see GapCloser. search is the search distance of the linking of the present frame: maxdist, or the one given by the residuals of the predictor, in which case the ends are also moved by the median predicted displacement. The positions of the reconnected trajectories in the missing frames are interpolated and appended to the .dat files, so that the .dat, .p2tr and .traj files stay consistent, see save_intermediate_positions."""
     pattern = path+'_t%0'+('%dd.dat'%len('%d'%size))
     #last frame is often empty when acquisition was interrupted
     if len([line for line in open(pattern%(size-1))])<3 or len(np.loadtxt(pattern%(size-1), skiprows=2))==0:
         size -=1
     #linking
     pos1 = np.loadtxt(pattern%0, skiprows=2)
-    linker = Linker(len(pos1))
+    linker = Linker(len(pos1), method)
     np.savetxt((pattern[:-3]+'p2tr')%0, linker.pos2tr[0], fmt='%d')
+    closer = GapCloser(linker, maxgap, 2 * maxdist) if maxgap > 0 else None
+    #positions of the last frames, where the reconnected trajectories get intermediate positions
+    window = deque([pos1], maxlen=maxgap + 2)
+    if minsearch is None:
+        minsearch = 0.2 * maxdist
+    pos0 = None
+    previous = None
     for t in range(size-1):
-        pos0 = pos1
+        pos_prev, pos0 = pos0, pos1
         pos1 = np.loadtxt(pattern%(t+1), skiprows=2)
-        pairs, distances = get_links(pos0, np.ones(len(pos0)), pos1, np.ones(len(pos1)), maxdist=5)
+        guess, search, drift = pos0, maxdist, None
+        if predict is not None and t > 0:
+            guess, residuals = linker.predict(pos_prev, pos0, predict, previous)
+            previous = guess
+            drift = np.median(guess - pos0, axis=0)
+            if len(residuals) > 0:
+                search = min(maxdist, max(minsearch, 0.5 * margin * np.median(residuals)))
+        pairs, distances = get_links(guess, np.ones(len(pos0)), pos1, np.ones(len(pos1)), maxdist=search)
         linker.addFrame(len(pos1), pairs, distances)
-        #saving p2tr
+        window.append(pos1)
+        if closer is not None and closer(pos0, pos1, drift, 2 * search).any():
+            save_intermediate_positions(pattern, linker, window)
         np.savetxt((pattern[:-3]+'p2tr')%(t+1), linker.pos2tr[-1], fmt='%d')
     #saving in the same format as the c++
     with open(path+'.traj', 'w') as f:
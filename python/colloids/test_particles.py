@@ -1,8 +1,22 @@
 from particles import *
+import io, os.path, shutil, tempfile
+from scipy.spatial.distance import cdist
 import unittest
 import numpy.testing as npt
 
 
+def greedy_ref(pairs, distances, from_used, to_used):
+    """Former Python loop of Linker.addFrame: shortest links first, each end linked once"""
+    links = []
+    for p, q in pairs[np.argsort(distances, kind='stable')]:
+        if from_used[p] or to_used[q]:
+            continue
+        from_used[p] = True
+        to_used[q] = True
+        links.append((p, q))
+    return np.array(links, int).reshape(-1, 2)
+
+
 class TestLinker(unittest.TestCase):
     def test_one(self):
         #a single particle at t=0
@@ -75,3 +89,293 @@ class TestLinker(unittest.TestCase):
         self.assertListEqual(linker.tr2pos, [[0,0,0,0,1],[0]])
         self.assertListEqual(linker.trajstart, [0,4])
         self.assertListEqual(linker.nbtrajs, [1,1,1,1,2])
+
+    def test_intermediate(self):
+        #two particles at t=0, the second one is missing at t=1 and t=2
+        linker = Linker(2)
+        linker.addFrame(1, np.array([[0, 0]]), np.zeros(1))
+        linker.addFrame(1, np.array([[0, 0]]), np.zeros(1))
+        linker.addFrame(2, np.array([[0, 0]]), np.zeros(1))
+        self.assertListEqual(linker.tr2pos, [[0,0,0,0],[1],[1]])
+        self.assertListEqual(linker.trajstart, [0, 0, 3])
+        #the second particle at t=3 continues the second trajectory across two missing frames
+        linker.update(np.array([[1, 1]]), np.zeros(1), maxgap=2)
+        npt.assert_equal(linker.pos2tr[1], [0,1])
+        npt.assert_equal(linker.pos2tr[2], [0,1])
+        npt.assert_equal(linker.pos2tr[3], [0,1])
+        self.assertListEqual(linker.tr2pos, [[0,0,0,0],[1,1,1,1]])
+        self.assertListEqual(linker.trajstart, [0, 0])
+        self.assertListEqual(linker.nbtrajs, [2,2,2,2])
+        trajstart, indptr, positions = linker.get_csr()
+        npt.assert_equal(trajstart, [0, 0])
+        npt.assert_equal(indptr, [0, 4, 8])
+        npt.assert_equal(positions, [0,0,0,0,1,1,1,1])
+        f = io.StringIO()
+        linker.save(f)
+        self.assertEqual(f.getvalue(), '0\n0\t0\t0\t0\n0\n1\t1\t1\t1\n')
+        self.assertIsNone(linker._csr)
+
+    def test_csr(self):
+        #the CSR export agrees with the list layout built frame by frame
+        rng = np.random.RandomState(0)
+        linker = Linker(60)
+        for t in range(40):
+            m = rng.randint(50, 70)
+            k = rng.randint(0, 180)
+            pairs = np.column_stack((rng.randint(0, len(linker.pos2tr[-1]), k), rng.randint(0, m, k)))
+            linker.addFrame(m, pairs, rng.rand(k))
+            if t > 2 and rng.rand() < 0.5:
+                k = rng.randint(0, 20)
+                pairs = np.column_stack((rng.randint(0, linker.nbtrajs[-2], k), rng.randint(0, m, k)))
+                linker.update(pairs, rng.rand(k), maxgap=2)
+            tr2pos = [[] for tr in range(linker.nbtrajs[-1])]
+            trajstart = [None] * len(tr2pos)
+            for u, frame in enumerate(linker.pos2tr):
+                for p, tr in enumerate(frame):
+                    if trajstart[tr] is None:
+                        trajstart[tr] = u
+                    tr2pos[tr].append(p)
+            self.assertListEqual(linker.tr2pos, tr2pos)
+            self.assertListEqual(linker.trajstart, trajstart)
+
+    def test_greedy(self):
+        #compiled greedy matching is the same as the Python loop
+        rng = np.random.RandomState(1)
+        for n in [0, 1, 10, 100, 1000]:
+            nfrom, nto = rng.randint(1, 50, 2)
+            pairs = np.column_stack((rng.randint(0, nfrom, n), rng.randint(0, nto, n)))
+            distances = rng.rand(n)
+            from_used = rng.rand(nfrom) < 0.2
+            to_used = rng.rand(nto) < 0.2
+            ref_from, ref_to = from_used.copy(), to_used.copy()
+            ref = greedy_ref(pairs, distances, ref_from, ref_to)
+            linker = Linker(1)
+            npt.assert_equal(linker.select_links(pairs, distances, from_used, to_used), ref)
+            npt.assert_equal(from_used, ref_from)
+            npt.assert_equal(to_used, ref_to)
+            #linking a new frame
+            linker = Linker(nfrom)
+            linker.addFrame(nto, pairs, distances)
+            ref = greedy_ref(pairs, distances, np.zeros(nfrom, bool), np.zeros(nto, bool))
+            npt.assert_equal(linker.pos2tr[-1][ref[:,1]], ref[:,0])
+            self.assertEqual(linker.nbtrajs[-1], nfrom + nto - len(ref))
+
+    def test_optimal(self):
+        #greedy links the shortest pair and leaves the second particle alone
+        pairs = np.array([[0, 0], [0, 1], [1, 0]])
+        distances = np.array([0.5, 1.0, 0.8])
+        greedy = Linker(2)
+        greedy.addFrame(2, pairs, distances)
+        npt.assert_equal(greedy.pos2tr[-1], [0, 2])
+        optimal = Linker(2, 'optimal')
+        optimal.addFrame(2, pairs, distances)
+        npt.assert_equal(optimal.pos2tr[-1], [1, 0])
+        self.assertEqual(optimal.nbtrajs[-1], 2)
+        #above maxsize, the subnetwork is solved greedily
+        fallback = Linker(2, 'optimal', maxsize=1)
+        fallback.addFrame(2, pairs, distances)
+        npt.assert_equal(fallback.pos2tr[-1], greedy.pos2tr[-1])
+        #among maximal sets of links, the sum of squared distances is minimized, whereas greedy takes the shortest link first
+        pairs = np.array([[0, 0], [0, 1], [1, 0], [1, 1]])
+        accepted = optimal_links(pairs, np.array([0.1, 0.5, 0.5, 0.8]), np.zeros(2, bool), np.zeros(2, bool))
+        npt.assert_equal(accepted, [False, True, True, False])
+        self.assertRaises(ValueError, Linker, 1, 'fast')
+
+    def test_optimal_batches(self):
+        #many independent subnetworks, each a copy of the counterexample to greedy
+        n = 500
+        base = np.array([[0, 0], [0, 1], [1, 0]])
+        pairs = np.vstack([base + 2*i for i in range(n)])
+        distances = np.tile([0.5, 1.0, 0.8], n)
+        for workers, batchsize in [(1, 64), (4, 7), (-1, 1000)]:
+            from_used = np.zeros(2*n, bool)
+            to_used = np.zeros(2*n, bool)
+            accepted = optimal_links(pairs, distances, from_used, to_used, workers=workers, batchsize=batchsize)
+            npt.assert_equal(accepted, np.tile([False, True, True], n))
+            self.assertTrue(from_used.all() and to_used.all())
+
+    def test_predict(self):
+        #particles moving at constant but different velocities
+        rng = np.random.RandomState(2)
+        velocities = rng.normal(0, 1, (20, 2))
+        pos0 = rng.uniform(0, 100, (20, 2))
+        pos = [pos0 + t * velocities for t in range(3)]
+        linker = Linker(20)
+        for t in range(2):
+            linker.addFrame(20, np.column_stack((np.arange(20), np.arange(20))), np.zeros(20))
+        self.assertRaises(ValueError, linker.predict, pos[1], pos[2], 'fast')
+        guess, residuals = linker.predict(pos[0], pos[1], 'median')
+        npt.assert_allclose(guess, pos[1] + np.median(velocities, axis=0))
+        npt.assert_allclose(residuals, np.sqrt(np.sum((velocities - np.median(velocities, axis=0))**2, -1)))
+        #the residuals of the predictor are measured against the previous prediction
+        previous, residuals = linker.predict(pos[0], pos[1], 'particle')
+        npt.assert_allclose(previous, pos[2])
+        guess, residuals = linker.predict(pos[1], pos[2], 'particle', previous)
+        npt.assert_allclose(guess, pos[2] + velocities)
+        npt.assert_allclose(residuals, 0, atol=1e-12)
+
+    def test_link_save(self):
+        #perfect drift: the search distance is bounded from below
+        rng = np.random.RandomState(3)
+        path = tempfile.mkdtemp()
+        try:
+            #well separated particles on a jittered grid
+            pos = 50 * np.column_stack(np.unravel_index(np.arange(100), (10, 10))) + rng.uniform(-10, 10, (100, 2))
+            for t in range(10):
+                np.savetxt(os.path.join(path, 's_t%02d.dat'%t), np.vstack((np.zeros((2, 2)), pos[rng.permutation(100)])))
+                pos = pos + [3.0, -2.0]
+            for predict in [None, 'median', 'particle']:
+                link_save(os.path.join(path, 's'), 1.0, 10, predict=predict)
+                with open(os.path.join(path, 's.traj')) as f:
+                    lines = f.read().split('\n')[4:-1]
+                self.assertEqual(len(lines), 200, predict)
+        finally:
+            shutil.rmtree(path)
+
+    def test_gap_search(self):
+        #still particles on a grid, particle 0 is missing for 2 frames and comes back displaced
+        grid = 50.0 * np.column_stack(np.unravel_index(np.arange(25), (5, 5)))
+        path = tempfile.mkdtemp()
+        try:
+            for offset, predict, reconnected in [
+                    (2.0, None, True), (6.0, None, True),
+                    #the predictor is perfect, the search distance is minsearch
+                    (2.0, 'median', True), (6.0, 'median', False),
+                    ]:
+                for t in range(10):
+                    pos = grid.copy()
+                    if t >= 5:
+                        pos[0] += offset
+                    if t in [3, 4]:
+                        pos = pos[1:]
+                    np.savetxt(os.path.join(path, 's_t%02d.dat'%t), np.vstack((np.zeros((2, 2)), pos)))
+                #within 2*search*sqrt(3): 17.3 px without prediction, 3.5 px with
+                link_save(os.path.join(path, 's'), 1.0, 10, maxdist=5, predict=predict, maxgap=2, minsearch=1)
+                with open(os.path.join(path, 's.traj')) as f:
+                    ntrajs = len(f.read().split('\n')[4:-1]) // 2
+                self.assertEqual(ntrajs, 25 if reconnected else 26, (offset, predict))
+        finally:
+            shutil.rmtree(path)
+
+
+class TestGapCloser(unittest.TestCase):
+    def test_gaps(self):
+        #still particles on a grid
+        nframes = 20
+        grid = 20.0 * np.column_stack(np.unravel_index(np.arange(25), (5, 5)))
+        present = np.ones((nframes, len(grid)), bool)
+        #particle 0 is missing for 2 frames, particle 1 for 3 frames
+        present[3:5, 0] = False
+        present[3:6, 1] = False
+        #particles 5 to 24 leave one after the other
+        for p in range(5, len(grid)):
+            present[p - 4:, p] = False
+        linker = Linker(len(grid))
+        closer = GapCloser(linker, maxgap=2, maxdist=1.0)
+        pos1 = grid[present[0]]
+        maxends = 0
+        for t in range(1, nframes):
+            pos0, pos1 = pos1, grid[present[t]]
+            pairs, distances = get_links(pos0, np.ones(len(pos0)), pos1, np.ones(len(pos1)))
+            linker.addFrame(len(pos1), pairs, distances)
+            closer(pos0, pos1)
+            maxends = max(maxends, len(closer.ends))
+        #particle 0 is reconnected through intermediate positions
+        ids = [np.where(p)[0] for p in present]
+        trajstart, indptr, positions = linker.get_csr()
+        tr0 = linker.pos2tr[-1][0]
+        self.assertEqual(trajstart[tr0], 0)
+        self.assertEqual(indptr[tr0+1] - indptr[tr0], nframes)
+        tr0_positions = positions[indptr[tr0]:indptr[tr0+1]]
+        for t in [0, 1, 2, 5, 19]:
+            self.assertEqual(ids[t][tr0_positions[t]], 0)
+        #particle 1 is not, and its two trajectories have no intermediate position
+        tr1 = linker.pos2tr[-1][1]
+        self.assertEqual(trajstart[tr1], 6)
+        self.assertEqual(len(linker.tr2pos[linker.pos2tr[0][1]]), 3)
+        self.assertEqual(len(linker.starts), len(grid) + 1)
+        #only the ends of the last maxgap+1 frames are kept
+        self.assertLessEqual(maxends, 3)
+        self.assertTrue(all(frame >= nframes - 4 for frame, trs, ends, tree, free in closer.ends))
+
+    def test_experiment(self):
+        #the files written by link_save with gap closing are read back consistently
+        try:
+            from colloids import experiment
+        except ImportError as e:
+            self.skipTest(str(e))
+        rng = np.random.RandomState(25)
+        nframes = 10
+        grid = 20.0 * np.column_stack(np.unravel_index(np.arange(27), (3, 3, 3)))
+        truth = grid + rng.uniform(-1, 1, (nframes,) + grid.shape)
+        present = np.ones((nframes, len(grid)), bool)
+        #particle 0 is missing for 2 frames, particle 1 for 1 frame
+        present[3:5, 0] = False
+        present[7, 1] = False
+        path = tempfile.mkdtemp()
+        try:
+            for t in range(nframes):
+                ids = rng.permutation(np.where(present[t])[0])
+                np.savetxt(
+                    os.path.join(path, 's_t%02d.dat'%t),
+                    np.vstack(([1, len(ids), 1], [100, 100, 100], truth[t, ids])), fmt='%g')
+                np.save(os.path.join(path, 'ids_%02d.npy'%t), ids)
+            link_save(os.path.join(path, 's'), 1.0, nframes, maxdist=3, maxgap=2)
+            xp = experiment.Experiment(os.path.join(path, 's.traj'))
+            self.assertEqual(xp.size, nframes)
+            self.assertEqual(len(xp.trajs), len(grid))
+            npt.assert_array_equal(xp.get_nb(), [len(xp.p2tr(t)) for t in range(nframes)])
+            trajpos = xp.load_all(showprogress=False)
+            for t in range(nframes):
+                ids = np.load(os.path.join(path, 'ids_%02d.npy'%t))
+                for p, tr in enumerate(xp.p2tr(t)[:len(ids)]):
+                    self.assertEqual(xp.starts[tr], 0)
+                    npt.assert_allclose(trajpos[tr][t], truth[t, ids[p]], atol=1e-4)
+            #the positions in the missing frames are interpolated
+            for particle, frames in [(0, [3, 4]), (1, [7])]:
+                tr = xp.p2tr(0)[np.where(np.load(os.path.join(path, 'ids_00.npy')) == particle)[0][0]]
+                before, after = frames[0] - 1, frames[-1] + 1
+                for f in frames:
+                    npt.assert_allclose(
+                        trajpos[tr][f],
+                        truth[before, particle] + (truth[after, particle] - truth[before, particle]) * (f - before) / (after - before),
+                        atol=1e-4)
+        finally:
+            shutil.rmtree(path)
+
+
+class TestGetLinks(unittest.TestCase):
+    def brute(self, pos0, radii0, pos1, radii1, maxdist):
+        d = cdist(pos0, pos1)
+        pairs = np.argwhere(d < maxdist * (radii0[:, None] + radii1[None, :]))
+        return pairs, d[tuple(pairs.T)]
+
+    def test_cdist(self):
+        rng = np.random.RandomState(20)
+        for dim in [2, 3]:
+            pos0 = rng.uniform(0, 50, (500, dim))
+            pos1 = rng.uniform(0, 50, (400, dim))
+            radii0 = rng.uniform(0.5, 2, len(pos0))
+            radii1 = rng.uniform(0.5, 2, len(pos1))
+            for maxdist in [0.5, 1.5]:
+                ref_pairs, ref_dists = self.brute(pos0, radii0, pos1, radii1, maxdist)
+                self.assertTrue(len(ref_pairs) > 0)
+                #several chunks, in parallel or not
+                for chunk, workers in [(2**16, -1), (64, 1), (64, 3)]:
+                    pairs, dists = get_links(pos0, radii0, pos1, radii1, maxdist, workers, chunk)
+                    npt.assert_array_equal(pairs, ref_pairs)
+                    npt.assert_allclose(dists, ref_dists, rtol=1e-12)
+                pairs, dists = get_links_size(pos0, radii0, pos1, radii1, maxdist)
+                npt.assert_array_equal(pairs, ref_pairs)
+                npt.assert_allclose(dists, ref_dists + (radii0[ref_pairs[:, 0]] - radii1[ref_pairs[:, 1]])**2, rtol=1e-12)
+
+    def test_empty(self):
+        pos = np.random.RandomState(21).rand(10, 3)
+        for pos0, pos1 in [(pos, np.zeros((0, 3))), (np.zeros((0, 3)), pos), (np.zeros((0, 3)), np.zeros((0, 3)))]:
+            pairs, dists = get_links(pos0, np.ones(len(pos0)), pos1, np.ones(len(pos1)))
+            self.assertEqual(pairs.shape, (0, 2))
+            self.assertEqual(dists.shape, (0,))
+        #no pair close enough
+        pairs, dists = get_links(pos, np.ones(10), pos + 10, np.ones(10))
+        self.assertEqual(pairs.shape, (0, 2))
+        self.assertEqual(dists.shape, (0,))
@@ -0,0 +1,74 @@
+import os.path
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+import PIL.Image
+from colloids import tiff
+from colloids.track import readTIFF16
+
+
+class TestReader(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(5)
+        self.frames = [rng.randint(0, 2**16, (37, 53)).astype(np.uint16) for t in range(5)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, frames, **kwargs):
+        """Write frames with Pillow as the reference writer"""
+        path = os.path.join(self.dir, name)
+        ims = [PIL.Image.fromarray(f) for f in frames]
+        ims[0].save(path, save_all=True, append_images=ims[1:], **kwargs)
+        return path
+
+    def check(self, path, byteorder):
+        reader = tiff.Reader(path)
+        self.assertEqual(reader.byteorder, byteorder)
+        self.assertEqual(len(reader), len(self.frames))
+        for page, frame in zip(reader, self.frames):
+            npt.assert_array_equal(page, frame)
+        npt.assert_array_equal(reader[-1], self.frames[-1])
+        npt.assert_array_equal(readTIFF16(path), self.frames[0])
+        self.assertRaises(IndexError, reader.__getitem__, len(self.frames))
+        #contiguous pages are views on the memory map
+        self.assertTrue(np.shares_memory(reader[2], reader.map))
+        return reader
+
+    def test_little_endian(self):
+        reader = self.check(self.write('le.tif', self.frames), '<')
+        self.assertEqual(reader[0].dtype, np.dtype('<u2'))
+
+    def test_big_endian(self):
+        path = self.write('be.tif', [f.astype('>u2') for f in self.frames])
+        reader = self.check(path, '>')
+        self.assertEqual(reader[0].dtype, np.dtype('>u2'))
+
+    def test_bigtiff(self):
+        path = self.write('big.tif', self.frames, big_tiff=True)
+        with open(path, 'rb') as f:
+            if f.read(4)[2:] != b'+\x00':
+                self.skipTest('this version of Pillow cannot write BigTIFF')
+        self.check(path, '<')
+
+    def test_float(self):
+        frames = [f.astype(np.float32) / 7 for f in self.frames]
+        reader = tiff.Reader(self.write('float.tif', frames))
+        for page, frame in zip(reader, frames):
+            npt.assert_array_equal(page, frame)
+
+    def test_compressed(self):
+        path = self.write('lzw.tif', self.frames[:1], compression='tiff_lzw')
+        self.assertRaises(ValueError, tiff.Reader(path).__getitem__, 0)
+
+    def test_not_tiff(self):
+        path = os.path.join(self.dir, 'raw.tif')
+        self.frames[0].tofile(path)
+        self.assertRaises(ValueError, tiff.Reader, path)
+
+
+if __name__ == '__main__':
+    unittest.main()
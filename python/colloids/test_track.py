@@ -0,0 +1,785 @@
+import os.path
+import re
+import shutil
+import struct
+import tempfile
+import unittest
+import numba
+import numpy as np
+import numpy.testing as npt
+from scipy.special import erf
+from scipy.integrate import quad
+from colloids import kernels
+from colloids.track import *
+
+
+def halfG_ref(d, R, sigma):
+    return np.exp(-(R+d)**2/(2*sigma**2))*np.sqrt(2/np.pi)*sigma/d + erf((R+d)/sigma/np.sqrt(2.0))
+
+def G_ref(d, R, sigma):
+    return halfG_ref(d, R, sigma) + halfG_ref(-d, R, sigma)
+
+def G_dsigma_ref(d, R, s2):
+    h = lambda d: (R*R + d*R + s2)*np.exp(-(R+d)**2/(2*s2))/np.sqrt(2*np.pi)/d/s2
+    return h(d) + h(-d)
+
+def G_dsigma_dR_ref(d, R, s2):
+    h = lambda d: -R*((R+d)**2 - s2)*np.exp(-(R+d)**2/(2*s2))/np.sqrt(2*np.pi)/d/(s2*s2)
+    return h(d) + h(-d)
+
+def G0_dsigma_ref(R, sigma):
+    return -R**3/sigma**4*np.sqrt(2/np.pi)*np.exp(-R**2/2/sigma**2)
+
+def G0_dsigma_dR_ref(R, sigma):
+    return R**2*(R**2 - 3*sigma**2)/sigma**6*np.sqrt(2/np.pi)*np.exp(-R**2/2/sigma**2)
+
+def rescale_terms_ref(bonds, dists, sigma0, R0, intensities, alpha):
+    v0 = intensities * (alpha*G0_dsigma_ref(R0, alpha*sigma0) - G0_dsigma_ref(R0, sigma0))
+    tr = intensities * (alpha*G0_dsigma_dR_ref(R0, alpha*sigma0) - G0_dsigma_dR_ref(R0, sigma0))
+    i, j = bonds.T
+    DoG_dsigma = lambda d, R, s: alpha*G_dsigma_ref(d, R, (alpha*s)**2) - G_dsigma_ref(d, R, s**2)
+    DoG_dsigma_dR = lambda d, R, s: alpha*G_dsigma_dR_ref(d, R, (alpha*s)**2) - G_dsigma_dR_ref(d, R, s**2)
+    jacob = np.column_stack((
+        intensities[j] * DoG_dsigma_dR(dists, R0[j], sigma0[i]),
+        intensities[i] * DoG_dsigma_dR(dists, R0[i], sigma0[j])
+        ))
+    np.add.at(v0, i, intensities[j] * DoG_dsigma(dists, R0[j], sigma0[i]))
+    np.add.at(v0, j, intensities[i] * DoG_dsigma(dists, R0[i], sigma0[j]))
+    return v0, tr, jacob
+
+
+class TestKernels(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+
+    def test_G(self):
+        #Gaussian blurred sphere computed by radial integration (normalised to 1 inside)
+        def blurred(d, R, sigma):
+            return quad(lambda r: r/d/sigma/np.sqrt(2*np.pi)*(
+                np.exp(-(r-d)**2/(2*sigma**2)) - np.exp(-(r+d)**2/(2*sigma**2))
+                ), 0, R)[0]
+        for d, R, sigma in [(0.5, 3.0, 1.0), (2.0, 3.0, 1.5), (5.0, 2.0, 0.7), (1e-3, 4.0, 1.2)]:
+            self.assertAlmostEqual(kernels.G(d, R, sigma), 2*blurred(d, R, sigma), 6)
+            self.assertAlmostEqual(kernels.G(d, R, sigma), G_ref(d, R, sigma), 12)
+        #G0 is the limit at the center
+        self.assertAlmostEqual(kernels.G(1e-4, 3.0, 1.0)/2, kernels.G0(3.0, 1.0), 8)
+        #G_dsigma is the derivative with respect to sigma of G normalised to 1 inside, like G0
+        d, R, sigma, h = 2.0, 3.0, 1.2, 1e-6
+        self.assertAlmostEqual(
+            kernels.G_dsigma(d, R, sigma**2),
+            (kernels.G(d, R, sigma+h) - kernels.G(d, R, sigma-h))/(4*h), 6)
+        self.assertAlmostEqual(
+            kernels.G0_dsigma(R, sigma),
+            (kernels.G0(R, sigma+h) - kernels.G0(R, sigma-h))/(2*h), 6)
+
+    def test_rescale_terms(self):
+        N = 50
+        bonds = np.array([(i, j) for i in range(N) for j in range(i+1, N) if self.rng.rand() < 0.1], np.int64)
+        dists = 3 + 4*self.rng.rand(len(bonds))
+        sigma0 = 1 + self.rng.rand(N)
+        R0 = 2 + self.rng.rand(N)
+        intensities = 0.5 + self.rng.rand(N)
+        alpha = 2**(1/3.)
+        v0 = np.zeros(N)
+        tr = np.zeros(N)
+        jacob = np.zeros((len(bonds), 2))
+        kernels.rescale_terms(bonds, dists, sigma0, R0, intensities, alpha, False, v0, tr, jacob)
+        v0_ref, tr_ref, jacob_ref = rescale_terms_ref(bonds, dists, sigma0, R0, intensities, alpha)
+        npt.assert_allclose(v0, v0_ref, rtol=1e-10, atol=1e-14)
+        npt.assert_allclose(tr, tr_ref, rtol=1e-10, atol=1e-14)
+        npt.assert_allclose(jacob, jacob_ref, rtol=1e-10, atol=1e-14)
+
+    def subpix_ref(self, im, c0):
+        """Crocker & Grier subpixel refinement by numpy fancy indexing"""
+        coefprime = np.array([1, -8, 0, 8, -1])
+        coefsec = np.array([-1, 16, -30, 16, -1])
+        offsets = np.arange(-2, 3)
+        ngb = im[tuple(
+            c0[:, a].reshape((-1,) + (1,)*im.ndim) + offsets.reshape([1]+[-1 if b == a else 1 for b in range(im.ndim)])
+            for a in range(im.ndim)
+            )]
+        centers = [ngb.reshape(len(c0), -1).mean(-1)]
+        for a in range(im.ndim):
+            line = ngb[(slice(None),) + tuple(slice(None) if b == a else 2 for b in range(im.ndim))]
+            centers.append(c0[:, a] - np.dot(line, coefprime) / np.dot(line, coefsec))
+        return np.column_stack(centers)
+
+    def test_subpix2D(self):
+        im = self.rng.rand(40, 50)
+        c0 = np.column_stack((self.rng.randint(2, 38, 100), self.rng.randint(2, 48, 100)))
+        centers = np.zeros((len(c0), 3))
+        kernels.subpix2D(im, c0, coefprime, coefsec, centers)
+        npt.assert_allclose(centers, self.subpix_ref(im, c0), rtol=1e-12)
+
+    def test_subpix3D(self):
+        im = self.rng.rand(20, 25, 30)
+        c0 = np.column_stack([self.rng.randint(2, s-2, 100) for s in im.shape])
+        centers = np.zeros((len(c0), 4))
+        kernels.subpix3D(im, c0, coefprime, coefsec, centers)
+        npt.assert_allclose(centers, self.subpix_ref(im, c0), rtol=1e-12)
+
+
+class TestSparse(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(13)
+        self.N = 200
+        self.bonds = KDTree(rng.rand(self.N, 3)).query_pairs(0.15, output_type='ndarray')
+        self.off = -rng.rand(len(self.bonds), 2)
+        #diagonally dominant, hence positive definite when symmetric
+        self.diag = 1 + np.bincount(self.bonds.ravel(), -self.off.ravel(), minlength=self.N)
+        self.rhs = rng.randn(self.N)
+
+    def test_bond_matrix(self):
+        ref = np.diag(self.diag)
+        for (i, j), (a, b) in zip(self.bonds, self.off):
+            ref[i, j] = a
+            ref[j, i] = b
+        npt.assert_array_equal(bond_matrix(self.diag, self.bonds, self.off).toarray(), ref)
+
+    def test_solvers(self):
+        for off, solvers in [
+                (self.off[:, [0, 0]], ['cg', 'bicgstab']),
+                (self.off, ['bicgstab'])
+                ]:
+            mat = bond_matrix(self.diag, self.bonds, off)
+            ref = spsolve(mat.tocsc(), self.rhs)
+            npt.assert_allclose(solve_sparse(mat, self.rhs), ref, rtol=1e-12)
+            for solver in solvers:
+                npt.assert_allclose(solve_sparse(mat, self.rhs, solver), ref, atol=1e-8)
+                #the initial guess is used
+                npt.assert_array_equal(solve_sparse(mat, self.rhs, solver, x0=ref, maxiter=1), ref)
+        self.assertRaises(ValueError, solve_sparse, mat, self.rhs, 'gmres')
+
+    def test_warm_start(self):
+        rng = np.random.RandomState(14)
+        N = 50
+        bonds = np.array([(i, j) for i in range(N) for j in range(i+1, N) if rng.rand() < 0.1], np.int64)
+        dists = 3 + 4*rng.rand(len(bonds))
+        sigma0 = 1 + rng.rand(N)
+        intensities = 0.5 + rng.rand(N)
+        R1 = global_rescale_intensity(sigma0, bonds, dists, intensities)
+        ref = global_rescale_intensity(sigma0, bonds, dists, intensities, R0=R1)
+        #x0 is the increment from R0: from the exact increment, the iterative solver has nothing to do
+        npt.assert_allclose(
+            global_rescale_intensity(sigma0, bonds, dists, intensities, R0=R1, solver='bicgstab', x0=ref - R1),
+            ref, rtol=0, atol=1e-13)
+        #a warm start from the increment of the previous iteration converges to the same radii
+        npt.assert_allclose(
+            global_rescale_intensity(sigma0, bonds, dists, intensities, R0=R1, solver='bicgstab', x0=R1 - sigma2radius(sigma0)),
+            ref, atol=1e-8)
+
+
+class TestOctaveBlobFinder(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.im = gaussian_filter(rng.rand(256, 256), 2)*100
+        self.finder = OctaveBlobFinder(self.im.shape)
+
+    def test_subpix_batch(self):
+        self.finder(self.im, maxDoG=5.0)
+        npt.assert_allclose(
+            self.finder.subpix(batch=True), self.finder.subpix(batch=False),
+            rtol=1e-5)
+        #centers with a non-negative DoG value only use the background of their own neighbourhood
+        c0 = self.finder.pixel_centers()
+        self.finder.layers -= np.median(self.finder.layers[tuple(c0.T)])
+        self.assertTrue((self.finder.layers[tuple(c0.T)] >= 0).any())
+        npt.assert_allclose(
+            self.finder.subpix(batch=True), self.finder.subpix(batch=False),
+            rtol=1e-5)
+
+
+    def test_fused(self):
+        for im, kws in [
+                (self.im.astype(np.float32), [{}, dict(maxDoG=-1e-3), dict(maxedge=10)]),
+                (disks((40, 44, 48), 60, 1.5, 4, 8), [{}, dict(maxDoG=-1e-3)])
+                ]:
+            finder = OctaveBlobFinder(im.shape)
+            fused = OctaveBlobFinder(im.shape, fused=True)
+            for kw in kws:
+                centers = finder(im, **kw)
+                self.assertTrue(len(centers) > 5)
+                npt.assert_array_equal(fused(im, **kw), centers)
+                npt.assert_array_equal(fused.pixel_centers(), finder.pixel_centers())
+        self.assertRaises(ValueError, fused, im, first_layer=True)
+
+
+class TestTimings(unittest.TestCase):
+    def setUp(self):
+        self.im = np.random.RandomState(3).rand(64, 64).astype(np.float32)
+
+    def test_disabled(self):
+        finder = MultiscaleBlobFinder(self.im.shape)
+        finder(self.im)
+        self.assertEqual(finder.timings.calls, {})
+        self.assertEqual(finder.time, 0.0)
+        self.assertEqual(finder.time_overlap, 0.0)
+
+    def test_compatibility(self):
+        finder = MultiscaleBlobFinder(self.im.shape, timings=Timings(True))
+        finder(self.im)
+        t = finder.timings
+        self.assertAlmostEqual(finder.time, sum(t.time.values()))
+        self.assertEqual(finder.time_overlap, t.time['overlap'])
+        self.assertEqual(finder.octaves[1].time_fill, t.time['fill'])
+        self.assertEqual(finder.octaves[1].time_subpix, t.time['subpix'])
+        self.assertEqual(t.calls['overlap'], 1)
+        self.assertRaises(AttributeError, setattr, finder, 'time', 0.0)
+
+    def test_report(self):
+        t = Timings(True)
+        for name in ['deconvolution', 'fill']:
+            with t.stage(name):
+                pass
+        lines = t.report().split('\n')
+        self.assertEqual(len(lines), 3)
+        #columns are aligned: each field of the header ends where the values end
+        self.assertEqual(len(set(map(len, lines))), 1)
+        header = [m.end() for m in re.finditer(r'calls|\(s\)|\(ms\)|MB', lines[0])]
+        for line in lines[1:]:
+            self.assertEqual([m.end() for m in re.finditer(r'\S+', line)][1:], header)
+
+
+class TestDeconvolver(unittest.TestCase):
+    def test_deconvolve(self):
+        rng = np.random.RandomState(4)
+        im = rng.rand(16, 20, 24).astype(np.float32)
+        kernel = 1 + rng.rand(9)
+        deconvolver = Deconvolver(im.shape, kernel)
+        for k in [None, 1.6]:
+            blurred = im.astype(float) if k is None else gaussian_filter(im.astype(float), k)
+            ref = deconvolve(blurred, kernel)
+            npt.assert_allclose(deconvolver(im, k), ref, rtol=1e-6, atol=1e-6)
+            first = deconvolver(im, k, positive=True)
+            npt.assert_allclose(first, np.maximum(ref, 0), rtol=1e-6, atol=1e-6)
+        #each call returns a new array
+        self.assertFalse(np.shares_memory(first, deconvolver(im, k, positive=True)))
+
+
+def hessian_edges_ref(im, c0, maxedge):
+    """Loop over the centers, as the finders used to do"""
+    isedge = np.zeros(len(c0), bool)
+    for i, p in enumerate(c0):
+        #xy neighbourhood
+        ngb = im[tuple(p[:-2])][tuple([slice(u-1, u+2) for u in p[-2:]])]
+        hess = [
+            ngb[0, 1] - 2*ngb[1, 1] + ngb[-1,1],
+            ngb[1, 0] - 2*ngb[1, 1] + ngb[1,-1],
+            ngb[0,0] + ngb[-1,-1] - ngb[0,-1] - ngb[-1,0]
+            ]
+        detH = hess[0]*hess[1] - hess[2]**2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = (hess[0]+hess[1])**2/(4.0*hess[0]*hess[1])
+        isedge[i] = detH < 0 or ratio > maxedge
+    return isedge
+
+
+class TestHessianEdges(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(9)
+
+    def check(self, im, c0):
+        for maxedge in [1.5, 10]:
+            isedge = hessian_edges(im, c0, maxedge)
+            npt.assert_array_equal(isedge, hessian_edges_ref(im, c0, maxedge))
+            self.assertTrue(0 < isedge.sum() < len(c0))
+
+    def test_2D(self):
+        im = gaussian_filter(self.rng.rand(64, 80), 2).astype(np.float32)
+        self.check(im, np.column_stack([self.rng.randint(1, s-1, 200) for s in im.shape]))
+        self.assertEqual(len(hessian_edges(im, np.zeros((0, 2), int), 10)), 0)
+
+    def test_layers(self):
+        #leading axes (scale) are indexed by the first columns
+        im = gaussian_filter(self.rng.rand(5, 64, 80), [0, 2, 2]).astype(np.float32)
+        self.check(im, np.column_stack([self.rng.randint(1, s-1, 200) for s in im.shape]))
+
+    def test_crocker_grier(self):
+        im = disks((128, 140), 40, 2, 8, 0)
+        finder = CrockerGrierFinder(im.shape)
+        all_centers = finder(im)
+        finder.initialize_binary()
+        c0 = np.transpose(np.where(finder.binary))
+        kept = c0[np.logical_not(hessian_edges_ref(finder.blurred, c0, 10))]
+        self.assertTrue(0 < len(kept) < len(all_centers))
+        finder(im, maxedge=10)
+        npt.assert_array_equal(np.transpose(np.where(finder.binary)), kept)
+
+
+def clusters2particles_ref(clusters, k=1.6, n=3):
+    """Per cluster loop, as clusters2particles used to do. Subclusters are appended to clusters."""
+    particles = []
+    N = max(map(len, clusters))
+    finders = [MultiscaleBlobFinder([l], n, 3) for l in range(5, N+1)]
+    def maximum(cl):
+        m = np.argmax(cl[:,-2])
+        if m > 0 and m+1 < len(cl):
+            z = measurements.center_of_mass(cl[m-1:m+2,-2])[0] + m - 1
+        else:
+            z = measurements.center_of_mass(cl[:,-2])[0]
+        return [np.array([[z, cl[len(cl)//2,-2], 0.0]])]
+    for cl in clusters:
+        if len(cl) < 3:
+            continue
+        if len(cl) < 5:
+            blobs = maximum(cl)
+        else:
+            gradxy = np.sqrt(sobel(cl[:,0], axis=0)**2 + sobel(cl[:,1], axis=0)**2)
+            gradblobs = finders[len(cl)-5](gradxy, k)
+            gradblobs = gradblobs[gradblobs[:,-1] < -0.05]
+            if len(gradblobs):
+                clusters += np.array_split(cl, np.sort(np.rint(gradblobs[:,0]).astype(int)))
+                continue
+            blobs = [b for b in [finders[len(cl)-5](u, k) for u in [cl[:,3], cl[:,4]]] if len(b)]
+            if len(blobs) == 0:
+                blobs = maximum(cl)
+        blobs = np.vstack([bs[np.argsort(bs[:,-1])] for bs in blobs])
+        out = []
+        for i in blobs:
+            for j in out:
+                if (i[0]-j[0])**2 < (i[1]+j[1])**2:
+                    break
+            else:
+                out.append(i)
+        grad = gaussian_filter1d(cl, k/2, axis=0, order=1)
+        for z, s, v in out:
+            zi = min(max(int(np.rint(z)), 0), len(cl)-1)
+            particles.append(cl[zi] + grad[zi]*(z-zi))
+    return np.array(particles)
+
+
+def random_clusters(nb, seed):
+    """Noisy piles of 2D centers (x, y, z, r, intensity) of one or two spheres along z"""
+    rng = np.random.RandomState(seed)
+    clusters = []
+    for i in range(nb):
+        #one or two particles piled along z
+        R = rng.uniform(3, 8, 2)
+        z0 = np.array([R[0], 2*R[0] + R[1]*rng.uniform(0.5, 1)])
+        L = rng.randint(2, 2 + 2*R[0] + (2*R[1] if rng.rand() < 0.3 else 0))
+        z = np.arange(L, dtype=float)
+        p = np.argmin(np.abs(z[:, None] - z0), axis=1)
+        xy = rng.uniform(0, 100, (2, 2))[p] + 0.1*rng.randn(L, 2)
+        r = np.sqrt(np.maximum(R[p]**2 - (z - z0[p])**2, 0.5)) + 0.1*rng.randn(L)
+        clusters.append(np.column_stack((xy, z, r, r**2 * rng.uniform(0.5, 1))))
+    return clusters
+
+
+class TestClusters(unittest.TestCase):
+    def test_batch_finder(self):
+        for length in [5, 9, 16]:
+            signals = np.random.RandomState(length).rand(50, length)
+            finder = MultiscaleBlobFinder([length], 3, 3)
+            ref = np.vstack([
+                np.column_stack((np.full(len(c), i), c))
+                for i, c in enumerate(finder(s) for s in signals)
+                ])
+            self.assertTrue(len(ref) > 0)
+            npt.assert_allclose(BatchBlobFinder(signals.shape, 3, 3)(signals), ref, rtol=1e-10, atol=1e-10)
+
+    def test_clusters2particles(self):
+        clusters = random_clusters(300, 0)
+        ref = list(clusters)
+        particles = clusters2particles_ref(ref)
+        #some clusters were split
+        self.assertTrue(len(ref) > len(clusters))
+        npt.assert_allclose(clusters2particles(clusters), particles, rtol=1e-10, atol=1e-10)
+        #CSR-like input
+        offsets = np.cumsum([0] + [len(cl) for cl in clusters])
+        npt.assert_allclose(
+            clusters2particles((offsets, np.vstack(clusters))), particles, rtol=1e-10, atol=1e-10)
+
+
+class TestLocalize2D3D(unittest.TestCase):
+    def test_link_slices(self):
+        slices = [
+            np.array([[10, 10, 3, -1], [30, 30, 3, -2]]),
+            #the closest of two candidates is linked, a center further than the radii is not
+            np.array([[11, 10, 3, -3], [10.5, 10, 3, -4], [40, 30, 3, -5]]),
+            #an empty slice breaks all clusters
+            np.zeros((0, 4)),
+            np.array([[10, 10, 3, -6]])
+            ]
+        clusters = link_slices(slices, ZXratio=2.0)
+        self.assertEqual(len(clusters), 5)
+        npt.assert_array_equal(clusters[0], [[10, 10, 0, 3, 1], [10.5, 10, 2, 3, 4]])
+        npt.assert_array_equal(np.vstack(clusters[1:]), [
+            [30, 30, 0, 3, 2], [11, 10, 2, 3, 3], [40, 30, 2, 3, 5], [10, 10, 6, 3, 6]
+            ])
+        self.assertEqual(link_slices([np.zeros((0, 4))]*3), [])
+
+    def test_frame(self):
+        rng = np.random.RandomState(11)
+        #spheres on a jittered cubic lattice
+        g = np.mgrid[0:3, 0:3, 0:3].reshape(3, -1).T
+        pos = 16 + 22*g + rng.uniform(-2, 2, g.shape)
+        radii = rng.uniform(5, 7, len(pos))
+        stack = draw_spheres((76, 76, 76), pos, radii, sigma=1, noise=0.05, seed=0)
+        particles = localize2D3D_frame(stack)
+        self.assertEqual(len(particles), len(pos))
+        d, j = KDTree(particles[:, :3]).query(pos)
+        self.assertEqual(len(np.unique(j)), len(pos))
+        self.assertTrue(d.max() < 0.5)
+        npt.assert_allclose(particles[j, 3], radii, atol=0.5)
+        #z is scaled by ZXratio
+        scaled = localize2D3D_frame(stack, ZXratio=2.0)
+        npt.assert_allclose(scaled, particles * [1, 1, 2, 1, 1])
+        self.assertEqual(localize2D3D_frame(np.zeros((10, 32, 32), np.float32)).shape, (0, 5))
+
+
+def load_clusters_ref(trajfile):
+    """Per cluster parse, as load_clusters used to do. Returns a list of arrays."""
+    clusters = []
+    path = os.path.split(trajfile)[0]
+    with open(trajfile) as f:
+        ZXratio = float(next(f)[:-1].split("\t")[1])
+        pattern, ext = os.path.splitext(next(f)[:-1].split("\t")[0])
+        token, = next(f)[:-1].split("\t")
+        offset,size = list(map(int, next(f)[:-1].split("\t")))
+        m = re.match('(.*)'+token+'([0-9]*)',pattern)
+        recomposed = os.path.join(path, m.group(1)+token+'%0'+str(len(m.group(2)))+'d%s')
+        slices = [np.hstack((
+            np.loadtxt(recomposed%(z,ext), skiprows=2, ndmin=2),
+            -np.loadtxt(recomposed%(z,'.intensity'), ndmin=1)[:, np.newaxis]
+            ))
+            for z in range(size)]
+        for line in f:
+            z0 = int(line[:-1])
+            pos = list(map(int, next(f)[:-1].split('\t')))
+            clusters.append(np.asarray([
+                [s[p,0], s[p,1], z*ZXratio, s[p,-2], s[p,-1]]
+                for z, s, p in zip(range(z0, z0+len(pos)), slices[z0:], pos)
+                ]))
+    return clusters
+
+
+class TestLoadClusters(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(12)
+        #2D centers of each slice, in the format of save_2Dcenters
+        nbs = [5, 3, 6, 4]
+        for z, nb in enumerate(nbs):
+            centers = np.column_stack((100*rng.rand(nb, 2), 1 + 3*rng.rand(nb)))
+            np.savetxt(
+                os.path.join(self.dir, 'slice_z%02d.dat' % z),
+                np.vstack(([1, nb, 1], [256, 256, 1], centers)), fmt='%g')
+            np.savetxt(os.path.join(self.dir, 'slice_z%02d.intensity' % z), -rng.rand(nb), fmt='%g')
+        #clusters as output by linker: starting slice, then the position in each slice
+        clusters = [(0, [0, 2, 1, 3]), (0, [4]), (1, [0, 5]), (2, [1]), (0, [1, 1, 2]), (3, [0])]
+        self.trajfile = os.path.join(self.dir, 'slice.traj')
+        with open(self.trajfile, 'w') as f:
+            f.write('%s\t1.5\nslice_z00.dat\n_z\n0\t%d\n' % (self.dir, len(nbs)))
+            for z0, pos in clusters:
+                f.write('%d\n%s\n' % (z0, '\t'.join(map(str, pos))))
+        self.lengths = [len(pos) for z0, pos in clusters]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_load(self):
+        offsets, rows = load_clusters(self.trajfile)
+        npt.assert_array_equal(offsets, np.cumsum([0] + self.lengths))
+        self.assertEqual(rows.shape, (sum(self.lengths), 5))
+        #same clusters as the former parse
+        ref = load_clusters_ref(self.trajfile)
+        self.assertEqual(len(ref), len(self.lengths))
+        for cl, r in zip(np.split(rows, offsets[1:-1]), ref):
+            npt.assert_array_equal(cl, r)
+        #z is scaled by ZXratio and the (negative) DoG values of the files become positive intensities
+        npt.assert_array_equal(rows[:4, 2], [0, 1.5, 3, 4.5])
+        self.assertTrue((rows[:, -1] > 0).all())
+        npt.assert_array_equal(
+            clusters2particles((offsets, rows)), clusters2particles(ref))
+
+
+def draw_spheres_ref(shape, pos, radii):
+    """Binary image of spheres, as draw_spheres used to do"""
+    im = np.zeros(shape, bool)
+    radii = radii * np.ones(len(pos))
+    for p, rsq, m, M in zip(
+        pos, radii**2,
+        np.maximum(0, pos[:,::-1] - radii[:,None]).astype(int),
+        np.minimum(im.shape, pos[:,::-1] + radii[:,None] + 1).astype(int)
+    ):
+        im[m[0]:M[0], m[1]:M[1], m[2]:M[2]] |= (
+            (p[2] - np.arange(m[0], M[0]))[:,None,None]**2 +
+            (p[1] - np.arange(m[1], M[1]))[None,:,None]**2 +
+            (p[0] - np.arange(m[2], M[2]))[None,None,:]**2 <= rsq
+            )
+    return im
+
+
+class TestDrawSpheres(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(19)
+        self.shape = (40, 50, 60)
+        self.pos = rng.rand(80, 3) * self.shape[::-1]
+        self.radii = rng.uniform(1, 6, 80)
+
+    def test_binary(self):
+        for radii in [self.radii, 3.5]:
+            im = draw_spheres(self.shape, self.pos, radii)
+            self.assertEqual(im.dtype, bool)
+            npt.assert_array_equal(im, draw_spheres_ref(self.shape, self.pos, radii))
+        #2D images from (x, y) positions
+        npt.assert_array_equal(
+            draw_spheres(self.shape[1:], self.pos[:, :2], self.radii),
+            draw_spheres_ref((1,) + self.shape[1:], self.pos * [1, 1, 0], self.radii)[0]
+            )
+
+    def test_seed(self):
+        a = draw_spheres(self.shape, self.pos, self.radii, sigma=1, noise=0.1, seed=3)
+        self.assertEqual(a.dtype, np.float32)
+        npt.assert_array_equal(draw_spheres(self.shape, self.pos, self.radii, sigma=1, noise=0.1, seed=3), a)
+        b = draw_spheres(self.shape, self.pos, self.radii, sigma=1, noise=0.1, seed=4)
+        self.assertFalse(np.array_equal(a, b))
+        #only the noise depends on the seed
+        clean = draw_spheres(self.shape, self.pos, self.radii, sigma=1)
+        self.assertAlmostEqual(np.std(a - clean), 0.1, 2)
+        self.assertAlmostEqual(np.std(b - clean), 0.1, 2)
+        #nor on the number of threads
+        if numba.config.NUMBA_NUM_THREADS > 1:
+            numba.set_num_threads(1)
+            try:
+                npt.assert_array_equal(draw_spheres(self.shape, self.pos, self.radii, sigma=1), clean)
+            finally:
+                numba.set_num_threads(numba.config.NUMBA_NUM_THREADS)
+
+
+def disks(shape, nb, rmin, rmax, seed):
+    """Blurred noisy image of random bright disks (balls in 3D)"""
+    rng = np.random.RandomState(seed)
+    im = np.zeros(shape, np.float32)
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    for c, r in zip(rng.uniform(0, 1, (nb, len(shape))) * shape, rng.uniform(rmin, rmax, nb)):
+        im[sum((x - u)**2 for x, u in zip(grid, c)) < r*r] = 1
+    return gaussian_filter(im, 1) + 0.05*rng.rand(*shape).astype(np.float32)
+
+
+def assert_same_blobs(test, a, b, atol):
+    """Same number of blobs and each blob of a is within atol of a blob of b"""
+    test.assertEqual(len(a), len(b))
+    d, j = KDTree(b[:, :-2]).query(a[:, :-2])
+    test.assertEqual(len(np.unique(j)), len(b))
+    npt.assert_allclose(a, b[j], atol=atol)
+
+
+class TestStackBlobFinder(unittest.TestCase):
+    def setUp(self):
+        self.stack = np.array([disks((80, 96), 25, 2, 8, t) for t in range(5)])
+
+    def check(self, stack, Octave0, **kwargs):
+        finder = MultiscaleBlobFinder(stack.shape[1:], Octave0=Octave0)
+        ref = [finder(im, **kwargs) for im in stack]
+        self.assertTrue(sum(map(len, ref)) > 0)
+        centers = StackBlobFinder(stack.shape, Octave0=Octave0)(stack, **kwargs)
+        self.assertEqual(len(centers), len(stack))
+        for c, r in zip(centers, ref):
+            npt.assert_array_equal(c, r)
+
+    def test_2D(self):
+        for Octave0 in [True, False]:
+            self.check(self.stack, Octave0)
+            self.check(self.stack, Octave0, maxedge=10)
+
+    def test_3D(self):
+        self.check(np.array([disks((24, 28, 32), 20, 1.5, 4, t) for t in range(3)]), True)
+
+    def test_octave(self):
+        finder = OctaveBlobFinder(self.stack.shape[1:])
+        ref = [finder(im) for im in self.stack]
+        #the image index is a coordinate, in reverse order of the axes
+        centers = StackOctaveBlobFinder(self.stack.shape)(self.stack)
+        npt.assert_array_equal(
+            centers[np.argsort(centers[:, 2], kind='stable')],
+            np.vstack([np.insert(r, 2, t, axis=1) for t, r in enumerate(ref)])
+            )
+
+
+class TestTiledBlobFinder(unittest.TestCase):
+    def test_whole(self):
+        im = disks((200, 230), 80, 2, 9, 0)
+        whole = MultiscaleBlobFinder(im.shape)(im)
+        finder = TiledBlobFinder((48, 48))
+        self.assertEqual(finder.halo, 32)
+        assert_same_blobs(self, finder(im), whole, 1e-2)
+        self.assertEqual(finder.ntiles, 5*5)
+        #wider halo, better agreement
+        finder = TiledBlobFinder((48, 48), halo=TiledBlobFinder.default_halo(truncate=4))
+        assert_same_blobs(self, finder(im), whole, 1e-3)
+
+    def test_odd(self):
+        #tiles are aligned on the grid of the last octave whatever the shapes of the image and of the core
+        im = disks((201, 233), 90, 2, 9, 1)
+        whole = MultiscaleBlobFinder(im.shape)(im)
+        finder = TiledBlobFinder((47, 51))
+        npt.assert_equal(finder.core, [48, 52])
+        assert_same_blobs(self, finder(im), whole, 1e-2)
+        for tile, core in finder.tiles(im.shape):
+            self.assertTrue(all(t.start % finder.step == 0 for t in tile))
+
+
+class TestSmoothing(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(6)
+
+    def test_filter(self):
+        for shape in [(64, 80), (24, 32, 40)]:
+            im = self.rng.rand(*shape)
+            for sigma in [0.3, 1, 2.5, 5, [1, 2.5, 4][:im.ndim]]:
+                npt.assert_allclose(
+                    recursive_gaussian_filter(im, sigma), gaussian_filter(im, sigma),
+                    atol=1e-3)
+            #in place
+            out = im.copy()
+            recursive_gaussian_filter(out, 2, output=out)
+            npt.assert_array_equal(out, recursive_gaussian_filter(im, 2))
+
+    def test_smoothing_error(self):
+        for im in [
+                disks((128, 128), 30, 2, 8, 0),
+                gaussian_filter(self.rng.rand(32, 32, 32), 1.5).astype(np.float32)
+                ]:
+            finder = OctaveBlobFinder(im.shape)
+            finder(im)
+            self.assertTrue(np.all(finder.smoothing_error() < 1e-4))
+            finder = OctaveBlobFinder(im.shape, smoothing='recursive')
+            finder(im)
+            self.assertTrue(np.all(finder.smoothing_error() < 5e-3))
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, OctaveBlobFinder, (16, 16), smoothing='fast')
+
+
+class TestMultiscaleBlobFinder(unittest.TestCase):
+    def upsampled(self, image, k, smoothing):
+        """Octave -1 as previously built, by repeating the image along each axis"""
+        im2 = np.copy(image)
+        for a in range(image.ndim):
+            im2 = np.repeat(im2, 2, a)
+        out = np.empty(im2.shape, np.float32)
+        get_smoothing(smoothing)(im2, k, output=out)
+        return out
+
+    def test_fused(self):
+        for im in [
+                disks((128, 140), 40, 2, 8, 0),
+                disks((40, 44, 48), 60, 1.5, 4, 8)
+                ]:
+            for kw in [{}, dict(maxDoG=-1e-3)]:
+                centers = MultiscaleBlobFinder(im.shape)(im, **kw)
+                self.assertTrue(len(centers) > 10)
+                npt.assert_array_equal(MultiscaleBlobFinder(im.shape, fused=True)(im, **kw), centers)
+
+    def test_preblur(self):
+        im2D = disks((60, 70), 15, 2, 6, 3)
+        im3D = gaussian_filter(np.random.RandomState(7).rand(20, 24, 28), 1.5)
+        for image in [im2D, (255 * im2D / im2D.max()).astype(np.uint8), im3D.astype(np.float32)]:
+            for smoothing in ['exact', 'recursive']:
+                finder = MultiscaleBlobFinder(image.shape, nbOctaves=2, smoothing=smoothing)
+                finder(image)
+                npt.assert_array_equal(finder.preblurred, self.upsampled(image, 1.6, smoothing))
+
+
+class TestRemoveOverlap(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(2)
+
+    def check(self, centers):
+        kept = remove_overlap(centers, method='kdtree')
+        npt.assert_array_equal(kept, remove_overlap(centers, method='brute'))
+        self.assertTrue(0 < len(kept) < len(centers))
+        #no overlap remains
+        d = np.sqrt(np.sum((kept[:, None, :-2] - kept[None, :, :-2])**2, -1))
+        rsum = kept[:, None, -2] + kept[None, :, -2]
+        self.assertFalse(np.any(np.triu(d < rsum, 1)))
+
+    def test_2D(self):
+        centers = np.column_stack((
+            100 * self.rng.rand(2000, 2),
+            1 + 2 * self.rng.rand(2000),
+            -self.rng.rand(2000)
+            ))
+        self.check(centers)
+
+    def test_3D(self):
+        centers = np.column_stack((
+            30 * self.rng.rand(2000, 3),
+            1 + 2 * self.rng.rand(2000),
+            -self.rng.rand(2000)
+            ))
+        self.check(centers)
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, remove_overlap, np.zeros((2, 4)), 'fast')
+
+
+def write_lif(path, frames):
+    """Write a minimal LIF file containing a single XYT serie of 8 bits frames"""
+    nt, ny, nx = frames.shape
+    xml = (
+        '<LMSDataContainerHeader Version="2"><Element Name="test"><Children>'
+        '<Element Name="serie"><Data><Image><ImageDescription>'
+        '<Channels><ChannelDescription Resolution="8" ChannelTag="0"/></Channels>'
+        '<Dimensions>'
+        '<DimensionDescription DimID="1" NumberOfElements="%d" BytesInc="1"/>'
+        '<DimensionDescription DimID="2" NumberOfElements="%d" BytesInc="%d"/>'
+        '<DimensionDescription DimID="4" NumberOfElements="%d" BytesInc="%d"/>'
+        '</Dimensions></ImageDescription></Image></Data>'
+        '<Memory Size="%d" MemoryBlockID="MemBlock_0"/>'
+        '</Element></Children></Element></LMSDataContainerHeader>'
+        ) % (nx, ny, nx, nt, nx*ny, frames.nbytes)
+    descr = 'MemBlock_0'
+    with open(path, 'wb') as f:
+        f.write(struct.pack('iic', 112, 0, b'*') + struct.pack('I', len(xml)))
+        f.write(xml.encode('utf-16-le'))
+        f.write(struct.pack('iic', 112, 0, b'*') + struct.pack('Q', frames.nbytes))
+        f.write(b'*' + struct.pack('I', len(descr)) + descr.encode('utf-16-le'))
+        f.write(frames.astype(np.uint8).tobytes())
+
+
+class TestLocalizeSerie(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'serie.lif')
+        self.frames = np.array([
+            255 * disks((64, 80), 15, 2, 6, t) / 1.1 for t in range(5)
+            ]).astype(np.uint8)
+        write_lif(self.path, self.frames)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check(self, processes):
+        serie = lif.Reader(self.path).getSeries()[0]
+        npt.assert_array_equal(serie.getFrame(T=3), self.frames[3])
+        finder = MultiscaleBlobFinder(self.frames.shape[1:], nbOctaves=2)
+        results = list(localize_serie(
+            serie, processes=processes, finder_kwargs=dict(nbOctaves=2), maxedge=-1
+            ))
+        self.assertEqual([t for t, centers in results], list(range(len(self.frames))))
+        for frame, (t, centers) in zip(self.frames, results):
+            self.assertTrue(len(centers) > 0)
+            npt.assert_array_equal(centers, finder(frame, maxedge=-1))
+        serie.f.close()
+
+    def test_serial(self):
+        self.check(1)
+
+    def test_pool(self):
+        self.check(2)
+
+    def test_path(self):
+        #a file that was moved cannot be reopened by the workers from its name
+        serie = lif.Reader(self.path).getSeries()[0]
+        moved = os.path.join(self.dir, 'moved.lif')
+        shutil.move(self.path, moved)
+        self.assertRaises(ValueError, next, localize_serie(serie, processes=2))
+        self.assertEqual(len(list(localize_serie(serie, processes=1))), len(self.frames))
+        #unless its path is given
+        self.assertEqual(len(list(localize_serie(serie, processes=2, path=moved))), len(self.frames))
+        serie.f.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+#
+#    Copyright 2009 Mathieu Leocmach
+#
+#    This file is part of Colloids.
+#
+#    Colloids is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Colloids is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Colloids.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Memory-mapped reader of uncompressed (multi-page) TIFF files.
+
+Pages are returned as numpy views on a memory map of the file, with the byte order of the file, so that long movies can be streamed without decoding nor copying.
+"""
+import numpy as np
+
+#TIFF field types: (numpy type code, size in bytes)
+fieldTypes = {
+    1: ('u1', 1), 2: ('S1', 1), 3: ('u2', 2), 4: ('u4', 4), 5: ('u4', 8),
+    6: ('i1', 1), 7: ('u1', 1), 8: ('i2', 2), 9: ('i4', 4), 10: ('i4', 8),
+    11: ('f4', 4), 12: ('f8', 8), 16: ('u8', 8), 17: ('i8', 8), 18: ('u8', 8),
+    }
+#sample format tag value -> numpy kind
+sampleKinds = {1: 'u', 2: 'i', 3: 'f'}
+
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIGURATION = 284
+TILE_OFFSETS = 324
+SAMPLE_FORMAT = 339
+
+
+class Page:
+    """One image file directory of a TIFF file"""
+
+    def __init__(self, reader, tags):
+        self.reader = reader
+        self.tags = tags
+        if tags.get(COMPRESSION, [1])[0] != 1:
+            raise ValueError('Compressed TIFF (compression=%d) not supported' % tags[COMPRESSION][0])
+        if TILE_OFFSETS in tags:
+            raise ValueError('Tiled TIFF not supported')
+        if tags.get(PLANAR_CONFIGURATION, [1])[0] != 1:
+            raise ValueError('Planar TIFF not supported')
+        bits = tags.get(BITS_PER_SAMPLE, [1])
+        if len(set(bits)) > 1 or bits[0] % 8:
+            raise ValueError('%s bits per sample not supported' % list(bits))
+        kind = sampleKinds[tags.get(SAMPLE_FORMAT, [1])[0]]
+        self.dtype = np.dtype(reader.byteorder + kind + str(bits[0] // 8))
+        self.samples = int(tags.get(SAMPLES_PER_PIXEL, [1])[0])
+        self.shape = (int(tags[IMAGE_LENGTH][0]), int(tags[IMAGE_WIDTH][0]))
+        if self.samples > 1:
+            self.shape += (self.samples,)
+        self.offsets = np.asarray(tags[STRIP_OFFSETS], np.int64)
+        self.counts = np.asarray(tags[STRIP_BYTE_COUNTS], np.int64)
+
+    def is_contiguous(self):
+        """Are the strips one after the other in the file"""
+        return np.all(self.offsets[1:] == self.offsets[:-1] + self.counts[:-1])
+
+    def asarray(self):
+        """The image as a read-only view on the memory map when the strips are contiguous, a copy otherwise"""
+        nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        if self.is_contiguous():
+            data = self.reader.map[self.offsets[0]:self.offsets[0] + nbytes]
+        else:
+            data = np.concatenate([
+                self.reader.map[o:o+c] for o, c in zip(self.offsets, self.counts)
+                ])[:nbytes]
+        return data.view(self.dtype).reshape(self.shape)
+
+
+class Reader:
+    """Lazy access to the pages of an uncompressed TIFF or BigTIFF file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.map = np.memmap(path, np.uint8, mode='r')
+        order = self.map[:2].tobytes()
+        if order == b'II':
+            self.byteorder = '<'
+        elif order == b'MM':
+            self.byteorder = '>'
+        else:
+            raise ValueError('%s is not a TIFF file' % path)
+        magic = self.read('u2', 2)
+        if magic == 42:
+            self.offsetType, self.countType, self.entrySize = 'u4', 'u2', 12
+            self.first = self.read('u4', 4)
+        elif magic == 43:
+            self.offsetType, self.countType, self.entrySize = 'u8', 'u8', 20
+            self.first = self.read('u8', 8)
+        else:
+            raise ValueError('%s is not a TIFF file' % path)
+        self._ifds = [self.first]
+
+    def read(self, code, offset, count=1):
+        """Read count values of the given type at offset"""
+        dtype = np.dtype(self.byteorder + code)
+        a = self.map[offset:offset + count * dtype.itemsize].view(dtype)
+        if count == 1:
+            return int(a[0]) if dtype.kind in 'ui' else a[0]
+        return a
+
+    def read_ifd(self, offset):
+        """Tags of the image file directory at offset and offset of the next one"""
+        ctype = np.dtype(self.countType).itemsize
+        otype = np.dtype(self.offsetType).itemsize
+        nb = self.read(self.countType, offset)
+        tags = {}
+        start = offset + ctype
+        for e in range(start, start + nb * self.entrySize, self.entrySize):
+            tag = self.read('u2', e)
+            ftype = self.read('u2', e + 2)
+            if ftype not in fieldTypes:
+                continue
+            count = self.read(self.offsetType, e + 4)
+            code, size = fieldTypes[ftype]
+            if size * count <= otype:
+                pos = e + 4 + otype
+            else:
+                pos = self.read(self.offsetType, e + 4 + otype)
+            if ftype in (5, 10):
+                #rationals
+                count *= 2
+            tags[tag] = np.atleast_1d(self.read(code, pos, count))
+        return tags, self.read(self.offsetType, start + nb * self.entrySize)
+
+    def _ifd_offset(self, index):
+        """Walk the chain of image file directories up to index"""
+        while len(self._ifds) <= index and self._ifds[-1] != 0:
+            self._ifds.append(self.read_ifd(self._ifds[-1])[1])
+        if index >= len(self._ifds) or self._ifds[index] == 0:
+            raise IndexError('page %d out of range' % index)
+        return self._ifds[index]
+
+    def get_page(self, index=0):
+        """Page object of a given index"""
+        return Page(self, self.read_ifd(self._ifd_offset(index))[0])
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        return self.get_page(index).asarray()
+
+    def __len__(self):
+        while self._ifds[-1] != 0:
+            self._ifds.append(self.read_ifd(self._ifds[-1])[1])
+        return len(self._ifds) - 1
+
+    def __iter__(self):
+        """Lazily yield the pages one after the other"""
+        offset = self.first
+        while offset != 0:
+            tags, offset = self.read_ifd(offset)
+            yield Page(self, tags).asarray()
@@ -17,18 +17,21 @@
 #
  #for python 2.5, useless in 2.6
 import numpy as np
-import os.path, subprocess, shlex, string, re, time, sys
-from colloids import lif, vtk
-from scipy.ndimage.filters import gaussian_filter, gaussian_filter1d, sobel, uniform_filter
-from scipy.ndimage.morphology import grey_erosion, grey_dilation, binary_dilation
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os.path, subprocess, shlex, string, re, time, sys, itertools
+import tracemalloc
+from contextlib import nullcontext
+from colloids import lif, vtk, kernels, tiff
+from scipy.ndimage.filters import gaussian_filter, gaussian_filter1d, sobel, uniform_filter, correlate1d
+from scipy.ndimage.morphology import grey_erosion, grey_dilation, binary_dilation, generate_binary_structure
 from scipy.ndimage import measurements
-from scipy.sparse.linalg import splu, spsolve
+from scipy.sparse.linalg import splu, spsolve, cg, bicgstab
 from scipy import sparse
-if (sys.version_info <= (3, 0)):
-    from scipy import weave
-    from scipy.weave import converters
+from scipy import fft
+from scipy.spatial import cKDTree as KDTree
 import numexpr
-import PIL.Image
 import unittest
 import time
 
@@ -36,17 +39,13 @@ coefprime = np.array([1,-8, 0, 8, -1])
 coefsec = np.array([-1, 16, -30, 16, -1])
 
 
-def readTIFF16(path, bigendian=True):
-    """Read 16bits TIFF"""
-    im = PIL.Image.open(path)
-    out = np.fromstring(
-        im.tostring(), 
-        np.uint8
-        ).reshape(tuple(list(im.size)+[2]))
-    if bigendian:
-        return (np.array(out[:,:,0], np.uint16) << 8) + out[:,:,1]
-    else:
-        return (np.array(out[:,:,1], np.uint16) << 8) + out[:,:,0]
+def readTIFF16(path, bigendian=None):
+    """Read the first page of a 16bits TIFF as a memory-mapped view.
+    The byte order is read from the file header unless bigendian is given."""
+    im = tiff.Reader(path)[0]
+    if bigendian is not None:
+        im = im.view(im.dtype.newbyteorder('>' if bigendian else '<'))
+    return im
 
 
 def bestParams(inputPath, outputPath, radMins=np.arange(2.5, 5, 0.5), radMaxs=np.arange(6, 32, 4), t=0, serie=None):
@@ -184,6 +183,45 @@ The crosses in the blue channel have the size of the detected blob."""
         ))
 
 
+def recursive_gaussian_filter(input, sigma, output=None, truncate=4.0):
+    """Approximation of scipy.ndimage.gaussian_filter by the fourth order recursive filter of Deriche, of constant cost per pixel whatever sigma.
+
+    Borders are treated as in mode='reflect' up to truncate*sigma from the edges. input and output can be the same array. For sigma<0.5, the exact filter is used."""
+    if output is None:
+        output = np.empty(np.shape(input), np.result_type(input, np.float32))
+    if np.isscalar(sigma):
+        sigma = [sigma] * output.ndim
+    if np.min(sigma) < 0.5:
+        return gaussian_filter(input, sigma, output=output, truncate=truncate)
+    output[:] = input
+    for a, s in enumerate(sigma):
+        lines = np.ascontiguousarray(np.moveaxis(output, a, -1))
+        kernels.recursive_gaussian_lines(
+            lines.reshape(-1, lines.shape[-1]),
+            *kernels.deriche_coefficients(float(s)),
+            pad=int(truncate * s + 0.5)
+            )
+        np.moveaxis(output, a, -1)[:] = lines
+    return output
+
+
+#available implementations of the Gaussian filter, with the signature of scipy.ndimage.gaussian_filter(input, sigma, output)
+smoothing_backends = {
+    'exact': gaussian_filter,
+    'recursive': recursive_gaussian_filter,
+    }
+
+
+def get_smoothing(smoothing):
+    """Get a Gaussian filter function from its name in smoothing_backends, or check that it is callable"""
+    if callable(smoothing):
+        return smoothing
+    try:
+        return smoothing_backends[smoothing]
+    except KeyError:
+        raise ValueError("Unknown smoothing backend %s" % smoothing)
+
+
 class LocalDispl:
     def __init__(self, space):
         self.space = space
@@ -309,130 +347,156 @@ def save_2Dcenters(file_pattern, frame):
     
 
 def load_clusters(trajfile):
-    """Load the piles of 2D centers as formed by linker"""
-    clusters = []
+    """Load the piles of 2D centers as formed by linker.
+
+    All slices are read into a single array and the cluster description is parsed at once. Returns a CSR-like structure (offsets, rows): rows is an array of (x, y, z*ZXratio, r, intensity) where cluster i spans rows[offsets[i]:offsets[i+1]].
+    This used to return a list of arrays, one per cluster, which np.split(rows, offsets[1:-1]) recovers. clusters2particles accepts both."""
     path = os.path.split(trajfile)[0]
     with open(trajfile) as f:
         #parsing header
-        ZXratio = float(f.next()[:-1].split("\t")[1])
-        pattern, ext = os.path.splitext(f.next()[:-1].split("\t")[0])
-        token, = f.next()[:-1].split("\t")
-        offset,size = list(map(int, f.next()[:-1].split("\t")))
+        ZXratio = float(f.readline()[:-1].split("\t")[1])
+        pattern, ext = os.path.splitext(f.readline()[:-1].split("\t")[0])
+        token, = f.readline()[:-1].split("\t")
+        offset,size = list(map(int, f.readline()[:-1].split("\t")))
         m = re.match('(.*)'+token+'([0-9]*)',pattern)
         head = m.group(1)
         digits = len(m.group(2))
         recomposed = os.path.join(path, head+token+'%0'+str(digits)+'d%s')
-        #load coordinates in the (x, y, r) space for each z
-        slices = [np.hstack((
-            np.loadtxt(recomposed%(z,ext), skiprows=2),
-            -np.loadtxt(recomposed%(z,'.intensity'))[:, np.newaxis]
-            ))
-            for z in range(size)]
-        #parse cluster description
-        for line in f:
-            z0 = int(line[:-1])
-            pos = list(map(int, string.split(f.next()[:-1],'\t')))
-            clusters.append(np.asarray([
-                [s[p,0], s[p,1], z*ZXratio,
-                 s[p,-2],
-                 s[p,-1]] for z, s, p in zip(
-                    list(range(z0, z0+len(pos))),
-                    slices[z0:],
-                    pos)
-                ]))
-    return clusters
+        #cluster description: alternating lines of starting slice and positions
+        lines = f.read().splitlines()
+    #load coordinates in the (x, y, r) space for all z, skipping the 2 header lines of each slice
+    slices = []
+    for z in range(size):
+        with open(recomposed%(z,ext)) as sf:
+            xyr = np.array(sf.read().split(), float).reshape(-1, 3)[2:]
+        with open(recomposed%(z,'.intensity')) as sf:
+            slices.append(np.column_stack((xyr, -np.array(sf.read().split(), float))))
+    slice_offsets = np.cumsum([0] + [len(sl) for sl in slices])
+    slices = np.vstack(slices) if len(slices) else np.zeros([0, 4])
+    #parse cluster description
+    z0 = np.array(lines[0::2], np.int64)
+    lengths = np.array([line.count('\t')+1 for line in lines[1::2]], np.int64)
+    pos = np.array('\t'.join(lines[1::2]).split(), np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    #slice of each position
+    z = np.repeat(z0 - offsets[:-1], lengths) + np.arange(offsets[-1])
+    s = slices[slice_offsets[z] + pos]
+    rows = np.column_stack((s[:,0], s[:,1], z*ZXratio, s[:,-2], s[:,-1]))
+    return offsets, rows
+
+
+def cluster_maxima(cls):
+    """Position along z and radius of the maximum of the radius profile of each cluster.
+
+    cls is a (nb clusters, length, 5) array of (x, y, z, r, intensity). The position is the center of mass of the radius profile around its maximum (or of the whole profile if the maximum is on the edge). Returns an array of (z, r, 0)"""
+    w = cls[..., -2]
+    length = w.shape[1]
+    m = np.argmax(w, axis=1)
+    inner = (m > 0) & (m+1 < length)
+    w3 = np.take_along_axis(w, np.clip(m-1, 0, length-3)[:, None] + np.arange(3), axis=1)
+    z = np.where(
+        inner,
+        (w3 * np.arange(3)).sum(1) / w3.sum(1) + m - 1,
+        (w * np.arange(length)).sum(1) / w.sum(1)
+        )
+    return np.column_stack((z, w[:, length//2], np.zeros(len(w))))
 
 
 def clusters2particles(clusters, k=1.6, n=3, noDuplicate=True, outputFinders=False):
+    """Reconstruct 3D particles from clusters of 2D centers (x, y, z, r, intensity) piled along z.
+
+    Clusters of equal length are processed together. Clusters are split where their xy position changes abruptly along z, the subclusters being processed in the next round. 1D blobs are then found in the radius and intensity profiles of all remaining clusters at once (see BatchBlobFinder) and the particle coordinates are interpolated at each blob.
+    Clusters shorter than 3 are discarded. Clusters shorter than 5, or without blob, yield a single particle at the maximum of their radius profile.
+    clusters is either a list of arrays or a CSR-like structure (offsets, rows) as returned by load_clusters.
+    If outputFinders is True, also returns the finders used for the last clusters of each length."""
     particles = []
-    #allocate the memory for each possible size of MultiscaleBlobFinder
-    N = max(list(map(len, clusters)))
-    finders = [MultiscaleBlobFinder([l], n, 3) for l in range(5, N+1)]
-    for cl in clusters:
-        #a cluster that appears in less than 3 slices is not a real particle
-        if len(cl)<3:
-            continue
-        #No blob can be extracted out of too short signal
-        #we just take the middle of the cluster
-        if len(cl)<5:
-            m = np.argmax(cl[:,-2])
-            if m>0 and m+1<len(cl):
-                blobs = [np.asarray([[
-                    measurements.center_of_mass(cl[m-1:m+2,-2])[0]+m-1,
-                    cl[0.5*len(cl),-2], 0.0
-                    ]])]
-            else:
-                blobs = [np.asarray([[
-                    measurements.center_of_mass(cl[:,-2])[0],
-                    cl[0.5*len(cl),-2], 0.0
-                    ]])]
-        else:
-            #xy gradient along z
-            gradxy = np.sqrt(sobel(cl[:,0], axis=0)**2 + sobel(cl[:,1], axis=0)**2)
-            #try to split the cluster at the location of strong xy(z) gradient
-            gradblobs = finders[len(cl)-5](gradxy, k)
-            #keep only strong position change
-            if len(gradblobs):
-                gradblobs = gradblobs[gradblobs[:,-1]<-0.05]
-            if len(gradblobs):
-                #split into subclusters
-                clusters += np.array_split(cl, np.sort(
-                    np.rint(gradblobs[:,0]).astype(int)
-                    ))
-                #stop the treatment of the actual cluster.
-                #subclusters will be treated further in the loop
+    finders = {}
+    if isinstance(clusters, tuple):
+        offsets, rows = clusters
+        clusters = np.split(rows, offsets[1:-1])
+    pending = [np.asarray(cl) for cl in clusters]
+    while len(pending):
+        lengths = np.array(list(map(len, pending)))
+        #subclusters produced by each cluster of this round
+        subclusters = [[] for cl in pending]
+        keys = []
+        parts = []
+        for L in np.unique(lengths):
+            #a cluster that appears in less than 3 slices is not a real particle
+            if L < 3:
                 continue
-            #get the blobs for each signal, remove signals without blob
-            blobs = list(filter(len, [
-                finders[len(cl)-5](u, k) for u in [cl[:,3], cl[:,4]]
-                ]))
-            if len(blobs)==0:
+            idx = np.where(lengths == L)[0]
+            cls = np.array([pending[i] for i in idx])
+            if L < 5:
+                #No blob can be extracted out of too short signal
+                #we just take the middle of the cluster
+                blobs = cluster_maxima(cls)
+                owner = np.arange(len(cls))
+            else:
+                #xy gradient along z (1D Sobel filter, not smoothed across clusters)
+                gradxy = np.sqrt(
+                    correlate1d(cls[...,0], [-1, 0, 1], axis=1)**2
+                    + correlate1d(cls[...,1], [-1, 0, 1], axis=1)**2
+                    )
+                #try to split the clusters at the location of strong xy(z) gradient
+                gradblobs = BatchBlobFinder(gradxy.shape, n, 3)(gradxy, k)
+                #keep only strong position change
+                gradblobs = gradblobs[gradblobs[:,-1] < -0.05]
+                gradblobs = gradblobs[np.argsort(gradblobs[:,0], kind='stable')]
+                split, starts = np.unique(gradblobs[:,0].astype(int), return_index=True)
+                #split into subclusters, that will be treated in the next round
+                for c, cuts in zip(split, np.split(gradblobs[:,1], starts[1:])):
+                    subclusters[idx[c]] = np.array_split(cls[c], np.sort(np.rint(cuts).astype(int)))
+                keep = np.setdiff1d(np.arange(len(cls)), split)
+                idx = idx[keep]
+                cls = cls[keep]
+                if len(cls) == 0:
+                    continue
+                #get the blobs for the radius and intensity signals of all clusters
+                signals = np.vstack((cls[...,3], cls[...,4]))
+                finders[int(L)] = BatchBlobFinder(signals.shape, n, 3)
+                sblobs = finders[int(L)](signals, k)
+                #sort by cluster, then signal, then intensity (negative)
+                owner = sblobs[:,0].astype(int) % len(cls)
+                order = np.lexsort((sblobs[:,-1], sblobs[:,0] >= len(cls), owner))
+                owner = owner[order]
+                blobs = sblobs[order, 1:]
                 #no blob in any signal, we just take the position of the maximum radius
-                m = np.argmax(cl[:,-2])
-                if m>0 and m+1<len(cl):
-                    blobs = [np.asarray([[
-                        measurements.center_of_mass(cl[m-1:m+2,-2])[0]+m-1,
-                        cl[0.5*len(cl),-2], 0.0
-                        ]])]
-                else:
-                    blobs = [np.asarray([[
-                        measurements.center_of_mass(cl[:,-2])[0],
-                        cl[0.5*len(cl),-2], 0.0
-                        ]])]
-        #sort the blob of each signal by intensity (negative)
-        blobs = np.vstack([bs[np.argsort(bs[:,-1])] for bs in blobs])
-        #Remove overlapping centers than may appear at different scales
-        #in the different signals.
-        #The most intense blob in apparent radius is the best,
-        #then, the second intense in apparent radius, etc.
-        #then, the blobs in intensity
-        if noDuplicate:
-            #The blobs in a stack of 2D centers are few (<30),
-            #a simple O(N**2) algorithm is enough
-            out = []
-            for i in blobs:
-                for j in out:
-                    if (i[0]-j[0])**2 < (i[1]+j[1])**2:
-                        break
-                else:
-                    out.append(i)
-            blobs = np.vstack(out)
-        #Interpolate the x,y,r,intensity values at the position of each blob
-        grad = gaussian_filter1d(cl, k/2, axis=0, order=1)
-        for z, s, v in blobs:
-            #smoothed = (gaussian_filter1d(cl, 1.6*2**(s/3-1), axis=0)-cl.mean(0))*np.sqrt(2)+cl.mean(0)
-            #grad = gaussian_filter1d(cl, 1.6*2**(s/3-1), axis=0, order=1)
-            zi = np.rint(z)
-            if zi==len(cl):
-                zi = len(cl)-1
-            if zi<0:
-                zi = 0
-            dz = z-zi
-            particles.append(cl[zi]+grad[zi]*dz)
+                noblob = np.setdiff1d(np.arange(len(cls)), owner)
+                if len(noblob):
+                    owner = np.concatenate((owner, noblob))
+                    blobs = np.vstack((blobs, cluster_maxima(cls[noblob])))
+                    order = np.argsort(owner, kind='stable')
+                    owner = owner[order]
+                    blobs = blobs[order]
+                #Remove overlapping centers than may appear at different scales
+                #in the different signals.
+                #The most intense blob in apparent radius is the best,
+                #then, the second intense in apparent radius, etc.
+                #then, the blobs in intensity
+                if noDuplicate and len(blobs) > 1:
+                    #clusters are far apart on an extra axis, the rank is used as intensity
+                    spacing = 2 * (np.ptp(blobs[:,0]) + 2 * blobs[:,1].max()) + 1
+                    kept = remove_overlap(np.column_stack((
+                        owner * spacing, blobs[:,0], blobs[:,1], np.arange(len(blobs))
+                        )))[:,-1].astype(int)
+                    owner = owner[kept]
+                    blobs = blobs[kept]
+            #Interpolate the x,y,r,intensity values at the position of each blob
+            grad = gaussian_filter1d(cls, k/2, axis=1, order=1)
+            zi = np.clip(np.rint(blobs[:,0]), 0, L-1).astype(int)
+            dz = blobs[:,0] - zi
+            keys.append(idx[owner])
+            parts.append(cls[owner, zi] + grad[owner, zi] * dz[:, None])
+        if len(parts):
+            keys = np.concatenate(keys)
+            particles.append(np.vstack(parts)[np.argsort(keys, kind='stable')])
+        pending = [sub for subs in subclusters for sub in subs]
+    particles = np.vstack(particles) if len(particles) else np.zeros([0, 5])
     if outputFinders:
-        return np.asarray(particles), finders
+        return particles, finders
     else:
-        return np.asarray(particles)
+        return particles
 
 
 def label_clusters(centers):
@@ -462,22 +526,38 @@ def split_clusters(clusters, centers):
     return clusters
 
 
-def draw_spheres(shape, pos, radii):
-    im = np.zeros(shape, bool)
-    if np.isscalar(radii):
-        radii = radii * np.ones(len(pos))
+def draw_spheres(shape, pos, radii, sigma=0, intensities=1.0, noise=0, seed=None, dtype=None):
+    """Synthetic image of spheres of given (x, y, z) positions and radii.
+
+    If sigma is 0, returns a binary image, True inside the spheres.
+    Otherwise the spheres are blurred by a Gaussian of width sigma and their contributions are added. Their peak value is close to intensities (scalar or one per sphere). Gaussian noise of standard deviation noise is then added, drawn deterministically from seed. dtype is the floating point type of the output, float32 by default.
+    2D images are drawn from (x, y) positions.
+    Spheres are drawn in parallel plane by plane, see kernels.draw_spheres."""
+    pos = np.asarray(pos, float)
+    radii = radii * np.ones(len(pos))
     assert len(pos)==len(radii)
-    assert np.min(pos.max(0)<shape[::-1]) and np.min([0,0,0]<=pos.min(0)), "points out of bounds"
-    for p, rsq, m, M in zip(
-        pos, radii**2, 
-        np.maximum(0, pos[:,::-1] - radii[:,None]).astype(int), 
-        np.minimum(im.shape, pos[:,::-1] + radii[:,None] + 1).astype(int)
-    ):
-        im[m[0]:M[0], m[1]:M[1], m[2]:M[2]] |= (
-            (p[2] - np.arange(m[0], M[0]))[:,None,None]**2 + 
-            (p[1] - np.arange(m[1], M[1]))[None,:,None]**2 +
-            (p[0] - np.arange(m[2], M[2]))[None,None,:]**2 <= rsq
+    assert np.min(pos.max(0)<shape[::-1]) and np.min(0<=pos.min(0)), "points out of bounds"
+    if len(shape) == 2:
+        return draw_spheres(
+            (1,)+tuple(shape), np.column_stack((pos, np.zeros(len(pos)))),
+            radii, sigma, intensities, noise, seed, dtype
+            )[0]
+    if sigma > 0:
+        im = np.zeros(shape, np.float32 if dtype is None else dtype)
+    else:
+        im = np.zeros(shape, np.uint8)
+    zlow = np.floor(pos[:, 2] - radii - 4*sigma)
+    kernels.draw_spheres(
+        pos, radii, (intensities if sigma > 0 else 1) * np.ones(len(pos)), float(sigma),
+        zlow, np.argsort(zlow, kind='stable'), im
         )
+    if sigma <= 0:
+        return im.view(bool)
+    if noise > 0:
+        rng = np.random.default_rng(seed)
+        #plane by plane to bound memory usage
+        for plane in im:
+            plane += noise * rng.standard_normal(plane.shape, plane.dtype)
     return im
 
 
@@ -488,34 +568,18 @@ def draw_rods(pos, radii, shape=None, im=None):
         shape = im.shape
     assert len(pos)==len(radii)
     assert np.min(pos.max(0)<shape[::-1]) and np.min([0,0,0]<=pos.min(0)), "points out of bounds"
-    code = """
-    #pragma omp parallel for
-    for(int p=0; p<Npos[0]; ++p)
-    {
-        const int i = pos(p,0), j = pos(p,1);
-        im(blitz::Range(
-            std::max(0, (int)(pos(p,2)-radii(p))),
-            std::min(Nim[0], (int)(pos(p,2)+radii(p))+1)-1
-            ), j, i) = 1;
-    }
-    """
-    weave.inline(
-        code,['pos', 'radii', 'im'],
-        type_converters = converters.blitz,
-        #extra_compile_args =['-O3 -fopenmp'],
-        extra_compile_args =['-O3'],
-        #extra_link_args=['-lgomp'],
-        verbose=2, compiler='gcc')
+    kernels.draw_rods(np.asarray(pos, float), np.asarray(radii, float), im)
     return im;
     
     
-def get_deconv_kernel(im, k=1.6, pxZ = 1.0, pxX=1.0):
+def get_deconv_kernel(im, k=1.6, pxZ = 1.0, pxX=1.0, workers=-1):
     """Compute the deconvolution kernel from a priori isotropic image. 
-    Returned kernel is in Fourier space."""
+    Returned kernel is in Fourier space.
+    workers is the number of threads of the FFT (-1 for all CPUs)."""
     assert im.ndim == 3
     imbl = gaussian_filter(im, k)
-    sblx = (np.abs(np.fft.rfft(imbl, axis=2))**2).mean(0).mean(0)
-    sblz = (np.abs(np.fft.rfft(imbl, axis=0))**2).mean(1).mean(1)
+    sblx = (np.abs(fft.rfft(imbl, axis=2, workers=workers))**2).mean(0).mean(0)
+    sblz = (np.abs(fft.rfft(imbl, axis=0, workers=workers))**2).mean(1).mean(1)
     f2 = np.interp(
         np.fft.fftfreq(2*len(sblz), pxZ)[:len(sblz)], 
         np.fft.fftfreq(2*len(sblx), pxX)[:len(sblx)], sblx
@@ -523,9 +587,39 @@ def get_deconv_kernel(im, k=1.6, pxZ = 1.0, pxX=1.0):
     return np.sqrt(f2)
 
 
-def deconvolve(im, kernel):
+def deconvolve(im, kernel, workers=-1):
     """Deconvolve the input image. Suppose no noise (already blurred input)."""
-    return np.fft.irfft(np.fft.rfft(im, axis=0) * kernel[:,None,None], axis=0, n=im.shape[0])
+    spectrum = fft.rfft(im, axis=0, workers=workers)
+    spectrum *= kernel[:,None,None]
+    return fft.irfft(spectrum, axis=0, n=im.shape[0], overwrite_x=True, workers=workers)
+
+
+class Deconvolver:
+    """Deconvolution along the first axis of stacks of fixed shape by a fixed kernel (see get_deconv_kernel).
+
+    The kernel is broadcasted once and the blurred stack is written in a preallocated buffer. scipy.fft has no output argument, so each call allocates the spectrum, and the inverse transform allocates the deconvolved stack. FFTs are multithreaded and their plans are cached by scipy.fft between calls."""
+    def __init__(self, shape, kernel, workers=-1):
+        assert len(kernel) == shape[0]//2+1
+        self.kernel = np.asarray(kernel, float)
+        self.broadcasted = self.kernel.reshape((-1,) + (1,) * (len(shape)-1))
+        self.workers = workers
+        self.shape = tuple(shape)
+        self.blurred = np.empty(shape)
+
+    def __call__(self, image, k=None, positive=False):
+        """Deconvolve the image, after blurring it by k if given. Negative values are removed if positive is True.
+
+        Returns a new array."""
+        if k is None:
+            blurred = np.asarray(image, float)
+        else:
+            blurred = gaussian_filter(image, k, output=self.blurred)
+        spectrum = fft.rfft(blurred, axis=0, workers=self.workers)
+        spectrum *= self.broadcasted
+        output = fft.irfft(spectrum, axis=0, n=self.shape[0], overwrite_x=True, workers=self.workers)
+        if positive:
+            np.maximum(output, 0, out=output)
+        return output
 
 
 def radius2scale(R, k=1.6, n=3.0, dim=3):
@@ -552,61 +646,45 @@ def sigma2radius(sigma, n=3.0, dim=3):
     return sigma * np.sqrt(2*dim* np.log(2) / n/(1 - 2**(-2.0/n)))
 
 
-support_functions = """
-#include <boost/math/special_functions/erf.hpp>
-    inline double halfG(const double &d, const double &R, const double &sigma)
-    {
-        return exp(-pow(R+d, 2)/(2*pow(sigma,2)))*sqrt(2/M_PI)*sigma/d + boost::math::erf((R+d)/sigma/sqrt(2));
-    }
-    inline double G(const double &d, const double &R, const double &sigma)
-    {
-        return halfG(d,R,sigma) + halfG(-d, R, sigma);
-    }
-    inline double G(const double &R, const double &sigma)
-    {
-        const double x = R/sigma/sqrt(2);
-        return boost::math::erf(x) - x*exp(-pow(x, 2))*2/sqrt(M_PI);
-    }
-    inline double DoG(const double &d, const double &R, const double &sigma, const double &alpha)
-    {
-        return G(d,R, alpha*sigma) - G(d, R, sigma);
-    }
-    inline double halfG_dsigma(const double &d, const double &R, const double &s2)
-    {
-        return (R*R+d*R+s2)*exp(-pow(R+d, 2)/(2*s2))/sqrt(2*M_PI)/d/s2;
-    }
-    inline double G_dsigma(const double &d, const double &R, const double &s2)
-    {
-        return halfG_dsigma(d,R,s2) + halfG_dsigma(-d, R, s2);
-    }
-    inline double DoG_dsigma(const double &d, const double &R, const double &sigma, const double &alpha)
-    {
-        return alpha*G_dsigma(d,R, pow(alpha*sigma, 2)) - G_dsigma(d, R, sigma*sigma);
-    }
-    inline double G_dsigma(const double &R, const double &sigma)
-    {
-        return -pow(R,3)/pow(sigma,4)*sqrt(2/M_PI)*exp(-pow(R,2)/2/pow(sigma,2));
-    }
-    inline double halfG_dsigma_dR(const double &d, const double &R, const double &s2)
-    {
-        return -R*(pow(R+d, 2)-s2)*exp(-pow(R+d, 2)/(2*s2))/sqrt(2*M_PI)/d/(s2*s2);
-    }
-    inline double G_dsigma_dR(const double &d, const double &R, const double &s2)
-    {
-        return halfG_dsigma_dR(d,R,s2) + halfG_dsigma_dR(-d, R, s2);
-    }
-    inline double DoG_dsigma_dR(const double &d, const double &R, const double &sigma, const double &alpha)
-    {
-        return alpha*G_dsigma_dR(d,R, pow(alpha*sigma, 2)) - G_dsigma_dR(d, R, sigma*sigma);
-    }
-    inline double G_dsigma_dR(const double &R, const double &sigma)
-    {
-        return pow(R,2)*(pow(R,2)-3*pow(sigma,2))/pow(sigma,6)*sqrt(2/M_PI)*exp(-pow(R,2)/2/pow(sigma,2));
-    }
-    """
+def bond_matrix(diagonal, bonds, offdiagonal):
+    """Sparse square matrix with the given diagonal and, for each bond (i,j), the terms offdiagonal[b] at [i,j] and [j,i].
+
+    The matrix is assembled in COO format from the bond arrays, each bond must appear only once."""
+    bonds = np.asarray(bonds, np.int64).reshape(-1, 2)
+    offdiagonal = np.asarray(offdiagonal).reshape(-1, 2)
+    N = len(diagonal)
+    return sparse.coo_matrix((
+        np.concatenate((diagonal, offdiagonal[:,0], offdiagonal[:,1])),
+        (
+            np.concatenate((np.arange(N), bonds[:,0], bonds[:,1])),
+            np.concatenate((np.arange(N), bonds[:,1], bonds[:,0]))
+            )), shape=(N, N))
+
+
+def solve_sparse(mat, rhs, solver='direct', x0=None, tol=1e-10, maxiter=1000):
+    """Solve the sparse linear system mat x = rhs.
+
+    solver can be
+        'direct': sparse LU decomposition (spsolve)
+        'cg': conjugate gradient, for symmetric positive definite matrices
+        'bicgstab': biconjugate gradient stabilized
+    Iterative solvers use a Jacobi preconditioner, start from x0 if given and stop at a relative residual tol. If they do not converge within maxiter iterations, the direct solver is used."""
+    if solver == 'direct':
+        return spsolve(sparse.csc_matrix(mat), rhs)
+    if solver not in ['cg', 'bicgstab']:
+        raise ValueError("Unknown solver %s" % solver)
+    mat = sparse.csr_matrix(mat)
+    diagonal = mat.diagonal()
+    diagonal[diagonal == 0] = 1
+    x, info = {'cg': cg, 'bicgstab': bicgstab}[solver](
+        mat, rhs, x0=x0, rtol=tol, maxiter=maxiter, M=sparse.diags(1.0/diagonal)
+        )
+    if info != 0:
+        return spsolve(mat.tocsc(), rhs)
+    return x
 
 
-def global_rescale_weave(sigma0, bonds, dists, R0=None, n=3):
+def global_rescale_weave(sigma0, bonds, dists, R0=None, n=3, solver='direct', x0=None):
     """Takes into account the overlapping of the blurred spot of neighbouring particles to compute the radii of all particles. Suppose all particles equally bright.
     
     parameters
@@ -621,6 +699,10 @@ def global_rescale_weave(sigma0, bonds, dists, R0=None, n=3):
         Previous iteration's radii
     n : int
         Same as in MultiscaleTracker
+    solver : string
+        Linear solver, see solve_sparse
+    x0 : array((N))
+        Initial guess of the increment of the radii from R0 for an iterative solver (warm start), e.g. the increment of the previous iteration
     """
     assert len(bonds)==len(dists) 
     alpha = 2**(1.0/n)
@@ -629,38 +711,14 @@ def global_rescale_weave(sigma0, bonds, dists, R0=None, n=3):
     v0 = np.zeros([len(sigma0)])
     tr = np.zeros([len(sigma0)])
     jacob = np.zeros([len(bonds),2])
-    code = """
-    //using blitz++ expression
-    v0 = -alpha*pow(R0,3)/pow(alpha*sigma0,4)*sqrt(2/M_PI)*exp(-pow(R0, 2)/2/pow(alpha*sigma0,2)) + pow(R0,3)/pow(sigma0,4)*sqrt(2/M_PI)*exp(-pow(R0, 2)/2/pow(sigma0,2));
-    tr = alpha*pow(R0,2)*(pow(R0,2)-3*pow(alpha*sigma0,2))/pow(alpha*sigma0,6)*sqrt(2/M_PI)*exp(-pow(R0,2)/2/pow(alpha*sigma0,2)) - pow(R0,2)*(pow(R0,2)-3*pow(sigma0,2))/pow(sigma0,6)*sqrt(2/M_PI)*exp(-pow(R0,2)/2/pow(sigma0,2));
-    #pragma omp parallel for
-    for(int b=0; b<Nbonds[0]; ++b)
-    {
-        int i = bonds(b,0), j = bonds(b,1);
-        jacob(b,0) = DoG_dsigma_dR(dists(b), R0(j), sigma0(i), alpha);
-        jacob(b,1) = DoG_dsigma_dR(dists(b), R0(i), sigma0(j), alpha);
-        v0(i) += DoG_dsigma(dists(b), R0(j), sigma0(i), alpha);
-        v0(j) += DoG_dsigma(dists(b), R0(i), sigma0(j), alpha);
-    }
-    """
-    weave.inline(
-        code,['bonds', 'dists', 'sigma0', 'R0', 'alpha', 'v0', 'jacob', 'tr'],
-        type_converters =converters.blitz,
-        support_code = support_functions,
-        #extra_compile_args =['-O3 -fopenmp'],
-        extra_compile_args =['-O3'],
-        #extra_link_args=['-lgomp'],
-        verbose=2, compiler='gcc')
-    jacob0 = sparse.lil_matrix(tuple([len(sigma0)]*2))
-    for (i,j), (a,b) in zip(bonds, jacob):
-        jacob0[i,j] = a
-        jacob0[j,i] = b
-    for i,a in enumerate(tr):
-        jacob0[i,i] = a
-    return R0 + spsolve(jacob0.tocsc(), -v0)
+    kernels.rescale_terms(
+        np.asarray(bonds, np.int64).reshape(-1, 2), np.asarray(dists, float),
+        np.asarray(sigma0, float), np.asarray(R0, float), np.ones(len(sigma0)),
+        alpha, False, v0, tr, jacob)
+    return R0 + solve_sparse(bond_matrix(tr, bonds, jacob), -v0, solver, x0)
 
     
-def global_rescale_intensity(sigma0, bonds, dists, intensities, R0=None, n=3):
+def global_rescale_intensity(sigma0, bonds, dists, intensities, R0=None, n=3, solver='direct', x0=None):
     """Takes into account the overlapping of the blurred spot of neighbouring particles to compute the radii of all particles. The brightness of the particles is taken into account.
     
     parameters
@@ -677,6 +735,10 @@ def global_rescale_intensity(sigma0, bonds, dists, intensities, R0=None, n=3):
         Previous iteration's radii
     n : int
         Same as in MultiscaleTracker
+    solver : string
+        Linear solver, see solve_sparse
+    x0 : array((N), float)
+        Initial guess of the increment of the radii from R0 for an iterative solver (warm start), e.g. the increment of the previous iteration
     """
     assert len(bonds)==len(dists) 
     alpha = 2**(1.0/n)
@@ -685,43 +747,13 @@ def global_rescale_intensity(sigma0, bonds, dists, intensities, R0=None, n=3):
     v0 = np.zeros([len(sigma0)])
     tr = np.zeros([len(sigma0)])
     jacob = np.zeros([len(bonds),2])
-    code = """
-    //using blitz++ expression
-    //tr = intensities * (alpha*pow(R0,2)*(pow(R0,2)-3*pow(alpha*sigma0,2))/pow(alpha*sigma0,6)*sqrt(2/M_PI)*exp(-pow(R0,2)/2/pow(alpha*sigma0,2)) - pow(R0,2)*(pow(R0,2)-3*pow(sigma0,2))/pow(sigma0,6)*sqrt(2/M_PI)*exp(-pow(R0,2)/2/pow(sigma0,2)));
-    #pragma omp parallel for
-    for(int i=0; i<Nv0[0]; ++i)
-    {
-        v0(i) = intensities(i) * (alpha*G_dsigma(R0(i), alpha*sigma0(i)) - G_dsigma(R0(i), sigma0(i)));
-        tr(i) = intensities(i) * (alpha*G_dsigma_dR(R0(i), alpha*sigma0(i)) - G_dsigma_dR(R0(i), sigma0(i)));
-    }
-    #pragma omp parallel for
-    for(int b=0; b<Nbonds[0]; ++b)
-    {
-        int i = bonds(b,0), j = bonds(b,1);
-        const double d = std::max(dists(b), R0(i)+R0(j));
-        jacob(b,0) = intensities(j) * DoG_dsigma_dR(d, R0(j), sigma0(i), alpha);
-        jacob(b,1) = intensities(i) * DoG_dsigma_dR(d, R0(i), sigma0(j), alpha);
-        v0(i) += intensities(j) * DoG_dsigma(d, R0(j), sigma0(i), alpha);
-        v0(j) += intensities(i) * DoG_dsigma(d, R0(i), sigma0(j), alpha);
-    }
-    """
-    weave.inline(
-        code,['bonds', 'dists', 'sigma0', 'intensities', 'R0', 'alpha', 'v0', 'jacob', 'tr'],
-        type_converters =converters.blitz,
-        support_code = support_functions,
-        #extra_compile_args =['-O3 -fopenmp'],
-        extra_compile_args =['-O3'],
-        #extra_link_args=['-lgomp'],
-        verbose=2, compiler='gcc')
-    jacob0 = sparse.lil_matrix(tuple([len(sigma0)]*2))
-    for (i,j), (a,b) in zip(bonds, jacob):
-        jacob0[i,j] = a
-        jacob0[j,i] = b
-    for i,a in enumerate(tr):
-        jacob0[i,i] = a
-    return R0 + spsolve(jacob0.tocsc(), -v0)
+    kernels.rescale_terms(
+        np.asarray(bonds, np.int64).reshape(-1, 2), np.asarray(dists, float),
+        np.asarray(sigma0, float), np.asarray(R0, float), np.asarray(intensities, float),
+        alpha, True, v0, tr, jacob)
+    return R0 + solve_sparse(bond_matrix(tr, bonds, jacob), -v0, solver, x0)
     
-def solve_intensities(sigma0, bonds, dists, intensities, R0=None, n=3):
+def solve_intensities(sigma0, bonds, dists, intensities, R0=None, n=3, solver='direct', x0=None):
     """Takes into account the overlapping of the blurred spot of neighbouring particles to compute the brightness of all particles.
     
     parameters
@@ -738,6 +770,10 @@ def solve_intensities(sigma0, bonds, dists, intensities, R0=None, n=3):
         Previous iteration's radii
     n : int
         Same as in MultiscaleTracker
+    solver : string
+        Linear solver, see solve_sparse
+    x0 : array((N), float)
+        Initial guess of the brightnesses for an iterative solver (warm start), e.g. the output of the previous iteration
     """
     assert len(bonds)==len(dists) 
     alpha = 2**(1.0/n)
@@ -745,34 +781,11 @@ def solve_intensities(sigma0, bonds, dists, intensities, R0=None, n=3):
         R0 = sigma2radius(sigma0, n=float(n))
     tr = np.zeros([len(sigma0)])
     ofd = np.zeros([len(bonds),2])
-    code = """
-    #pragma omp parallel for
-    for(int i=0; i<Ntr[0]; ++i)
-        tr(i) = G(R0(i), alpha*sigma0(i)) - G(R0(i), sigma0(i));
-    #pragma omp parallel for
-    for(int b=0; b<Nbonds[0]; ++b)
-    {
-        int i = bonds(b,0), j = bonds(b,1);
-        const double d = dists(b);
-        ofd(b,0) = DoG(d, R0(j), sigma0(i), alpha);
-        ofd(b,1) = DoG(d, R0(i), sigma0(j), alpha);
-    }
-    """
-    weave.inline(
-        code,['bonds', 'dists', 'sigma0', 'R0', 'alpha', 'ofd', 'tr'],
-        type_converters =converters.blitz,
-        support_code = support_functions,
-        #extra_compile_args =['-O3 -fopenmp'],
-        extra_compile_args =['-O3'],
-        #extra_link_args=['-lgomp'],
-        verbose=2, compiler='gcc')
-    mat = sparse.lil_matrix(tuple([len(sigma0)]*2))
-    for (i,j), (a,b) in zip(bonds, ofd):
-        mat[i,j] = a
-        mat[j,i] = b
-    for i,a in enumerate(tr):
-        mat[i,i] = a
-    return spsolve(mat.tocsc(), intensities)
+    kernels.intensity_terms(
+        np.asarray(bonds, np.int64).reshape(-1, 2), np.asarray(dists, float),
+        np.asarray(sigma0, float), np.asarray(R0, float),
+        alpha, tr, ofd)
+    return solve_sparse(bond_matrix(tr, bonds, ofd), intensities, solver, x0)
     
     
 halfG_dsigma = lambda d, R, sigma : (R**2+d*R+sigma**2)*np.exp(-(R+d)**2/(2*sigma**2))/np.sqrt(2*np.pi)/d/sigma**2
@@ -801,63 +814,214 @@ def G_dsigma_dR(d, R, sigma):
 DoG_dsigma_dR = lambda d, R, sigma, alpha : alpha*G_dsigma_dR(d,R,alpha*sigma) - G_dsigma_dR(d, R, sigma)
 
 
-def global_rescale(coords, sigma0, R0=None, bonds=None, n=3):
+def global_rescale(coords, sigma0, R0=None, bonds=None, n=3, solver='direct', x0=None):
+    """Same as global_rescale_weave, from the coordinates of the particles.
+
+    If bonds is None, all pairs closer than twice the sum of their radii are bonded. bonds can also be given as (i, j) or (i, j, distance)."""
     alpha = 2**(1.0/n)
-    if isinstance(R0, type(None)):
+    noR0 = isinstance(R0, type(None))
+    if noR0:
         R0 = sigma2radius(sigma0, n=float(n))
-        v0 = np.zeros([len(coords)])
+    coords = np.asarray(coords, float)
+    if bonds is None:
+        pairs = KDTree(coords).query_pairs(4 * np.max(R0) * (1 + 1e-7), output_type='ndarray').reshape(-1, 2)
+        dists = np.sqrt(np.sum((coords[pairs[:,0]] - coords[pairs[:,1]])**2, -1))
+        good = dists < 2 * (R0[pairs[:,0]] + R0[pairs[:,1]])
+        bonds, dists = pairs[good], dists[good]
     else:
-        v0 = DoG_dsigma(0, R0, sigma0, alpha)
-    jacob0 = sparse.lil_matrix(tuple([len(coords)]*2))
-    for i,(r,s) in enumerate(zip(R0, sigma0)):
-        jacob0[i,i] = DoG_dsigma_dR(0, r, s, alpha)
-    if bonds==None:
-        bonds=[]
-        for i,p in enumerate(coords):
-            for j,dsq in enumerate(np.sum(numexpr.evaluate(
-                    '(q-p)**2',
-                    {'p':p, 'q':coords[i+1:]}
-                    ), axis=-1)):
-                if dsq<4*(R0[i]+R0[i+1+j])**2:
-                    bonds.append([i, i+1+j, np.sqrt(dsq)])
-    if len(bonds[0])==2:
-        bonds = [[i, j, np.sqrt(np.sum((coords[i]-coords[j])**2))] for i,j in bonds]
-    for i, j, d in bonds:
-        jacob0[i, j] = DoG_dsigma_dR(d, R0[j], sigma0[i], alpha)
-        jacob0[j, i] = DoG_dsigma_dR(d, R0[i], sigma0[j], alpha)
-        v0[i] += DoG_dsigma(d, R0[j], sigma0[i], alpha)
-        v0[j] += DoG_dsigma(d, R0[i], sigma0[j], alpha)
-    return R0 + spsolve(jacob0.tocsc(), -v0)
+        bonds = np.asarray(bonds)
+        if bonds.shape[1] == 2:
+            bonds = bonds.astype(np.int64)
+            dists = np.sqrt(np.sum((coords[bonds[:,0]] - coords[bonds[:,1]])**2, -1))
+        else:
+            bonds, dists = bonds[:, :2].astype(np.int64), bonds[:, 2]
+    v0 = np.zeros([len(coords)])
+    tr = np.zeros([len(coords)])
+    jacob = np.zeros([len(bonds),2])
+    kernels.rescale_terms(
+        bonds, np.asarray(dists, float),
+        np.asarray(sigma0, float), np.asarray(R0, float), np.ones(len(coords)),
+        alpha, False, v0, tr, jacob)
+    if noR0:
+        #only the bonds contribute to the first iteration
+        v0 -= DoG_dsigma(0, R0, sigma0, alpha)
+    return R0 + solve_sparse(bond_matrix(tr, bonds, jacob), -v0, solver, x0)
+
+
+def remove_overlap(centers, method='kdtree'):
+    """Remove overlapping blobs, keeping the most intense.
+
+    centers is an array of (coordinates, radius, intensity), the most intense blobs having the lowest (negative) intensity.
+    Two blobs overlap if their distance is smaller than the sum of their radii.
+    method can be
+        'kdtree': candidate pairs are found using a spatial index, O(N log N)
+        'brute': each blob is compared to all the blobs already kept, O(N**2)
+    Returns the blobs kept, sorted by intensity."""
+    centers = centers[np.argsort(centers[:, -1])]
+    if method == 'brute':
+        out = []
+        for i in centers:
+            for j in out:
+                if np.sum((i[:-2]-j[:-2])**2) < (i[-2]+j[-2])**2:
+                    break
+            else:
+                out.append(i)
+        return np.vstack(out)
+    if method != 'kdtree':
+        raise ValueError("Unknown overlap removal method %s" % method)
+    #all pairs of blobs that may overlap
+    tree = KDTree(centers[:, :-2])
+    pairs = tree.query_pairs(2 * centers[:, -2].max() * (1 + 1e-7), output_type='ndarray')
+    dists = np.sum((centers[pairs[:, 0], :-2] - centers[pairs[:, 1], :-2])**2, -1)
+    pairs = pairs[dists < centers[pairs, -2].sum(-1)**2]
+    #symmetric adjacency matrix of the overlaps
+    overlaps = sparse.coo_matrix(
+        (np.ones(2*len(pairs), bool), (pairs.T.ravel(), pairs[:, ::-1].T.ravel())),
+        shape=(len(centers), len(centers))
+        ).tocsr()
+    good = np.ones(len(centers), bool)
+    #centers are already sorted by intensity
+    kernels.greedy_nonoverlap(
+        np.arange(len(centers)), overlaps.indptr, overlaps.indices, good
+        )
+    return centers[good]
+
+
+def hessian_edges(im, c0, maxedge):
+    """Tell which of the pixel positions c0 of im are elongated blobs.
+
+    The 2x2 Hessian matrix in the plane of the last two axes of im is computed by finite differences at all positions at once. Positions where its determinant is negative or where the ratio of its eigenvalues is larger than maxedge are edges. Leading axes of im (e.g. scale) are indexed by the first columns of c0."""
+    c0 = np.asarray(c0, int).reshape(-1, im.ndim)
+    lead = tuple(c0[:, :-2].T)
+    def ngb(dy, dx):
+        return im[lead + (c0[:, -2] + dy, c0[:, -1] + dx)]
+    centre = ngb(0, 0)
+    #compute the XYhessian matrix coefficients
+    hxx = ngb(-1, 0) - 2*centre + ngb(1, 0)
+    hyy = ngb(0, -1) - 2*centre + ngb(0, 1)
+    hxy = ngb(-1, -1) + ngb(1, 1) - ngb(-1, 1) - ngb(1, -1)
+    #determinant of the Hessian, for the coefficient see
+    #H Bay, a Ess, T Tuytelaars, and L Vangool,
+    #Computer Vision and Image Understanding 110, 346-359 (2008)
+    detH = hxx*hyy - hxy**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = (hxx+hyy)**2/(4.0*hxx*hyy)
+    return (detH < 0) | (ratio > maxedge)
+
+
+class Timings:
+    """Registry of the number of calls, wall time and bytes allocated by each processing stage of the finders.
+
+    When disabled (default), stage() returns a shared no-op context and nothing is recorded. If memory is True, the peak memory allocated during each stage is measured with tracemalloc, which slows down allocations. Stages must not be nested."""
+    def __init__(self, enabled=False, memory=False):
+        self.calls = {}
+        self.time = {}
+        self.bytes = {}
+        self.enable(enabled, memory)
+
+    def enable(self, enabled=True, memory=False):
+        self.enabled = enabled
+        self.memory = enabled and memory
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def reset(self):
+        self.calls.clear()
+        self.time.clear()
+        self.bytes.clear()
+
+    def stage(self, name):
+        """Context measuring the enclosed code as a part of stage name"""
+        if not self.enabled:
+            return no_stage
+        return TimedStage(self, name)
+
+    def total(self, *names):
+        """Total time spent in the given stages, or in all the stages if no name is given"""
+        if not names:
+            names = self.time.keys()
+        return sum((self.time.get(name, 0.0) for name in names), 0.0)
+
+    def add(self, name, duration, nbytes=0):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.time[name] = self.time.get(name, 0.0) + duration
+        self.bytes[name] = self.bytes.get(name, 0) + nbytes
+
+    def report(self):
+        """Table of the stages by decreasing total time"""
+        lines = ['%-14s %8s %10s %14s %10s' % ('stage', 'calls', 'time (s)', 'per call (ms)', 'MB')]
+        for name in sorted(self.time, key=self.time.get, reverse=True):
+            lines.append('%-14s %8d %10.3f %14.3f %10.1f' % (
+                name, self.calls[name], self.time[name],
+                1e3 * self.time[name] / self.calls[name], self.bytes[name] / 2.0**20
+                ))
+        return '\n'.join(lines)
+
+
+class TimedStage:
+    """Context recording the duration (and allocated memory) of a stage in a Timings registry"""
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        if self.timings.memory:
+            tracemalloc.reset_peak()
+            self.m0 = tracemalloc.get_traced_memory()[0]
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.t0
+        nbytes = tracemalloc.get_traced_memory()[1] - self.m0 if self.timings.memory else 0
+        self.timings.add(self.name, duration, nbytes)
+        return False
+
+
+no_stage = nullcontext()
 
 
 class CrockerGrierFinder:
     """A single scale blob finder using Crocker & Grier algorithm"""
-    def __init__(self, shape=(256,256), dtype=np.float32):
-        """Allocate memory once"""
+    def __init__(self, shape=(256,256), dtype=np.float32, timings=None):
+        """Allocate memory once. timings is the registry of the time spent in each stage, see Timings."""
+        self.timings = Timings() if timings is None else timings
         self.blurred = np.empty(shape, dtype)
         self.background = np.empty(shape, dtype)
         self.dilated = np.empty_like(self.blurred)
         self.binary = np.empty(self.blurred.shape, bool)
-        
+
+    @property
+    def time_fill(self):
+        """Time spent in fill, kept for compatibility. Only recorded when self.timings is enabled."""
+        return self.timings.total('fill')
+
+    @property
+    def time_subpix(self):
+        """Time spent in subpix, kept for compatibility. Only recorded when self.timings is enabled."""
+        return self.timings.total('subpix')
+
     def fill(self, image, k=1.6, uniform_size=None, background=None):
         """All the image processing when accepting a new image."""
         assert self.blurred.shape == image.shape, """Wrong image size:
 %s instead of %s"""%(image.shape, self.blurred.shape)
-        #fill the first layer by the input
-        self.blurred[:] = image
-        #Gaussian filter
-        gaussian_filter(self.blurred, k, output=self.blurred)
-        #background removal
-        if background is None:
-            if uniform_size is None:
-                uniform_size = int(10*k)
-            if uniform_size>0:
-                uniform_filter(self.blurred, uniform_size, output=self.background)
-                self.blurred -= self.background
-        else:
-            self.blurred -= background
+        with self.timings.stage('fill'):
+            #fill the first layer by the input
+            self.blurred[:] = image
+            #Gaussian filter
+            gaussian_filter(self.blurred, k, output=self.blurred)
+            #background removal
+            if background is None:
+                if uniform_size is None:
+                    uniform_size = int(10*k)
+                if uniform_size>0:
+                    uniform_filter(self.blurred, uniform_size, output=self.background)
+                    self.blurred -= self.background
+            else:
+                self.blurred -= background
         #Dilation
-        grey_dilation(self.blurred, [3]*self.blurred.ndim, output=self.dilated)
+        with self.timings.stage('dilation'):
+            grey_dilation(self.blurred, [3]*self.blurred.ndim, output=self.dilated)
         
     def initialize_binary(self, maxedge=-1, threshold=None):
         if threshold is None:
@@ -873,22 +1037,8 @@ class CrockerGrierFinder:
             self.binary[tuple([slice(None)]*(self.binary.ndim-1-a)+[slice(-2, None)])]=False
         #eliminate blobs that are edges
         if self.blurred.ndim==2 and maxedge>0 :
-            for p in np.transpose(np.where(self.binary)):
-                #xy neighbourhood
-                ngb = self.blurred[tuple([slice(u-1, u+2) for u in p])]
-                #compute the XYhessian matrix coefficients
-                hess = [
-                    ngb[0, 1] - 2*ngb[1, 1] + ngb[-1,1],
-                    ngb[1, 0] - 2*ngb[1, 1] + ngb[1,-1],
-                    ngb[0,0] + ngb[-1,-1] - ngb[0,-1] - ngb[-1,0]
-                    ]
-                #determinant of the Hessian, for the coefficient see
-                #H Bay, a Ess, T Tuytelaars, and L Vangool,
-                #Computer Vision and Image Understanding 110, 346-359 (2008)
-                detH = hess[0]*hess[1] - hess[2]**2
-                ratio = (hess[0]+hess[1])**2/(4.0*hess[0]*hess[1])
-                if detH<0 or ratio>maxedge:
-                    self.binary[tuple(p.tolist())] = False
+            c0 = np.transpose(np.where(self.binary))
+            self.binary[tuple(c0[hessian_edges(self.blurred, c0, maxedge)].T)] = False
                     
     def no_subpix(self):
         """extracts centers positions and values from binary without subpixel resolution"""
@@ -908,25 +1058,11 @@ class CrockerGrierFinder:
         centers = np.empty([nb_centers, self.blurred.ndim+1])
         #original positions of the centers
         c0 = np.transpose(np.where(self.binary))
-        if self.binary.ndim==2 and (sys.version_info <= (3, 0)):
-            im = self.blurred
-            code = """
-            #pragma omp parallel for
-            for(int p=0; p<Nc0[0]; ++p)
-            {
-                const int i = c0(p,0), j = c0(p,1);
-                centers(p,0) = blitz::sum(im(blitz::Range(i-2,i+2), blitz::Range(j-2,j+2)))/25.;
-                centers(p,1) = i - blitz::sum(im(blitz::Range(i-2,i+2), j) * coefprime) / blitz::sum(im(blitz::Range(i-2,i+2), j) * coefsec);
-                centers(p,2) = j - blitz::sum(im(i, blitz::Range(j-2,j+2)) * coefprime) / blitz::sum(im(i, blitz::Range(j-2,j+2)) * coefsec);
-            }
-            """
-            weave.inline(
-                code,['c0', 'centers', 'coefprime', 'coefsec', 'im'],
-                type_converters =converters.blitz,
-                #extra_compile_args =['-O3 -fopenmp -mtune=native'],
-                extra_compile_args =['-O3 -mtune=native'],
-                #extra_link_args=['-lgomp'],
-                verbose=2)
+        if self.binary.ndim==2:
+            kernels.subpix2D(self.blurred, c0, coefprime, coefsec, centers)
+            return centers
+        if self.binary.ndim==3:
+            kernels.subpix3D(self.blurred, c0, coefprime, coefsec, centers)
             return centers
         for i, p in enumerate(c0):
             #neighbourhood
@@ -941,29 +1077,53 @@ class CrockerGrierFinder:
         """Locate bright blobs in an image with subpixel resolution.
 Returns an array of (x, y, intensity)"""
         self.fill(image, k, uniform_size, background)
-        self.initialize_binary(maxedge, threshold)
-        centers = self.subpix()[:,::-1]
+        with self.timings.stage('binary'):
+            self.initialize_binary(maxedge, threshold)
+        with self.timings.stage('subpix'):
+            centers = self.subpix()[:,::-1]
         return centers
 
 
 class OctaveBlobFinder:
     """Locator of bright blobs in an image of fixed shape. Works on a single octave."""
-    def __init__(self, shape=(256, 256), nbLayers=3, dtype=np.float32):
+    # number of leading axes of the image that index independent images (see StackOctaveBlobFinder)
+    nbatch = 0
+
+    def __init__(self, shape=(256, 256), nbLayers=3, dtype=np.float32, smoothing='exact', fused=False, timings=None):
         """
         Allocate memory once
         nbLayers: effective layer of dog to locate particle
         actural layer number: Gaussian: nbLayers+3, DOG: nbLayers+2
+        smoothing: Gaussian filter used to build the scale space, a key of smoothing_backends or a function with the same signature as scipy.ndimage.gaussian_filter
+        fused: if True, the scale space minima are extracted in a single pass over the DoG layers (see kernels.scale_space_minima) and stored as coordinates in self.candidates. The eroded and binary arrays are then never allocated.
+        timings: registry of the time spent in each stage, see Timings
         """
+        self.timings = Timings() if timings is None else timings
+        self.smoothing = get_smoothing(smoothing)
+        self.fused = fused
         self.layersG = np.empty([nbLayers+3]+list(shape), dtype)
         self.layers = np.empty([nbLayers+2]+list(shape), dtype)
-        self.eroded = np.empty_like(self.layers)
-        self.binary = np.empty(self.layers.shape, bool)
-        self.time_fill = 0.0
-        self.time_subpix = 0.0
+        if fused:
+            self.eroded = None
+            self.binary = None
+        else:
+            self.eroded = np.empty_like(self.layers)
+            self.binary = np.empty(self.layers.shape, bool)
+        self.candidates = np.zeros([0, self.layers.ndim], int)
         self.ncalls = 0
         self.noutputs = 0
         self.sizes = np.empty(nbLayers)
 
+    @property
+    def time_fill(self):
+        """Time spent in fill, kept for compatibility. Only recorded when self.timings is enabled."""
+        return self.timings.total('fill')
+
+    @property
+    def time_subpix(self):
+        """Time spent in subpix, kept for compatibility. Only recorded when self.timings is enabled."""
+        return self.timings.total('subpix')
+
     def get_iterative_radii(self, k):
         dim = self.layers[0].ndim
         nbLayers = len(self.layersG) - 3  # the first layer is the origional graph
@@ -976,23 +1136,38 @@ class OctaveBlobFinder:
 
     def fill(self, image, k=1.6):
         """All the image processing when accepting a new image."""
-        t0 = time.clock()
         # total 220 ms
         assert self.layersG[0].shape == image.shape, """Wrong image size:
 %s instead of %s""" % (image.shape, self.layersG[0].shape)
-        # fill the first layer by the input (already blurred by k)
-        self.layersG[0] = image
-        self.sizes, sigmas_iter = self.get_iterative_radii(k)
-        # Gaussian filters
-        for l, layer in enumerate(self.layersG[:-1]):
-            gaussian_filter(layer, sigmas_iter[l], output=self.layersG[l+1])
-        # Difference of Gaussian layers
-        for l in range(len(self.layers)):
-            self.layers[l] = self.layersG[l+1] - self.layersG[l]
+        with self.timings.stage('fill'):
+            # fill the first layer by the input (already blurred by k)
+            self.layersG[0] = image
+            self.sizes, sigmas_iter = self.get_iterative_radii(k)
+            # Gaussian filters
+            for l, layer in enumerate(self.layersG[:-1]):
+                self.smoothing(layer, sigmas_iter[l], output=self.layersG[l+1])
+            # Difference of Gaussian layers
+            for l in range(len(self.layers)):
+                self.layers[l] = self.layersG[l+1] - self.layersG[l]
         # Erosion 86.2 ms
-        grey_erosion(self.layers, [3]*self.layers.ndim, output=self.eroded)
+        if not self.fused:
+            with self.timings.stage('erosion'):
+                grey_erosion(self.layers, [3]*self.layers.ndim, output=self.eroded)
         # scale space minima, whose neighbourhood are all negative 10 ms
-        self.time_fill += time.clock() - t0
+
+    def smoothing_error(self, k=1.6):
+        """Difference between the DoG layers built by the smoothing backend and those built by the exact Gaussian filter, from the same input (last call to fill).
+
+        Returns for each DoG layer the maximum absolute difference, relative to the maximum absolute value of the exact DoG layer."""
+        sigmas_iter = self.get_iterative_radii(k)[1]
+        previous = np.array(self.layersG[0], float)
+        err = np.zeros(len(self.layers))
+        for l in range(len(self.layers)):
+            exact = gaussian_filter(previous, sigmas_iter[l])
+            dog = exact - previous
+            err[l] = np.abs(self.layers[l] - dog).max() / max(np.abs(dog).max(), np.finfo(float).tiny)
+            previous = exact
+        return err
 
     def initialize_binary(self, maxedge=-1, first_layer=False, maxDoG=None):
         """Convert the DoG layers into the binary image, True at center position.
@@ -1003,9 +1178,31 @@ class OctaveBlobFinder:
         Centers at the edge of the image are excluded. 
         On 2D images, if maxedge is positive, elongated blobs are excluded if the ratio of the eignevalues of the Hessian matrix is larger than maxedge.
         Optionally, the local spatial minima in the first DoG layer can be considered as centers.
+        In fused mode, the centers are stored as coordinates in self.candidates and first_layer is not available.
         """
         if maxDoG is None:
             maxDoG = 0
+        if self.fused:
+            if first_layer:
+                raise ValueError("first_layer is not available with fused extraction of the minima")
+            layers = np.ascontiguousarray(self.layers)
+            # flat offsets of the neighbours in scale and space
+            strides = np.array(layers.strides) // layers.itemsize
+            offsets = np.array([
+                np.dot(strides, d)
+                for d in itertools.product([-1, 0, 1], repeat=layers.ndim)
+                if any(d)
+                ], np.int64)
+            # no center closer to the edge than its size, nor in the first and last layers
+            margins = np.zeros(len(layers), np.int64)
+            margins[1:-1] = self.sizes[1:len(layers)-1]
+            self.candidates = kernels.scale_space_minima(
+                layers.ravel(), np.array(layers.shape, np.int64),
+                margins, offsets, float(maxDoG)
+                )
+            if self.layers.ndim == 3 and maxedge > 0:
+                self.candidates = self.candidates[np.logical_not(hessian_edges(self.layers, self.candidates, maxedge))]
+            return
         # local minima in the DoG on both space and scale are obtained from erosion
         self.binary = numexpr.evaluate(
             '(l==e) & (l<maxDoG) & (l**2+1.0>1.0)',
@@ -1043,43 +1240,40 @@ class OctaveBlobFinder:
                 bi[tuple([slice(None)]*(bi.ndim-1-a)+[slice(-r, None)])]=False
         # eliminate blobs that are edges
         if self.layers.ndim == 3 and maxedge > 0:
-            for r, bi, layer in zip(self.sizes[1:-1], self.binary[1:-1], self.layers[1:-1]):
-                for p in np.transpose(np.where(bi)):
-                    # xy neighbourhood
-                    ngb = layer[tuple([slice(u-1, u+2) for u in p])]
-                    # compute the XYhessian matrix coefficients
-                    hess = [
-                        ngb[0, 1] - 2*ngb[1, 1] + ngb[-1,1],
-                        ngb[1, 0] - 2*ngb[1, 1] + ngb[1,-1],
-                        ngb[0,0] + ngb[-1,-1] - ngb[0,-1] - ngb[-1,0]
-                        ]
-                    #determinant of the Hessian, for the coefficient see
-                    #H Bay, a Ess, T Tuytelaars, and L Vangool,
-                    #Computer Vision and Image Understanding 110, 346-359 (2008)
-                    detH = hess[0]*hess[1] - hess[2]**2
-                    ratio = (hess[0]+hess[1])**2/(4.0*hess[0]*hess[1])
-                    if detH < 0 or ratio > maxedge:
-                        bi[tuple(p.tolist())] = False
+            c0 = np.transpose(np.where(self.binary))
+            self.binary[tuple(c0[hessian_edges(self.layers, c0, maxedge)].T)] = False
+
+    def pixel_centers(self):
+        """Positions (layer, coordinates) of the centers without subpixel resolution, from either self.binary or self.candidates (fused mode). None if the binary image is degenerated."""
+        if self.fused:
+            return self.candidates
+        if self.binary.min():
+            return None
+        return np.transpose(np.where(self.binary))
 
     def no_subpix(self):
         """extracts centers positions and values from binary without subpixel resolution"""
-        nb_centers = self.binary.sum()
-        if nb_centers == 0 or self.binary.min():
-            return np.zeros([0, self.layers.ndim+1])
         # original positions of the centers
-        c0 = np.transpose(np.where(self.binary))
-        vals = self.layers[self.binary]
+        c0 = self.pixel_centers()
+        if c0 is None or len(c0) == 0:
+            return np.zeros([0, self.layers.ndim+1])
+        vals = self.layers[tuple(c0.T)]
         return np.column_stack((vals, c0))
 
-    def subpix(self, method=1):
-        """Extract and refine to subpixel resolution the positions and size of the blobs"""
-        nb_centers = self.binary.sum()
-        if nb_centers == 0 or self.binary.min():
-            return np.zeros([0, self.layers.ndim+1])
-        centers = np.empty([nb_centers, self.layers.ndim+1])
+    def subpix(self, method=1, batch=True):
+        """Extract and refine to subpixel resolution the positions and size of the blobs
+
+        method 0 fits a quadratic form on the 3**dim neighbourhood.
+        method 1 computes the center of mass of the negative DoG region around each center.
+        If batch is True, method 1 processes all the centers of a layer at once (see subpix_batch), with the same output."""
         #original positions of the centers
-        c0 = np.transpose(np.where(self.binary))
-        if method==0:
+        c0 = self.pixel_centers()
+        if c0 is None or len(c0) == 0:
+            return np.zeros([0, self.layers.ndim+1])
+        centers = np.empty([len(c0), self.layers.ndim+1])
+        if method==1 and batch:
+            self.subpix_batch(c0, centers)
+        elif method==0:
             for i, p in enumerate(c0):
                 #neighbourhood
                 ngb = self.layers[tuple([slice(u-1, u+2) for u in p])]
@@ -1122,9 +1316,9 @@ class OctaveBlobFinder:
                 labels = measurements.label(ngb < 0)[0]
                 lab = labels[tuple(rv)]
                 # value
-                centers[i,0] = measurements.mean(ngb, labels, [lab])
+                centers[i,0] = measurements.mean(ngb, labels, lab)
                 # pedestal removal
-                ped = measurements.maximum(ngb, labels, [lab])
+                ped = measurements.maximum(ngb, labels, lab)
                 if ped != self.layers[tuple(p.tolist())]: # except if only one pixel or uniform value
                     ngb -= ped
                 # center of mass
@@ -1141,6 +1335,57 @@ class OctaveBlobFinder:
                 else:
                     centers[i, 1] = p[0]
         return centers
+
+    def subpix_batch(self, c0, centers, maxsize=2**24):
+        """Vectorized version of subpix method 1.
+
+        The neighbourhoods of all the centers of a given layer are gathered in a single array and labelled at once. Centroids, mean values and scale interpolation are then computed for all centers together. Neighbourhoods are processed by chunks of at most maxsize pixels to bound memory usage."""
+        ndim = self.layers.ndim - 1
+        for l in np.unique(c0[:, 0]):
+            sel = np.where(c0[:, 0] == l)[0]
+            r = self.sizes[l]
+            # half widths of the neighbourhood, that does not extend along batch axes
+            half = [1] + [0] * self.nbatch + [r] * (ndim - self.nbatch)
+            # offsets of the neighbourhood with respect to the center
+            offsets = np.ix_(*[np.arange(-h, h+1) for h in half])
+            # labels are connected in scale and space, but not between neighbourhoods
+            structure = np.zeros([3] * (ndim + 2), bool)
+            structure[1] = generate_binary_structure(ndim + 1, 1)
+            # coordinates inside a neighbourhood
+            grids = [g.astype(float) for g in np.ogrid[tuple(slice(0, 2*h+1) for h in half)]]
+            chunk = max(1, maxsize // int(np.prod([2*h+1 for h in half])))
+            for start in range(0, len(sel), chunk):
+                idx = sel[start:start + chunk]
+                p = c0[idx]
+                # gather all neighbourhoods (copy)
+                ngb = self.layers[tuple(
+                    p[:, a].reshape((-1,) + (1,) * (ndim + 1)) + o[None]
+                    for a, o in enumerate(offsets)
+                    )]
+                # label only the negative pixels
+                labels, nlab = measurements.label(ngb < 0, structure)
+                # the background of each neighbourhood gets its own label,
+                # so that a non-negative center never pools the whole chunk
+                background = np.arange(nlab + 1, nlab + 1 + len(idx)).reshape((-1,) + (1,) * (ndim + 1))
+                labels = np.where(labels == 0, background, labels)
+                labs = labels[(slice(None),) + tuple(half)]
+                # value
+                centers[idx, 0] = measurements.mean(ngb, labels, labs)
+                # pedestal removal, except if only one pixel or uniform value
+                ped = np.asarray(measurements.maximum(ngb, labels, labs))
+                remove = ped != self.layers[tuple(p.T)]
+                ngb[remove] -= ped[remove].reshape((-1,) + (1,) * (ndim + 1))
+                # center of mass
+                normalizer = measurements.sum(ngb, labels, labs)
+                for a, g in enumerate(grids):
+                    centers[idx, a + 1] = measurements.sum(ngb * g, labels, labs) / normalizer - half[a] + p[:, a]
+                # the subscale resolution is calculated using only 3 pixels
+                n = ngb[(slice(None), slice(None)) + tuple(half[1:])]
+                denom = n[:, 2] - 2 * n[:, 1] + n[:, 0]
+                good = (np.abs(denom) + 1.0)**2 > 1.0
+                centers[idx, 1] = p[:, 0]
+                centers[idx[good], 1] = p[good, 0] - (n[good, 2] - n[good, 0]) / 2.0 / denom[good]
+        return centers
         
     def __call__(self, image, k=1.6, maxedge=-1, first_layer=False, maxDoG=None):
         """
@@ -1149,66 +1394,98 @@ class OctaveBlobFinder:
         """
         self.ncalls += 1
         self.fill(image, k)
-        self.initialize_binary(maxedge, first_layer, maxDoG)
-        t0 = time.clock()
-        centers = self.subpix()[:,::-1]
-        self.time_subpix += time.clock() - t0
+        with self.timings.stage('binary'):
+            self.initialize_binary(maxedge, first_layer, maxDoG)
+        with self.timings.stage('subpix'):
+            centers = self.subpix()[:,::-1]
         # convert scale to size
         n = (len(self.layers)-2)
-        centers[:, -2] = scale2radius(centers[:, -2], k, n, self.layers.ndim-1)
+        centers[:, -2] = scale2radius(centers[:, -2], k, n, self.layers.ndim-1-self.nbatch)
         self.noutputs += len(centers)
         return centers
         
         
 class MultiscaleBlobFinder:
     """Locator of bright blobs in an image of fixed shape. Works on more than one octave, starting at octave -1."""
-    def __init__(self, shape=(256,256), nbLayers=3, nbOctaves=3, dtype=np.float32, Octave0=True):
-        """Allocate memory for each octave"""
+    def __init__(self, shape=(256,256), nbLayers=3, nbOctaves=3, dtype=np.float32, Octave0=True, smoothing='exact', fused=False, timings=None):
+        """Allocate memory for each octave.
+
+        smoothing is the Gaussian filter used for preblurring and to build the scale space, see OctaveBlobFinder.
+        fused selects the single pass extraction of the scale space minima in each octave, see OctaveBlobFinder.
+        timings is the registry of the time spent in each stage, see Timings. It is shared with the octaves."""
+        self.timings = Timings() if timings is None else timings
+        self.smoothing = get_smoothing(smoothing)
         shapes = np.vstack([np.ceil([s*2.0**(Octave0-o) for s in shape]) for o in range(nbOctaves)])
         shapes = shapes.astype(int)
         self.preblurred = np.empty(shapes[0], dtype)
         self.octaves = [
-            OctaveBlobFinder(s, nbLayers, dtype)
+            OctaveBlobFinder(s, nbLayers, dtype, smoothing, fused, self.timings)
             for s in shapes if s.min() > 8
             ]  # shortens the list of octaves if no blob can be detected in that small window
         if not Octave0:
-            self.octaves.insert(0, OctaveBlobFinder([0]*len(shape), nbLayers, dtype))
+            self.octaves.insert(0, OctaveBlobFinder([0]*len(shape), nbLayers, dtype, smoothing, fused, self.timings))
         self.Octave0 = Octave0
-        self.time = 0.0
+        self.deconvolver = None
         self.ncalls = 0
+
+    @property
+    def time(self):
+        """Time spent in all the stages of the registry, kept for compatibility. Only recorded when self.timings is enabled."""
+        return self.timings.total()
+
+    @property
+    def time_overlap(self):
+        """Time spent removing overlapping blobs, kept for compatibility. Only recorded when self.timings is enabled."""
+        return self.timings.total('overlap')
+
+    def get_deconvolver(self, shape, deconvKernel):
+        """Deconvolver for the given kernel, cached between calls with the same shape and kernel"""
+        if isinstance(deconvKernel, Deconvolver):
+            return deconvKernel
+        if (self.deconvolver is None
+                or self.deconvolver.shape != tuple(shape)
+                or not np.array_equal(self.deconvolver.kernel, deconvKernel)):
+            self.deconvolver = Deconvolver(shape, deconvKernel)
+        return self.deconvolver
         
     def __call__(self, image, k=1.6, Octave0=True,
-                 removeOverlap=True, maxedge=-1, deconvKernel=None, first_layer=False, maxDoG=None):
-        """Locate blobs in each octave and regroup the results"""
+                 removeOverlap=True, maxedge=-1, deconvKernel=None, first_layer=False, maxDoG=None,
+                 overlapMethod='kdtree'):
+        """Locate blobs in each octave and regroup the results.
+
+        If removeOverlap is True, overlapping blobs are removed (keeping the most intense) using overlapMethod, see remove_overlap.
+        deconvKernel is either a kernel output by get_deconv_kernel or a Deconvolver."""
         if not self.Octave0:
             Octave0 = False
         self.ncalls += 1
-        t0 = time.clock()
         if len(self.octaves)==0:
             return np.zeros([0, image.ndim+2])
         #upscale the image for octave -1
         #halfbl = gaussian_filter(np.array(im, , k/2.0)
         if Octave0:
-            im2 = np.copy(image)
-            for a in range(image.ndim):
-                im2 = np.repeat(im2, 2, a)
-            #preblur octave -1
-            gaussian_filter(im2, k, output=self.preblurred)
+            with self.timings.stage('preblur'):
+                #nearest neighbour upsampling directly into the preallocated buffer
+                for offsets in itertools.product([0, 1], repeat=image.ndim):
+                    self.preblurred[tuple(slice(o, None, 2) for o in offsets)] = image
+                #preblur octave -1 in place
+                self.smoothing(self.preblurred, k, output=self.preblurred)
             #locate blobs in octave -1
             centers = [self.octaves[0](self.preblurred, k, maxedge, maxDoG=maxDoG)]
         else:
             centers = []
         if len(self.octaves) > 1:
             if deconvKernel is not None:
-                assert len(deconvKernel) == image.shape[0]/2+1
                 assert image.ndim == 3
                 # deconvolve the Z direction by a precalculated kernel
                 # To avoid noise amplification, the blurred image is deconvolved, not the raw one
-                deconv = deconvolve(gaussian_filter(image.astype(float), k), deconvKernel)
-                # remove negative values
-                centers += [self.octaves[1](np.maximum(0, deconv), k=k, maxedge=maxedge, first_layer=first_layer, maxDoG=maxDoG)]
+                # negative values are removed
+                with self.timings.stage('deconvolution'):
+                    deconv = self.get_deconvolver(image.shape, deconvKernel)(image, k, positive=True)
+                centers += [self.octaves[1](deconv, k=k, maxedge=maxedge, first_layer=first_layer, maxDoG=maxDoG)]
             else:
-                centers += [self.octaves[1](gaussian_filter(image, k), k=k, maxedge=maxedge, first_layer=first_layer, maxDoG=maxDoG)]
+                with self.timings.stage('preblur'):
+                    preblurred = self.smoothing(image, k)
+                centers += [self.octaves[1](preblurred, k=k, maxedge=maxedge, first_layer=first_layer, maxDoG=maxDoG)]
                 #centers += [self.octaves[1](gaussian_filter(image, k), maxedge=maxedge, first_layer=first_layer, maxDoG=maxDoG)]
         # subsample the -3 layerG of the previous octave
         # which is two times more blurred that layer 0
@@ -1229,51 +1506,451 @@ class MultiscaleBlobFinder:
         if not removeOverlap:
             return centers
         #remove overlaping objects (keep the most intense)
-        #scales in dim*N^2, thus expensive if many centers and in high dimensions
-        #Using a spatial index may be faster
+        with self.timings.stage('overlap'):
+            return remove_overlap(centers, overlapMethod)
+
+
+class BatchOctaveBlobFinder(OctaveBlobFinder):
+    """Locator of bright blobs in a batch of 1D signals of equal length. Works on a single octave.
+
+    The signals are stored end to end in the DoG layers, so that the methods of OctaveBlobFinder apply. Smoothing does not mix signals and no center is closer to the ends of its signal than its size."""
+    def __init__(self, shape=(1, 16), nbLayers=3, dtype=np.float32, timings=None):
+        """Allocate memory once for shape[0] signals of length shape[1]"""
+        OctaveBlobFinder.__init__(self, [shape[0] * shape[1]], nbLayers, dtype, timings=timings)
+        self.length = shape[1]
+
+    def fill(self, image, k=1.6):
+        """All the image processing when accepting a new batch of signals."""
+        signals = self.layersG.reshape(len(self.layersG), -1, self.length)
+        assert signals[0].shape == image.shape, """Wrong batch size:
+%s instead of %s""" % (image.shape, signals[0].shape)
+        with self.timings.stage('fill'):
+            signals[0] = image
+            self.sizes, sigmas_iter = self.get_iterative_radii(k)
+            # Gaussian filters along each signal
+            for l in range(len(signals)-1):
+                gaussian_filter1d(signals[l], sigmas_iter[l], output=signals[l+1])
+            # Difference of Gaussian layers
+            np.subtract(self.layersG[1:], self.layersG[:-1], out=self.layers)
+        with self.timings.stage('erosion'):
+            grey_erosion(self.layers, [3]*self.layers.ndim, output=self.eroded)
+
+    def initialize_binary(self, maxedge=-1, first_layer=False, maxDoG=None):
+        """Convert the DoG layers into the binary image, True at center position.
+
+        Same as OctaveBlobFinder.initialize_binary, except that centers are excluded at the ends of each signal. maxedge is meaningless in 1D and first_layer is not available."""
+        if maxDoG is None:
+            maxDoG = 0
+        self.binary = numexpr.evaluate(
+            '(l==e) & (l<maxDoG) & (l**2+1.0>1.0)',
+            {
+                'l': self.layers,
+                'e': self.eroded,
+                'maxDoG': maxDoG
+                }
+            )
+        self.binary[0] = False
+        self.binary[-1] = False
+        for r, bi in zip(self.sizes[1:-1], self.binary[1:-1]):
+            bi = bi.reshape(-1, self.length)
+            bi[:, :r] = False
+            bi[:, -r:] = False
+
+    def __call__(self, image, k=1.6, maxedge=-1, first_layer=False, maxDoG=None):
+        """Locate bright blobs in each signal with subpixel resolution.
+        Returns an array of (signal index, x, r, -intensity in scale space)"""
+        centers = OctaveBlobFinder.__call__(self, image, k, maxDoG=maxDoG)
+        signal = np.floor(centers[:, 0] / self.length)
+        centers[:, 0] -= signal * self.length
+        return np.column_stack((signal, centers))
+
+
+class BatchBlobFinder:
+    """Locator of bright blobs in a batch of 1D signals of equal length, e.g. the z profiles of piles of 2D centers.
+
+    Equivalent to calling MultiscaleBlobFinder([length]) on each signal, but all signals are processed at once."""
+    def __init__(self, shape=(1, 16), nbLayers=3, nbOctaves=3, dtype=np.float32, timings=None):
+        """Allocate memory for each octave, for shape[0] signals of length shape[1]. timings is shared with the octaves, see Timings."""
+        self.timings = Timings() if timings is None else timings
+        lengths = [int(np.ceil(shape[1]*2.0**(1-o))) for o in range(nbOctaves)]
+        self.preblurred = np.empty([shape[0], lengths[0]], dtype)
+        self.octaves = [
+            BatchOctaveBlobFinder([shape[0], l], nbLayers, dtype, self.timings)
+            for l in lengths if l > 8
+            ]
+        self.ncalls = 0
+
+    time = MultiscaleBlobFinder.time
+    time_overlap = MultiscaleBlobFinder.time_overlap
+
+    def __call__(self, signals, k=1.6, removeOverlap=True, maxDoG=None):
+        """Locate blobs in each octave and regroup the results.
+
+        Returns an array of (signal index, x, r, -intensity), sorted by signal. If removeOverlap is True, overlapping blobs of the same signal are removed (keeping the most intense) and the blobs of each signal are sorted by intensity."""
+        self.ncalls += 1
+        if len(self.octaves) == 0:
+            return np.zeros([0, 4])
+        with self.timings.stage('preblur'):
+            #upscale the signals for octave -1
+            self.preblurred[:, ::2] = signals
+            self.preblurred[:, 1::2] = signals
+            gaussian_filter1d(self.preblurred, k, output=self.preblurred)
+        centers = [self.octaves[0](self.preblurred, k, maxDoG=maxDoG)]
+        if len(self.octaves) > 1:
+            with self.timings.stage('preblur'):
+                preblurred = gaussian_filter1d(signals, k)
+            centers += [self.octaves[1](preblurred, k, maxDoG=maxDoG)]
+        # subsample the -3 layerG of the previous octave
+        for o, oc in enumerate(self.octaves[2:]):
+            centers += [oc(
+                self.octaves[o+1].layersG[-3].reshape(len(signals), -1)[:, ::2],
+                k, maxDoG=maxDoG
+                )]
+        # merge the results and scale the coordinates and sizes
+        centers = np.vstack([
+            c * [1, 2**(o-1), 2**(o-1), 1]
+            for o, c in enumerate(centers)
+            ])
+        if removeOverlap and len(centers) > 1:
+            #signals are put far apart on an extra axis
+            with self.timings.stage('overlap'):
+                spacing = 2 * (np.ptp(centers[:, 1]) + 2 * centers[:, 2].max()) + 1
+                centers[:, 0] *= spacing
+                centers = remove_overlap(centers, 'kdtree')
+                centers[:, 0] = np.rint(centers[:, 0] / spacing)
+        return centers[np.argsort(centers[:, 0], kind='stable')]
+
+
+class StackOctaveBlobFinder(OctaveBlobFinder):
+    """Locator of bright blobs in a stack of images of equal shape. Works on a single octave.
+
+    The first axis indexes the images. Smoothing, local minima and subpixel refinement act only along the other axes, so that images are never mixed."""
+    nbatch = 1
+
+    def __init__(self, shape=(1, 256, 256), nbLayers=3, dtype=np.float32, timings=None):
+        """Allocate memory once for shape[0] images of shape shape[1:]"""
+        OctaveBlobFinder.__init__(self, shape, nbLayers, dtype, timings=timings)
+
+    def fill(self, image, k=1.6):
+        """All the image processing when accepting a new stack."""
+        assert self.layersG[0].shape == image.shape, """Wrong stack size:
+%s instead of %s""" % (image.shape, self.layersG[0].shape)
+        with self.timings.stage('fill'):
+            self.layersG[0] = image
+            self.sizes, sigmas_iter = self.get_iterative_radii(k)
+            # Gaussian filters along the spatial axes only
+            for l, layer in enumerate(self.layersG[:-1]):
+                gaussian_filter(layer, [0] + [sigmas_iter[l]] * (layer.ndim-1), output=self.layersG[l+1])
+            # Difference of Gaussian layers
+            np.subtract(self.layersG[1:], self.layersG[:-1], out=self.layers)
+        with self.timings.stage('erosion'):
+            grey_erosion(self.layers, [3, 1] + [3]*(self.layers.ndim-2), output=self.eroded)
+
+    def initialize_binary(self, maxedge=-1, first_layer=False, maxDoG=None):
+        """Convert the DoG layers into the binary image, True at center position.
+
+        Same as OctaveBlobFinder.initialize_binary, except that centers are excluded only at the spatial edges of each image. maxedge applies to stacks of 2D images and first_layer is not available."""
+        if maxDoG is None:
+            maxDoG = 0
+        self.binary = numexpr.evaluate(
+            '(l==e) & (l<maxDoG) & (l**2+1.0>1.0)',
+            {
+                'l': self.layers,
+                'e': self.eroded,
+                'maxDoG': maxDoG
+                }
+            )
+        self.binary[0] = False
+        self.binary[-1] = False
+        for r, bi in zip(self.sizes[1:-1], self.binary[1:-1]):
+            for a in range(1, bi.ndim):
+                bi[(slice(None),)*a + (slice(0, r),)] = False
+                bi[(slice(None),)*a + (slice(-r, None),)] = False
+        if self.layers.ndim == 4 and maxedge > 0:
+            c0 = np.transpose(np.where(self.binary))
+            self.binary[tuple(c0[hessian_edges(self.layers, c0, maxedge)].T)] = False
+
+
+class StackBlobFinder:
+    """Locator of bright blobs in a stack of images of equal shape, e.g. a (T, H, W) block of frames of a 2D time series.
+
+    Equivalent to calling MultiscaleBlobFinder(shape[1:]) on each image, but all images are processed at once."""
+    def __init__(self, shape=(1, 256, 256), nbLayers=3, nbOctaves=3, dtype=np.float32, Octave0=True, timings=None):
+        """Allocate memory for each octave, for shape[0] images of shape shape[1:]. timings is shared with the octaves, see Timings."""
+        self.timings = Timings() if timings is None else timings
+        shapes = [
+            [shape[0]] + [int(np.ceil(s*2.0**(Octave0-o))) for s in shape[1:]]
+            for o in range(nbOctaves)
+            ]
+        self.preblurred = np.empty(shapes[0], dtype)
+        self.octaves = [
+            StackOctaveBlobFinder(s, nbLayers, dtype, self.timings)
+            for s in shapes if min(s[1:]) > 8
+            ]
+        if not Octave0:
+            self.octaves.insert(0, StackOctaveBlobFinder([shape[0]]+[0]*(len(shape)-1), nbLayers, dtype, self.timings))
+        self.Octave0 = Octave0
+        self.ncalls = 0
+
+    def __call__(self, stack, k=1.6, Octave0=True, removeOverlap=True, maxedge=-1, maxDoG=None):
+        """Locate blobs in each octave and regroup the results.
+
+        Returns a list of arrays of (coordinates, r, -intensity), one per image, as MultiscaleBlobFinder would. If removeOverlap is True, overlapping blobs of the same image are removed (keeping the most intense)."""
+        if not self.Octave0:
+            Octave0 = False
+        self.ncalls += 1
+        dim = stack.ndim - 1
+        if len(self.octaves) == 0:
+            return [np.zeros([0, dim+2]) for t in range(len(stack))]
+        sigma = [0] + [k] * dim
+        if Octave0:
+            with self.timings.stage('preblur'):
+                #nearest neighbour upsampling of each image
+                for offsets in itertools.product([0, 1], repeat=dim):
+                    self.preblurred[(slice(None),) + tuple(slice(o, None, 2) for o in offsets)] = stack
+                gaussian_filter(self.preblurred, sigma, output=self.preblurred)
+            centers = [self.octaves[0](self.preblurred, k, maxedge, maxDoG=maxDoG)]
+        else:
+            centers = []
+        if len(self.octaves) > 1:
+            with self.timings.stage('preblur'):
+                preblurred = gaussian_filter(stack, sigma)
+            centers += [self.octaves[1](preblurred, k, maxedge, maxDoG=maxDoG)]
+        # subsample the -3 layerG of the previous octave
+        for o, oc in enumerate(self.octaves[2:]):
+            centers += [oc(
+                self.octaves[o+1].layersG[-3][(slice(None),) + (slice(None, None, 2),) * dim],
+                k, maxedge, maxDoG=maxDoG
+                )]
+        # merge the results and scale the coordinates and sizes, but not the image index
+        centers = np.vstack([
+            c * ([2**(o-Octave0)]*dim + [1, 2**(o-Octave0), 1])
+            for o, c in enumerate(centers)
+            ])
+        if removeOverlap and len(centers) > 1:
+            #images are put far apart on their axis
+            with self.timings.stage('overlap'):
+                spacing = 2 * (np.ptp(centers[:, :dim]) + 2 * centers[:, -2].max()) + 1
+                centers[:, dim] *= spacing
+                centers = remove_overlap(centers, 'kdtree')
+                centers[:, dim] = np.rint(centers[:, dim] / spacing)
+        index = centers[:, dim].astype(int)
+        centers = np.delete(centers, dim, axis=1)[np.argsort(index, kind='stable')]
+        return np.split(centers, np.cumsum(np.bincount(index, minlength=len(stack)))[:-1])
+
+
+class TiledBlobFinder:
+    """Locator of bright blobs in an image too large to be processed at once.
+
+    The image is cut into overlapping tiles of fixed shape that are processed one after the other by the same MultiscaleBlobFinder. Only the blobs whose center is in the core of a tile (the tile without its halo) are kept, then the duplicates across tile borders are removed. Memory usage is thus bounded by the tile size, and the image can be a memory mapped array.
+    Tiles start at multiples of the subsampling step of the last octave, so that each octave is sampled on the same grid as in the whole image. The tiles at the end of an axis are thus up to step-1 pixels longer, and are processed after the others by a finder allocated for their shape."""
+    def __init__(self, tile=(128,128,128), nbLayers=3, nbOctaves=3, dtype=np.float32, Octave0=True, k=1.6, halo=None, timings=None):
+        """Allocate memory for a single tile.
+
+        tile is the shape of the core of a tile. If halo is None, its width is given by default_halo, see there for the trade-off between the width of the halo and the agreement with the detection on the whole image. The core and the halo are rounded up to multiples of the subsampling step of the last octave.
+        timings is the registry of the time spent in each stage, see Timings. It is shared with the finder."""
+        self.timings = Timings() if timings is None else timings
+        if halo is None:
+            halo = self.default_halo(nbLayers, nbOctaves, Octave0, k)
+        self.step = 2**max(0, nbOctaves - 1 - Octave0)
+        self.halo = -(-int(halo) // self.step) * self.step
+        self.core = -(-np.array(tile, int) // self.step) * self.step
+        self.shape = tuple(int(t) for t in self.core + 2*self.halo)
+        self.nbLayers = nbLayers
+        self.nbOctaves = nbOctaves
+        self.dtype = dtype
+        self.Octave0 = Octave0
+        #shape of the images the finder has been allocated for
+        self.finder_shape = self.shape
+        self.finder = MultiscaleBlobFinder(self.shape, nbLayers, nbOctaves, dtype, Octave0, timings=self.timings)
+        self.ntiles = 0
+
+    @staticmethod
+    def default_halo(nbLayers=3, nbOctaves=3, Octave0=True, k=1.6, truncate=3.0):
+        """Width of the halo: truncate times the standard deviation of the widest Gaussian kernel used by a MultiscaleBlobFinder (the last Gaussian layer of the last octave), in pixels of the image.
+
+        The influence of the tile border on the blobs of the core decays like a Gaussian tail. With truncate=3, positions agree with the detection on the whole image within a few 1e-3 pixel. With truncate=4, the truncation of scipy's Gaussian filter, they agree within about 1e-4 pixel, but the halo is 4/3 wider, and a tile costs ((core + 2*halo)/core)**ndim times the memory of its core."""
+        sigma = k * 2 ** ((nbLayers + 2)/float(nbLayers)) * 2**(nbOctaves - 1 - Octave0)
+        return int(np.ceil(truncate * sigma))
+
+    def tiles(self, shape):
+        """Generate the (tile, core) slices covering an image of a given shape. Tiles have the shape of the finder or of the image if smaller, except at the end of an axis where they can be up to step-1 pixels longer."""
+        assert len(shape) == len(self.core)
+        ranges = []
+        for n, c, t in zip(shape, self.core, self.shape):
+            t = min(t, n)
+            cuts = list(range(0, n, c)) + [n]
+            r = []
+            for a, b in zip(cuts[:-1], cuts[1:]):
+                #tiles start on the grid of the last octave
+                s = min(max(0, a - self.halo), (n - t) // self.step * self.step)
+                e = s + t
+                if n - e < self.step:
+                    e = n
+                r.append((slice(s, e), slice(a, b)))
+            ranges.append(r)
+        for r in itertools.product(*ranges):
+            yield tuple(u[0] for u in r), tuple(u[1] for u in r)
+
+    def __call__(self, image, k=1.6, removeOverlap=True, overlapMethod='kdtree', **kwargs):
+        """Locate blobs in each tile and merge the results. Other keyword arguments are passed to MultiscaleBlobFinder."""
         out = []
-        for i in centers[np.argsort(centers[:, -1])]:
-            for j in out:
-                if np.sum((i[:-2]-j[:-2])**2) < (i[-2]+j[-2])**2:
-                    break
-            else:
-                out.append(i)
-        self.time += time.clock() - t0
-        return np.vstack(out)
+        #tiles of the shape of the finder first, then the longer tiles grouped by shape
+        tiles = sorted(self.tiles(image.shape), key=lambda tc: (
+            tuple(s.stop - s.start for s in tc[0]) != self.shape,
+            tuple(s.stop - s.start for s in tc[0])
+            ))
+        for tile, core in tiles:
+            with self.timings.stage('read'):
+                im = np.asarray(image[tile], self.dtype)
+            if im.shape != self.finder_shape:
+                #the image is smaller than a tile along some dimension
+                self.finder_shape = im.shape
+                self.finder = MultiscaleBlobFinder(im.shape, self.nbLayers, self.nbOctaves, self.dtype, self.Octave0, timings=self.timings)
+            centers = self.finder(im, k=k, removeOverlap=removeOverlap, overlapMethod=overlapMethod, **kwargs)
+            self.ntiles += 1
+            #coordinates in the whole image. Coordinates are in reverse order of the axes.
+            centers[:, :image.ndim] += [t.start for t in tile[::-1]]
+            #keep only the centers inside the core
+            inside = np.ones(len(centers), bool)
+            for a, c in enumerate(core[::-1]):
+                inside &= (centers[:, a] >= c.start - 0.5) & (centers[:, a] < c.stop - 0.5)
+            out.append(centers[inside])
+        centers = np.vstack(out)
+        if removeOverlap and len(centers) > 1:
+            #blobs detected in two tiles
+            with self.timings.stage('overlap'):
+                centers = remove_overlap(centers, overlapMethod)
+        return centers
 
-def treatFrame(serie, t, file_pattern, finder=None ):
+
+#state of each worker process of localize_serie
+localize_worker = {}
+
+
+def init_localize_worker(path, offset, shape, finder_kwargs):
+    """Open the LIF file and allocate a finder once per worker process"""
+    for s in lif.Reader(path):
+        if s.getOffset() == offset:
+            localize_worker['serie'] = s
+            break
+    else:
+        raise ValueError('No serie at offset %d in %s' % (offset, path))
+    localize_worker['finder'] = MultiscaleBlobFinder(shape, **finder_kwargs)
+
+
+def localize_worker_frame(t, kwargs):
+    return localize_worker['finder'](localize_worker['serie'].getFrame(T=t), **kwargs)
+
+
+def localize_serie(serie, processes=None, finder_kwargs=None, path=None, **kwargs):
+    """Locate blobs in all the frames of a lif.Serie using a pool of processes.
+
+    Each process opens its own handle to the LIF file at path and holds its own preallocated MultiscaleBlobFinder (constructed with finder_kwargs). Other keyword arguments are passed to MultiscaleBlobFinder.__call__.
+    Worker processes are spawned, not forked, since forking a process where numba parallel kernels already started their threads can hang.
+    If path is None, it is the name of the file object of the serie, which must then be a file on disk.
+    Yields (t, centers) in time order. At most two frames per process are pending, so that memory usage does not grow with the number of frames.
+    If processes is 1, everything is done in the current process and path is not needed."""
+    finder_kwargs = finder_kwargs or {}
+    if processes is None:
+        processes = os.cpu_count()
+    shape = serie.getFrameShape()
+    if processes > 1 and path is None:
+        path = getattr(serie.f, 'name', None)
+        if not isinstance(path, str) or not os.path.isfile(path):
+            raise ValueError(
+                'The LIF file of the serie cannot be reopened by the worker processes. '
+                'Give its path or use processes=1')
+    if processes == 1:
+        finder = MultiscaleBlobFinder(shape, **finder_kwargs)
+        for t in range(serie.getNbFrames()):
+            yield t, finder(serie.getFrame(T=t), **kwargs)
+        return
+    #numba may already run threads in this process: do not fork it
+    with ProcessPoolExecutor(
+            processes, mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_localize_worker,
+            initargs=(path, serie.getOffset(), shape, finder_kwargs)
+            ) as executor:
+        pending = deque()
+        for t in range(serie.getNbFrames()):
+            pending.append((t, executor.submit(localize_worker_frame, t, kwargs)))
+            if len(pending) >= 2 * processes:
+                u, future = pending.popleft()
+                yield u, future.result()
+        while len(pending):
+            u, future = pending.popleft()
+            yield u, future.result()
+
+
+def link_slices(slices, ZXratio=1.0):
+    """Link the 2D centers of consecutive slices into clusters (piles of 2D centers along z).
+
+    slices is a list of (x, y, r, -intensity) arrays, one per slice, as returned by a 2D finder. Two centers of adjacent slices can be linked if their xy distance is smaller than both their radii. Links are accepted by increasing distance, each center being linked at most once upward and once downward.
+    Returns a list of clusters, each an array of (x, y, z*ZXratio, r, intensity) sorted by z."""
+    traj = []
+    nbtrajs = 0
+    previous = None
+    for z, centers in enumerate(slices):
+        matched = np.full(len(centers), -1, np.int64)
+        if previous is not None and len(previous) and len(centers):
+            dists = KDTree(previous[:, :2]).sparse_distance_matrix(
+                KDTree(centers[:, :2]), previous[:, 2].max(), output_type='ndarray'
+                )
+            dists = dists[
+                (dists['v'] < previous[dists['i'], 2]) & (dists['v'] < centers[dists['j'], 2])
+                ]
+            dists = dists[np.argsort(dists['v'], kind='stable')]
+            matched = kernels.greedy_matching(
+                np.column_stack((dists['i'], dists['j'])), len(previous), len(centers)
+                )
+        #unlinked centers start new clusters
+        new = matched < 0
+        tr = np.empty(len(centers), np.int64)
+        tr[new] = nbtrajs + np.arange(new.sum())
+        if not new.all():
+            tr[~new] = traj[-1][matched[~new]]
+        nbtrajs += new.sum()
+        traj.append(tr)
+        previous = centers
+    if nbtrajs == 0:
+        return []
+    pos = np.vstack([
+        np.column_stack((c[:, 0], c[:, 1], np.full(len(c), z*ZXratio), c[:, -2], -c[:, -1]))
+        for z, c in enumerate(slices) if len(c)
+        ])
+    traj = np.concatenate(traj)
+    #slices are in z order, a stable sort keeps each cluster sorted by z
+    order = np.argsort(traj, kind='stable')
+    return np.split(pos[order], np.where(np.diff(traj[order]))[0] + 1)
+
+
+def localize2D3D_frame(stack, finder=None, ZXratio=1.0, k=1.6, n=3):
+    """Localize 3D particles from the 2D centers of each slice of a stack, in memory.
+
+    The 2D centers are linked along z into clusters (see link_slices) that are converted into particles (see clusters2particles). Returns an array of (x, y, z, r, intensity)."""
+    if finder is None:
+        finder = MultiscaleBlobFinder(stack.shape[1:])
+    clusters = link_slices([finder(im) for im in stack], ZXratio)
+    if len(clusters) == 0:
+        return np.zeros([0, 5])
+    return clusters2particles(clusters, k, n)
+
+
+def treatFrame(serie, t, file_pattern, finder=None):
+    """Localize the particles of time step t in 3D from 2D slices and save them to file_pattern%(t, 0, 'npy')"""
     if finder is None:
         finder = MultiscaleBlobFinder(serie.get2DShape())
-    stack = serie.getFrame(T=t)
-    for z, im in enumerate(stack):
-        centers = finder(im)
-        np.savetxt(
-            file_pattern%(t, z, 'dat'),
-            np.vstack((
-                    [1, len(centers), 1],
-                    serie.get2DShape()+[1.6*np.sqrt(2)*2**(7.0/3)],
-                    centers[:,:-1]
-                    )), fmt='%g'
-            )
-        np.savetxt(file_pattern%(t, z, 'intensity'), centers[:,-1], fmt='%g')
-    pro = subprocess.Popen([
-        '/home/mathieu/test/bin/linker',
-        file_pattern%(t,0,'dat'),
-        '_z', '1', '%g'%serie.getZXratio(), '%d'%len(stack)
-        ], stdout=subprocess.PIPE)
-    trajfile = pro.communicate()[0].split()[-1]
-    clusters = load_clusters(trajfile)
-    particles = clusters2particles(clusters)
-    np.save(os.path.splitext(trajfile)[0], particles)
+    particles = localize2D3D_frame(serie.getFrame(T=t), finder, serie.getZXratio())
+    np.save(file_pattern%(t, 0, 'npy'), particles)
 
 def localize2D3D(serie, file_pattern, cleanup=True):
+    """Localize the particles of each time step in 3D from 2D slices, see treatFrame.
+
+    No intermediate file is written anymore, cleanup is kept for compatibility."""
     finder = MultiscaleBlobFinder(serie.get2DShape())
     for t in range(serie.getNbFrames()):
         treatFrame(serie, t, file_pattern, finder)
-        if cleanup:
-            for z in range(serie.getFrameShape()[-1]):
-                os.remove(file_pattern%(t, z, 'dat'))
-                os.remove(file_pattern%(t, z, 'intensity'))
               
         
   
@@ -3,7 +3,6 @@ from colloids import track, particles, phaseCorrelation
 from scipy.misc import imsave, imshow, imread
 import sys, itertools, re
 from os.path import split,join,isfile, splitext
-import Image
 from scipy.ndimage import gaussian_filter
 from scipy.interpolate import RectBivariateSpline
 from colloids.colors import colorscale
@@ -12,18 +11,8 @@ from matplotlib.colors import ListedColormap
 
 matplotlib.cm.register_cmap("bluetored", ListedColormap(colorscale(np.linspace(0,1,256,False)[None,:])[0]))
 
-def readTIFF16(path, bigendian=True):
-    """Read 16bits TIFF"""
-    im = Image.open(path)
-    out = np.fromstring(
-        im.tostring(), 
-        np.uint8
-        ).reshape(tuple(list(im.size)+[2]))
-    if bigendian:
-        return (np.array(out[:,:,0], np.uint16) << 8) + out[:,:,1]
-    else:
-        return (np.array(out[:,:,1], np.uint16) << 8) + out[:,:,0]
-    
+from colloids.track import readTIFF16
+
 def nth_period(a, n=2, guess=150, width=50):
     period = guess
     for i  in range(n):
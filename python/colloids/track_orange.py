@@ -3,16 +3,8 @@ from colloids import track, particles
 from scipy.misc import imsave, imshow, imread
 import sys, itertools, re
 from os.path import split,join,isfile, splitext
-import Image
 
-def readTIFF16(path):
-    """Read 16bits TIFF"""
-    im = Image.open(path)
-    out = np.fromstring(
-        im.tostring(), 
-        np.uint8
-        ).reshape(tuple(list(im.size)+[2]))
-    return (np.array(out[:,:,0], np.uint16)<<8)+out[:,:,1]
+from colloids.track import readTIFF16
 
 #read input file name
 if len(sys.argv) >1:
@@ -0,0 +1,92 @@
+"""Timing benchmarks of the localization on the bundled synthetic volumes.
+
+Each case is run on the original data and on tiled enlargements of it. Reports the best wall time over a few runs, the throughput in voxels per second (particles per second for the radius rescaling), the number of detections per second and the peak memory allocated during a run, not counting the buffers preallocated by the finders.
+
+usage: python benchmark_localization.py [repeat [largest enlargement]]
+"""
+import os.path, sys, time
+import tracemalloc
+import numpy as np
+from colloids import track
+from colloids.particles import get_bonds
+
+here = os.path.dirname(os.path.abspath(__file__))
+volume = np.load(os.path.join(here, 'hard_sphere_volume.npy')).astype(np.float32)
+positions = np.load(os.path.join(here, 'hard_sphere_64x64x64.npy'))
+radii = np.load(os.path.join(here, 'hard_sphere_size_64x64x64.npy'))
+dillute = np.load(os.path.join(here, os.pardir, 'colloids', 'dillute_raw.npy')).astype(np.float32)
+
+
+def enlarge(im, n):
+    """Tile an image n times along each axis"""
+    return np.tile(im, [n] * im.ndim)
+
+
+def enlarge_particles(n):
+    """Particles of the hard sphere volume tiled n times along each axis"""
+    shifts = np.mgrid[tuple([slice(0, n)] * 3)].reshape(3, -1).T * volume.shape[::-1]
+    return (positions[None] + shifts[:, None]).reshape(-1, 3), np.tile(radii, len(shifts))
+
+
+def measure(function, repeat):
+    """Best wall time over repeat runs (after a warm-up run), output of the last run and peak memory of an extra run"""
+    out = function()
+    best = np.inf
+    for r in range(repeat):
+        t0 = time.perf_counter()
+        out = function()
+        best = min(best, time.perf_counter() - t0)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, out, peak
+
+
+def finder_case(make_finder, im, **kwargs):
+    finder = make_finder(im.shape)
+    return lambda: finder(im, **kwargs), im.size
+
+
+def rescale_case(n, solver):
+    pos, rad = enlarge_particles(n)
+    sigma = track.radius2sigma(rad, dim=3)
+    bonds, dists = get_bonds(pos, rad, maxdist=1.5)
+    intensities = -np.ones(len(pos))
+    def rescale():
+        brights = track.solve_intensities(sigma, bonds, dists, intensities, solver=solver)
+        return track.global_rescale_intensity(sigma, bonds, dists, brights, solver=solver)
+    return rescale, len(pos)
+
+
+def cases(nmax):
+    sizes = [n for n in [1, 2, 4] if n <= nmax]
+    for n in sizes:
+        im = enlarge(dillute, 4*n)
+        yield 'CrockerGrier 2D', im.shape, finder_case(track.CrockerGrierFinder, im, threshold=0.1)
+        for Octave0 in [True, False]:
+            yield 'Multiscale 2D Octave0=%s' % Octave0, im.shape, finder_case(
+                lambda shape: track.MultiscaleBlobFinder(shape, Octave0=Octave0), im)
+    for n in sizes[:2]:
+        im = enlarge(volume, n)
+        yield 'CrockerGrier 3D', im.shape, finder_case(track.CrockerGrierFinder, im, uniform_size=0)
+        yield 'Multiscale 3D Octave0=False', im.shape, finder_case(
+            lambda shape: track.MultiscaleBlobFinder(shape, Octave0=False), im)
+        if n == 1:
+            #octave -1 of larger volumes needs several GB
+            yield 'Multiscale 3D Octave0=True', im.shape, finder_case(
+                lambda shape: track.MultiscaleBlobFinder(shape, Octave0=True), im)
+    for n in sizes:
+        for solver in ['direct', 'bicgstab']:
+            yield 'Rescale %s' % solver, (len(positions) * n**3,), rescale_case(n, solver)
+
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    nmax = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    print('%-30s %16s %10s %14s %14s %10s' % (
+        'case', 'shape', 'time (s)', 'throughput/s', 'detections/s', 'peak MB'))
+    for name, shape, (function, size) in cases(nmax):
+        best, out, peak = measure(function, repeat)
+        print('%-30s %16s %10.4f %14.3g %14.3g %10.1f' % (
+            name, 'x'.join(map(str, shape)), best, size / best, len(out) / best, peak / 2.0**20))
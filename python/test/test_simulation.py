@@ -30,15 +30,16 @@ plt.show()
 s = track.radius2sigma(centers[:, -2], dim=2)
 bonds, dists = get_bonds(positions=centers[:, :-2], radii=centers[:, -2], maxdist=8.0)
 
-brights1 = track.solve_intensities(s, bonds, dists, centers[:, -1])
-radii1 = track.global_rescale_intensity(s, bonds, dists, brights1)
+brights1 = track.solve_intensities(s, bonds, dists, centers[:, -1], solver='bicgstab')
+radii1 = track.global_rescale_intensity(s, bonds, dists, brights1, solver='bicgstab')
 
 draw_circles(np.hstack([centers[:, :3], np.array([radii1]).T]), z, facecolor='none', edgecolor='teal', lw=4)
 plt.imshow(im[:, :, z], 'hot')
 plt.show()
 
-brights2 = track.solve_intensities(s, bonds, dists, centers[:, -1], R0=radii1)
-radii2 = track.global_rescale_intensity(s, bonds, dists, brights2, R0=radii1)
+# warm start from the previous iteration: its brightnesses and its increment of the radii
+brights2 = track.solve_intensities(s, bonds, dists, centers[:, -1], R0=radii1, solver='bicgstab', x0=brights1)
+radii2 = track.global_rescale_intensity(s, bonds, dists, brights2, R0=radii1, solver='bicgstab', x0=radii1 - track.sigma2radius(s))
 
 draw_circles(np.hstack([centers[:, :3], np.array([radii2]).T]), z, facecolor='none', edgecolor='teal', lw=4)
 plt.imshow(im[:, :, z], 'hot')